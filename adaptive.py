@@ -0,0 +1,95 @@
+from budget import budget_fraction_left
+from models import config
+from state import GraphState
+
+
+def best_scores_by_round(responses):
+    """
+    Collects the best score reached in each round across all threads.
+
+    Args:
+        responses (list): The threads of the run.
+
+    Returns:
+        list[float]: The best score of each round, starting with the initial responses.
+    """
+    rounds = max(len(response["content"]) for response in responses)
+    return [
+        max(response["content"][r]["score"] for response in responses if len(response["content"]) > r)
+        for r in range(rounds)
+    ]
+
+
+def can_grow(state):
+    """
+    Determines whether the run can afford more threads or revisions.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        bool: False if the run has a budget and less than `min_budget_left_to_grow` of it is left.
+    """
+    left = budget_fraction_left(state)
+    return left is None or left >= config['adaptive_compute']['min_budget_left_to_grow']
+
+
+def reallocate_compute(state: GraphState) -> GraphState:
+    """
+    Re-evaluates the compute distribution after a round of revisions, based on the scores so far.
+
+    Search is widened (more threads) when the best score stalls at a low value, deepened
+    (more revisions) while it keeps climbing, and narrowed (fewer beams) when one thread
+    clearly dominates the others.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        GraphState: The updated threads, beams and revisions, and the decision taken.
+    """
+    settings = config['adaptive_compute']
+    if not settings['enabled']:
+        return {}
+
+    responses = state["responses"]
+    threads, beams, revisions = state["threads"], state["beams"], state["revisions"]
+    best = best_scores_by_round(responses)
+    if len(best) < 2:
+        return {}
+
+    improvement = best[-1] - best[-2]
+    latest = sorted((response["content"][-1]["score"] for response in responses), reverse=True)
+    changes = []
+
+    if improvement < settings['stall_delta'] and best[-1] < settings['low_score']:
+        if threads < settings['max_threads'] and can_grow(state):
+            threads = min(threads + settings['widen_step'], settings['max_threads'])
+            changes.append(f"widened to {threads} threads, best score stalled at {best[-1]}")
+    elif improvement >= settings['climb_delta']:
+        if revisions < settings['max_revisions'] and can_grow(state):
+            revisions += 1
+            changes.append(f"deepened to {revisions} revisions, best score climbed by {improvement:.2f}")
+
+    if len(latest) > 1 and latest[0] - latest[1] >= settings['dominance_gap'] and beams > 1:
+        beams -= 1
+        changes.append(f"narrowed to {beams} beams, best thread leads by {latest[0] - latest[1]:.2f}")
+
+    if not changes:
+        return {}
+
+    decision = {
+        "round": len(best) - 1,
+        "best_score": best[-1],
+        "threads": threads,
+        "beams": beams,
+        "revisions": revisions,
+        "changes": changes,
+    }
+    return {
+        "threads": threads,
+        "beams": beams,
+        "revisions": revisions,
+        "compute_decisions": [decision],
+        "stats": {"compute_reallocations": 1},
+    }
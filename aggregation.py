@@ -0,0 +1,112 @@
+import re
+
+BOXED_PATTERN = re.compile(r"\\boxed\{([^{}]+)\}")
+TAGGED_PATTERN = re.compile(r"<final_answer>(.*?)</final_answer>", re.DOTALL)
+STATED_PATTERN = re.compile(
+    r"(?:final answer|answer)\s*(?:is|:|=)\s*:?\s*(.+?)\s*(?:\.\s|\.?\s*$|\n)", re.IGNORECASE | re.MULTILINE
+)
+CHOICE_PATTERN = re.compile(r"^(?:option\s+|choice\s+)?\(?([a-e])\)?(?:[.):]\s.*)?$", re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r"^[-+]?\$?\d[\d,]*(?:\.\d+)?(?:\s*/\s*\d+)?\s*(?:%|[a-z/]+(?:\s[a-z/]+)?)?$", re.IGNORECASE)
+NUMERIC_PART_PATTERN = re.compile(r"[-+]?\d[\d,]*(?:\.\d+)?(?:\s*/\s*\d+)?")
+ARTICLES = {"a", "an", "the"}
+
+
+def extract_answer(text, max_words):
+    """
+    Extracts the final answer stated in a response.
+
+    A boxed or tagged answer is preferred, then the last "the answer is ..." statement,
+    and finally the whole response if it is short enough to be an answer by itself.
+
+    Args:
+        text (str): The response.
+        max_words (int): The longest answer, in words, that can be voted on.
+
+    Returns:
+        str | None: The raw answer, or None if the response states no short answer.
+    """
+    for pattern in (BOXED_PATTERN, TAGGED_PATTERN, STATED_PATTERN):
+        matches = pattern.findall(text)
+        if matches:
+            answer = matches[-1].strip().strip("*").strip()
+            return answer if len(answer.split()) <= max_words else None
+    text = text.strip()
+    return text if text and len(text.split()) <= max_words else None
+
+
+def normalize_answer(answer):
+    """
+    Normalizes an answer so that equivalent answers compare equal.
+
+    Numbers lose their formatting and units ("1,200.0 km" -> "1200", "3/4" -> "0.75"),
+    multiple-choice answers become their letter ("(b) Paris" -> "B"), and other answers
+    are lowercased without punctuation or articles.
+
+    Args:
+        answer (str): The raw answer.
+
+    Returns:
+        str: The normalized answer.
+    """
+    answer = answer.strip().strip("*$`").rstrip(".").strip()
+
+    choice = CHOICE_PATTERN.match(answer)
+    if choice and (len(answer) <= 3 or answer[:1] == "("):
+        return choice.group(1).upper()
+
+    if NUMBER_PATTERN.match(answer):
+        number = NUMERIC_PART_PATTERN.search(answer).group().replace(",", "").replace(" ", "")
+        if "/" in number:
+            numerator, denominator = number.split("/")
+            value = float(numerator) / float(denominator) if float(denominator) else float("nan")
+        else:
+            value = float(number)
+        return f"{value:.6f}".rstrip("0").rstrip(".")
+
+    words = re.sub(r"[^\w\s]", " ", answer.lower()).split()
+    return " ".join(word for word in words if word not in ARTICLES)
+
+
+def weighted_vote(threads, max_words):
+    """
+    Votes on the final answer of the threads, weighting every thread by the score of its latest response.
+
+    Args:
+        threads (list): The threads to vote with.
+        max_words (int): The longest answer, in words, that can be voted on.
+
+    Returns:
+        dict | None: The winning answer, the agreement (its share of the total weight, including threads
+            without a votable answer), the best thread that gave it, and the number of threads that voted
+            for it. None if no thread states a votable answer.
+    """
+    weights = {}
+    best = {}
+    best_weight = {}
+    votes = {}
+    total = 0.0
+    for thread in threads:
+        latest = thread["content"][-1]
+        weight = max(float(latest.get("score") or 0), 0.0)
+        total += weight
+        answer = extract_answer(latest["text"], max_words)
+        if answer is None:
+            continue
+        key = normalize_answer(answer)
+        if not key:
+            continue
+        weights[key] = weights.get(key, 0.0) + weight
+        votes[key] = votes.get(key, 0) + 1
+        if key not in best or weight > best_weight[key]:
+            best[key], best_weight[key] = thread, weight
+
+    if not weights:
+        return None
+
+    winner = max(weights, key=weights.get)
+    return {
+        "answer": winner,
+        "agreement": weights[winner] / total if total else votes[winner] / len(threads),
+        "thread": best[winner],
+        "votes": votes[winner],
+    }
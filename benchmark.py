@@ -0,0 +1,333 @@
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from aggregation import NUMERIC_PART_PATTERN, extract_answer, normalize_answer
+
+MAX_ANSWER_WORDS = 20
+
+# Settings the modules only read when they are imported (the models and their prompts, the tools and the
+# call queues), so overriding them for a variant would have no effect; "*" matches any key
+IMPORT_TIME_SETTINGS = (
+    ("llms",),
+    ("cascade", "*", "name"),
+    ("cascade", "*", "model"),
+    ("cassette",),
+    ("scheduling", "enabled"),
+    ("tools",),
+    ("tool_execution", "max_concurrent_calls"),
+    ("hedging", "window"),
+)
+
+
+def load_dataset(path):
+    """
+    Loads a labeled question set.
+
+    Args:
+        path (str): A JSON lines file with a "question" and a reference "answer" on every line.
+
+    Returns:
+        list[dict]: The questions and their reference answers.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def answer_matches(response, reference):
+    """
+    Checks whether a response gives the reference answer.
+
+    The final answer is extracted and normalized like the answer votes of the final
+    summary. A numeric reference may also match the first number of a longer stated
+    answer, and other references may appear in it as whole words.
+
+    Args:
+        response (str): The final response of a run.
+        reference: The reference answer.
+
+    Returns:
+        bool: True if the response is correct.
+    """
+    expected = normalize_answer(str(reference))
+    stated = extract_answer(response, MAX_ANSWER_WORDS)
+    answer = normalize_answer(stated or response)
+    if answer == expected:
+        return True
+
+    try:
+        float(expected)
+    except ValueError:
+        return f" {expected} " in f" {answer} "
+
+    number = NUMERIC_PART_PATTERN.search(stated or "")
+    return number is not None and normalize_answer(number.group()) == expected
+
+
+def apply_overrides(target, overrides):
+    """
+    Merges a variant's overrides into the config, in place so every module sees them.
+
+    Args:
+        target (dict): The config, or a section of it.
+        overrides (dict): The values to override, nested like the config.
+    """
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            apply_overrides(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def import_time_overrides(overrides, path=()):
+    """
+    Finds the overrides of settings that are only read when the modules are imported.
+
+    Args:
+        overrides (dict): The values to override, nested like the config.
+        path (tuple): The keys of the section the overrides apply to.
+
+    Returns:
+        list[str]: The dotted path of every such override.
+    """
+    found = []
+    for key, value in overrides.items():
+        key_path = path + (str(key),)
+        if any(len(setting) == len(key_path) and all(part in ("*", name) for part, name in zip(setting, key_path))
+               for setting in IMPORT_TIME_SETTINGS):
+            found.append(".".join(key_path))
+        elif isinstance(value, dict):
+            found.extend(import_time_overrides(value, key_path))
+    return found
+
+
+def check_overrides(name, overrides):
+    """
+    Rejects overrides that would be silently ignored.
+
+    Args:
+        name (str): The name of the variant or scenario.
+        overrides (dict): Its config overrides.
+
+    Raises:
+        ValueError: If the overrides change settings that are only read when the modules are imported.
+    """
+    ignored = import_time_overrides(overrides)
+    if ignored:
+        raise ValueError(f"{name} overrides {', '.join(ignored)}, which only take effect when set in the config file")
+
+
+def restore_config(target, snapshot):
+    """
+    Restores the config to a snapshot, in place so every module sees it.
+
+    Args:
+        target (dict): The config, or a section of it.
+        snapshot (dict): A deep copy of the config taken before the overrides.
+    """
+    for key in list(target):
+        if key not in snapshot:
+            del target[key]
+    for key, value in snapshot.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            restore_config(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def run_variant(run_question, config, variant, dataset):
+    """
+    Runs every question of the dataset through one pipeline variant.
+
+    Args:
+        run_question (callable): Runs a question through the graph, see `test_time_compute.run_question`.
+        config (dict): The shared config.
+        variant (dict): The name of the variant and its config overrides.
+        dataset (list[dict]): The questions and reference answers.
+
+    Returns:
+        list[dict]: The outcome of every question.
+    """
+    from models import llm_mapping
+    from stub_models import configure_stub_models
+
+    snapshot = copy.deepcopy(config)
+    apply_overrides(config, variant.get('overrides') or {})
+    # The stub models read their settings when they are built
+    configure_stub_models(llm_mapping, config.get('stub', {}))
+    results = []
+    try:
+        for index, item in enumerate(dataset):
+            started = time.time()
+            try:
+                result = run_question(item["question"], log_name=f"benchmark_{variant['name']}_{index}.txt")
+                response, error = result.get("final_response") or "", None
+                stats, confidence = result["stats"], result.get("confidence")
+            except Exception as e:
+                response, error, stats, confidence = "", f"{type(e).__name__}: {e}", {}, None
+            results.append({
+                "variant": variant['name'],
+                "question": item["question"],
+                "reference": item["answer"],
+                "response": response,
+                "correct": error is None and answer_matches(response, item["answer"]),
+                "error": error,
+                "confidence": confidence,
+                "seconds": time.time() - started,
+                "llm_calls": stats.get("llm_calls", 0),
+                "tokens": stats.get("input_tokens", 0) + stats.get("output_tokens", 0),
+                "cost": stats.get("cost", 0),
+            })
+    finally:
+        restore_config(config, snapshot)
+        configure_stub_models(llm_mapping, config.get('stub', {}))
+    return results
+
+
+def summarize(name, results):
+    """
+    Aggregates the outcomes of a variant.
+
+    Args:
+        name (str): The name of the variant.
+        results (list[dict]): The outcome of every question.
+
+    Returns:
+        dict: The accuracy, errors, mean LLM calls, tokens and cost per question, and p50/p95 latency.
+    """
+    seconds = [result["seconds"] for result in results]
+    return {
+        "variant": name,
+        "questions": len(results),
+        "accuracy": float(np.mean([result["correct"] for result in results])),
+        "errors": sum(result["error"] is not None for result in results),
+        "llm_calls": float(np.mean([result["llm_calls"] for result in results])),
+        "tokens": float(np.mean([result["tokens"] for result in results])),
+        "cost": float(np.mean([result["cost"] for result in results])),
+        "p50_seconds": float(np.percentile(seconds, 50)),
+        "p95_seconds": float(np.percentile(seconds, 95)),
+    }
+
+
+def markdown_report(summaries, config_path, dataset_path):
+    """
+    Formats the comparison of the variants as a markdown table.
+
+    Args:
+        summaries (list[dict]): The summary of every variant.
+        config_path (str): The config the benchmark ran with.
+        dataset_path (str): The question set.
+
+    Returns:
+        str: The report.
+    """
+    lines = [
+        "# Benchmark report",
+        "",
+        f"Config: `{config_path}`, dataset: `{dataset_path}`",
+        "",
+        "| Variant | Accuracy | Errors | LLM calls | Tokens | Cost ($) | p50 (s) | p95 (s) |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for s in summaries:
+        lines.append(
+            f"| {s['variant']} | {s['accuracy']:.1%} | {s['errors']} | {s['llm_calls']:.1f} | {s['tokens']:.0f} "
+            f"| {s['cost']:.4f} | {s['p50_seconds']:.2f} | {s['p95_seconds']:.2f} |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def find_regressions(summaries, baseline, limits):
+    """
+    Compares the variants against a previous report.
+
+    Args:
+        summaries (list[dict]): The summary of every variant.
+        baseline (dict): A previous JSON report.
+        limits (dict): The largest accuracy drop, and relative increase in LLM calls, tokens and p95 latency, allowed.
+
+    Returns:
+        list[str]: A description of every regression.
+    """
+    previous = {s["variant"]: s for s in baseline["variants"]}
+    regressions = []
+    for s in summaries:
+        before = previous.get(s["variant"])
+        if not before:
+            continue
+        if before["accuracy"] - s["accuracy"] > limits['max_accuracy_drop']:
+            regressions.append(f"{s['variant']}: accuracy fell from {before['accuracy']:.1%} to {s['accuracy']:.1%}")
+        for metric, limit in (("llm_calls", "max_calls_increase"), ("tokens", "max_tokens_increase"), ("p95_seconds", "max_p95_increase")):
+            if before[metric] and s[metric] > before[metric] * (1 + limits[limit]):
+                regressions.append(f"{s['variant']}: {metric} rose from {before[metric]:.2f} to {s[metric]:.2f}")
+    return regressions
+
+
+def main():
+    """
+    Command-line entry point: runs the labeled question set through every variant and writes the comparison report.
+    """
+    parser = argparse.ArgumentParser(description="Measure accuracy against compute for pipeline variants.")
+    parser.add_argument("--config", default=os.getenv("TTC_CONFIG", "config.stub.yaml"),
+                        help="The config to run with; the default stub config runs offline.")
+    parser.add_argument("--dataset", help="The labeled question set (JSON lines with question and answer).")
+    parser.add_argument("--variants", nargs="*", help="Only run these variants.")
+    parser.add_argument("--limit", type=int, help="Only run the first questions of the dataset.")
+    parser.add_argument("--report", help="The report path, without extension; .md and .json are written.")
+    parser.add_argument("--baseline", help="A previous JSON report; exit with an error on regressions against it.")
+    args = parser.parse_args()
+
+    # The config is loaded when the models are imported, so it has to be chosen first
+    os.environ["TTC_CONFIG"] = args.config
+    from models import config, provider_mapping
+    from stub_models import register_reference_answers
+    from test_time_compute import run_question
+
+    settings = config['benchmark']
+    dataset_path = args.dataset or settings['dataset']
+    dataset = load_dataset(dataset_path)[:args.limit]
+    variants = [variant for variant in settings['variants'] if not args.variants or variant['name'] in args.variants]
+    for variant in variants:
+        check_overrides(f"Variant {variant['name']}", variant.get('overrides') or {})
+
+    # Let stub models know the answers, so they can get them right or wrong
+    if 'stub' in provider_mapping['response_agents'].values():
+        register_reference_answers({item["question"]: item["answer"] for item in dataset})
+
+    results, summaries = [], []
+    for variant in variants:
+        print(f"Running {variant['name']} on {len(dataset)} questions...")
+        variant_results = run_variant(run_question, config, variant, dataset)
+        results.extend(variant_results)
+        summaries.append(summarize(variant['name'], variant_results))
+
+    report = markdown_report(summaries, args.config, dataset_path)
+    print("\n" + report)
+
+    report_path = args.report or settings['report']
+    folder = os.path.dirname(report_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(f"{report_path}.md", 'w', encoding='utf-8') as f:
+        f.write(report)
+    with open(f"{report_path}.json", 'w', encoding='utf-8') as f:
+        json.dump({"config": args.config, "dataset": dataset_path, "variants": summaries, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(summaries, baseline, settings['regression'])
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+from models import config
+
+
+def model_pricing(model_name):
+    """
+    Looks up the price of a model, matching the longest entry of `pricing` the model name starts with.
+
+    Args:
+        model_name (str): The name of the model, e.g. "gpt-4o-mini-2024-07-18".
+
+    Returns:
+        dict | None: The prices per million input, cached input and output tokens, or None if unknown.
+    """
+    pricing = config.get('pricing') or {}
+    matches = [name for name in pricing if model_name and model_name.startswith(name)]
+    if not matches:
+        return None
+    return pricing[max(matches, key=len)]
+
+
+def token_cost(prices, input_tokens, cached_input_tokens, output_tokens):
+    """
+    Computes the cost of tokens in dollars.
+
+    Args:
+        prices (dict): The prices per million input, cached input and output tokens.
+        input_tokens (int): The input tokens, including the cached ones.
+        cached_input_tokens (int): The input tokens served from the provider's prompt cache.
+        output_tokens (int): The output tokens.
+
+    Returns:
+        float: The cost of the tokens.
+    """
+    return (
+        (input_tokens - cached_input_tokens) * prices['input']
+        + cached_input_tokens * prices.get('cached_input', prices['input'])
+        + output_tokens * prices['output']
+    ) / 1_000_000
+
+
+def call_cost(message):
+    """
+    Computes the cost of a model call in dollars from its token usage.
+
+    Args:
+        message: The message returned by the model.
+
+    Returns:
+        float: The cost of the call, 0 if the model or its usage is unknown.
+    """
+    usage = getattr(message, "usage_metadata", None)
+    metadata = getattr(message, "response_metadata", None) or {}
+    prices = model_pricing(metadata.get("model_name") or metadata.get("model"))
+    if not usage or not prices:
+        return 0.0
+
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    return token_cost(prices, usage.get("input_tokens", 0), cached, usage.get("output_tokens", 0))
+
+
+def stats_cost(stats, model_name):
+    """
+    Computes what the tokens counted in run stats would have cost on a given model.
+
+    Args:
+        stats (dict): The stats of one or more calls.
+        model_name (str): The model to price the tokens at.
+
+    Returns:
+        float: The cost of the tokens, 0 if the model is unknown.
+    """
+    prices = model_pricing(model_name)
+    if not prices:
+        return 0.0
+    return token_cost(
+        prices, stats.get("input_tokens", 0), stats.get("cached_input_tokens", 0), stats.get("output_tokens", 0)
+    )
+
+
+def spent_tokens(stats):
+    """
+    Counts the tokens spent so far in a run.
+
+    Args:
+        stats (dict): The stats of the run.
+
+    Returns:
+        int: The input and output tokens spent.
+    """
+    return stats.get("input_tokens", 0) + stats.get("output_tokens", 0)
+
+
+def budget_fraction_left(state):
+    """
+    Computes the fraction of the tightest budget of a run that is still left.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        float | None: The fraction left (can be negative once overspent), or None if the run has no budget.
+    """
+    stats = state.get("stats") or {}
+    fractions = []
+    if state.get("token_budget"):
+        fractions.append(1 - spent_tokens(stats) / state["token_budget"])
+    if state.get("cost_budget"):
+        fractions.append(1 - stats.get("cost", 0) / state["cost_budget"])
+    return min(fractions) if fractions else None
+
+
+def budget_exhausted(state):
+    """
+    Determines whether a run has spent its budget, keeping back the share reserved for the final summary.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        bool: True if the run should go straight to the final summary.
+    """
+    left = budget_fraction_left(state)
+    return left is not None and left <= config['budget']['final_summary_reserve']
+
+
+def planned_units(threads, revisions, responses):
+    """
+    Counts the responses a plan still has to generate, each with its comment and score.
+
+    Args:
+        threads (int): The number of threads.
+        revisions (int): The number of revisions of each thread.
+        responses (int): The number of initial responses already generated.
+
+    Returns:
+        int: The number of initial responses and revisions left.
+    """
+    return max(threads - responses, 0) + threads * revisions
+
+
+def plan_compute(state, settings):
+    """
+    Fits the compute settings of a difficulty level to the budget left in a run.
+
+    The cost of one more response (with its comment and score) is estimated from what
+    the initial responses cost so far. While the plan does not fit in the budget left,
+    it is trimmed one step at a time, always making the cut (one thread fewer, or one
+    revision fewer) that removes the fewest responses.
+
+    Args:
+        state (GraphState): The current state, after the initial responses were scored.
+        settings (dict): The threads, beams and revisions of the assessed difficulty.
+
+    Returns:
+        dict: The threads, beams and revisions to use.
+    """
+    threads, beams, revisions = settings['threads'], settings['beams'], settings['revisions']
+    responses = len(state["responses"])
+    left = budget_fraction_left(state)
+    spent = 1 - left if left is not None else 0
+    if left is None or responses == 0 or spent <= 0:
+        return {"threads": threads, "beams": beams, "revisions": revisions}
+
+    # How many more responses fit in the budget, at the rate the initial responses were spent
+    usable = left - config['budget']['final_summary_reserve']
+    affordable = usable / (spent / responses)
+
+    while planned_units(threads, revisions, responses) > affordable and (threads > 1 or revisions > 0):
+        fewer_threads = planned_units(threads - 1, revisions, responses) if threads > 1 else -1
+        fewer_revisions = planned_units(threads, revisions - 1, responses) if revisions > 0 else -1
+        if fewer_threads >= fewer_revisions:
+            threads -= 1
+        else:
+            revisions -= 1
+
+    return {"threads": threads, "beams": min(beams, threads), "revisions": revisions}
+
+
+def spend_report(stats, token_budget=None, cost_budget=None):
+    """
+    Describes what a run spent against its budget.
+
+    Args:
+        stats (dict): The stats of the run.
+        token_budget (int | None): The token budget of the run.
+        cost_budget (float | None): The cost budget of the run, in dollars.
+
+    Returns:
+        str: The spend report.
+    """
+    tokens = f"{spent_tokens(stats)} tokens"
+    if token_budget:
+        tokens += f" of {token_budget} ({spent_tokens(stats) / token_budget:.0%})"
+    cost = f"${stats.get('cost', 0):.4f}"
+    if cost_budget:
+        cost += f" of ${cost_budget:.4f} ({stats.get('cost', 0) / cost_budget:.0%})"
+    return f"Spent {tokens}, {cost}"
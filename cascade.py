@@ -0,0 +1,149 @@
+from budget import stats_cost
+from models import config, llm_mapping, provider_mapping
+from parsing import message_text, normalize_confidence, parse_confidence
+
+
+def cascade_settings(role):
+    """
+    Looks up the cascade settings of a judging role.
+
+    Args:
+        role (str): "commenter" or "scorer".
+
+    Returns:
+        dict | None: The settings, or None if the role does not run in cascade mode.
+    """
+    settings = config['cascade'][role]
+    return settings if settings['enabled'] else None
+
+
+def first_judge(role, llm, provider):
+    """
+    Picks the model that judges a response first: the cheap model in cascade mode, the role's own model otherwise.
+
+    Args:
+        role (str): "commenter" or "scorer".
+        llm: The role's own language model.
+        provider (str): The provider of the role's own language model.
+
+    Returns:
+        Tuple[Any, str]: The language model and its provider.
+    """
+    if cascade_settings(role):
+        return llm_mapping['cascade'][role], provider_mapping['cascade'][role]
+    return llm, provider
+
+
+def reply_confidence(reply):
+    """
+    Reads the confidence a judge gave with its score.
+
+    Args:
+        reply: The structured reply, the raw message, or None when the score is a fallback.
+
+    Returns:
+        float | None: The confidence from 0 to 1 (0 for a fallback score), or None if the judge gave none.
+    """
+    if reply is None:
+        return 0.0
+    if hasattr(reply, "confidence"):
+        return None if reply.confidence is None else normalize_confidence(reply.confidence)
+    return parse_confidence(message_text(reply))
+
+
+def beam_cutoff(state):
+    """
+    Finds the score a response has to beat to be kept by the next beam search.
+
+    Until the difficulty is assessed, the fewest beams of any difficulty level are assumed.
+
+    Args:
+        state (GraphState): The current state, while a response is being scored.
+
+    Returns:
+        float | None: The lowest score currently kept, or None if every response would be kept.
+    """
+    responses = state["responses"]
+    if state["start"] or len(responses) < state["threads"]:
+        # An initial response, not yet in the list of responses
+        others = [response["content"][-1]["score"] for response in responses]
+    else:
+        others = [response["content"][-1]["score"] for i, response in enumerate(responses) if i != state["index"]]
+    beams = state.get("beams") or min(settings['beams'] for settings in config['difficulty_settings'].values())
+
+    if len(others) < beams:
+        return None
+    return sorted(others, reverse=True)[beams - 1]
+
+
+def should_escalate(role, score, confidence, cutoff):
+    """
+    Decides whether a cheap judgement is too uncertain to keep.
+
+    Args:
+        role (str): "commenter" or "scorer".
+        score (float): The score the cheap judge gave.
+        confidence (float | None): The confidence the cheap judge gave, if any.
+        cutoff (float | None): The score the response has to beat to be kept, if any.
+
+    Returns:
+        bool: True if the role runs in cascade mode and the score is within `margin` of the
+            cut-off or the confidence is below `min_confidence`.
+    """
+    settings = cascade_settings(role)
+    if not settings:
+        return False
+    near_cutoff = cutoff is not None and abs(score - cutoff) <= settings['margin']
+    unsure = confidence is not None and confidence < settings['min_confidence']
+    return near_cutoff or unsure
+
+
+def cheap_call_stats(role, stats):
+    """
+    Reports a call made by the cheap judge, and what it saved over the role's own model.
+
+    Args:
+        role (str): "commenter" or "scorer".
+        stats (dict): The stats of the cheap call.
+
+    Returns:
+        dict: The cascade stats of the call.
+    """
+    strong_cost = stats_cost(stats, config['llms'][f'{role}_agent']['model'])
+    return {f"{role}_cascade_calls": 1, "cascade_cost_saved": strong_cost - stats.get("cost", 0)}
+
+
+def escalation_stats(role, stats):
+    """
+    Reports an escalation to the role's own model, whose cost takes back what the cheap call saved.
+
+    Args:
+        role (str): "commenter" or "scorer".
+        stats (dict): The stats of the escalated calls.
+
+    Returns:
+        dict: The cascade stats of the escalation.
+    """
+    return {f"{role}_escalations": 1, "cascade_cost_saved": -stats.get("cost", 0)}
+
+
+def cascade_report(stats):
+    """
+    Describes how often each judging role escalated and what the cascade saved.
+
+    Args:
+        stats (dict): The stats of the run.
+
+    Returns:
+        str | None: The report, or None if no role ran in cascade mode.
+    """
+    lines = []
+    for role in config['cascade']:
+        calls = stats.get(f"{role}_cascade_calls", 0)
+        if calls:
+            escalations = stats.get(f"{role}_escalations", 0)
+            lines.append(f"{role}: {escalations} of {calls} escalated ({escalations / calls:.0%})")
+    if not lines:
+        return None
+    lines.append(f"estimated cost saved: ${stats.get('cascade_cost_saved', 0):.4f}")
+    return "Cascade: " + ", ".join(lines)
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from typing import ClassVar
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+MODES = ("live", "record", "replay")
+
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode when a request was never recorded."""
+
+
+class RecordedToolError(Exception):
+    """A tool error replayed from a cassette, shown exactly as the original error was."""
+
+    def __init__(self, description):
+        super().__init__(description)
+        self.description = description
+
+    def __repr__(self):
+        return self.description
+
+
+def request_key(*parts):
+    """
+    Hashes a request so that the same request always gets the same key.
+
+    Args:
+        *parts: The JSON-serializable parts of the request.
+
+    Returns:
+        str: The key.
+    """
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def message_fingerprint(message):
+    """
+    Describes what a message says, leaving out the ids and metadata that change from run to run.
+
+    Args:
+        message: The message.
+
+    Returns:
+        dict: The type, content, name and tool calls of the message.
+    """
+    return {
+        "type": message.type,
+        "content": message.content,
+        "name": getattr(message, "name", None),
+        "tool_calls": [{"name": call["name"], "args": call["args"]} for call in getattr(message, "tool_calls", [])],
+    }
+
+
+def dump_result(result):
+    """
+    Turns a chat result into JSON.
+
+    Args:
+        result (ChatResult): The result of a model call.
+
+    Returns:
+        dict: The generations and provider output of the result.
+    """
+    return {
+        "generations": [
+            {"message": message_to_dict(generation.message), "info": generation.generation_info}
+            for generation in result.generations
+        ],
+        "llm_output": result.llm_output,
+    }
+
+
+def load_result(data):
+    """
+    Turns JSON written by `dump_result` back into a chat result.
+
+    Args:
+        data (dict): The dumped result.
+
+    Returns:
+        ChatResult: The result.
+    """
+    messages = messages_from_dict([generation["message"] for generation in data["generations"]])
+    generations = [
+        ChatGeneration(message=message, generation_info=generation["info"])
+        for message, generation in zip(messages, data["generations"])
+    ]
+    return ChatResult(generations=generations, llm_output=data["llm_output"])
+
+
+class Cassette:
+    """
+    Records every model and tool call of the process to a JSON lines file, or serves them back from it.
+
+    In live mode calls go straight through. In record mode every call is appended to the file
+    with its request, response and latency. In replay mode calls are answered from the file
+    without touching the network; a request recorded several times gets its responses in the
+    order they were recorded, and the last one again once they run out.
+    """
+
+    def __init__(self, settings):
+        """
+        Args:
+            settings (dict): The cassette section of the config.
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if settings['mode'] not in MODES:
+            raise ValueError(f"Unknown cassette mode {settings['mode']}, try one of {', '.join(MODES)}")
+        self.mode = settings['mode']
+        self.path = settings['path']
+        self.replay_latency = settings['replay_latency']
+        self.latency_scale = settings['latency_scale']
+        self.lock = threading.Lock()
+        self.classes = {}
+        self.entries = defaultdict(deque)
+        if self.mode == "replay":
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]].append(entry)
+
+    def model_class(self, chat_model_class):
+        """
+        Makes a chat model class whose calls go through the cassette.
+
+        Args:
+            chat_model_class: The chat model class of a provider.
+
+        Returns:
+            The class itself in live mode, a subclass that records or replays its calls otherwise.
+        """
+        if self.mode == "live":
+            return chat_model_class
+        if chat_model_class not in self.classes:
+            self.classes[chat_model_class] = type(
+                f"Cassette{chat_model_class.__name__}",
+                (CassetteChatModel, chat_model_class),
+                {"__annotations__": {"cassette": ClassVar[Cassette]}, "cassette": self},
+            )
+        return self.classes[chat_model_class]
+
+    def write(self, entry):
+        """
+        Appends an entry to the cassette file.
+
+        Args:
+            entry (dict): The recorded call.
+        """
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+
+    def replay(self, key, description):
+        """
+        Takes the next recorded entry of a request, waiting for its original latency if configured.
+
+        Args:
+            key (str): The key of the request.
+            description (str): What the request was, for the error message.
+
+        Returns:
+            dict: The recorded entry.
+
+        Raises:
+            CassetteMiss: If the request was never recorded.
+        """
+        with self.lock:
+            recorded = self.entries.get(key)
+            if not recorded:
+                raise CassetteMiss(f"No recorded response for {description} in {self.path}")
+            entry = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        if self.replay_latency:
+            time.sleep(entry["seconds"] * self.latency_scale)
+        return entry
+
+    def model_call(self, model, key, request, call):
+        """
+        Records or replays a model call.
+
+        Args:
+            model (str): The model, for the cassette file and error messages.
+            key (str): The key of the request.
+            request (dict): The request, saved for inspection.
+            call (Callable[[], ChatResult]): Makes the call for real.
+
+        Returns:
+            ChatResult: The result of the call.
+        """
+        if self.mode == "replay":
+            return load_result(self.replay(key, f"a {model} call")["result"])
+
+        start = time.time()
+        result = call()
+        self.write({
+            "kind": "llm",
+            "key": key,
+            "model": model,
+            "seconds": time.time() - start,
+            "request": request,
+            "result": dump_result(result),
+        })
+        return result
+
+    def tool_call(self, name, args, call):
+        """
+        Records or replays a tool call, including the error it raised.
+
+        Args:
+            name (str): The name of the tool.
+            args: The arguments of the call.
+            call (Callable[[], Any]): Runs the tool for real.
+
+        Returns:
+            The output of the tool.
+
+        Raises:
+            RecordedToolError: In replay mode, if the recorded call raised an error.
+        """
+        if self.mode == "live":
+            return call()
+
+        key = request_key("tool", name, args)
+        if self.mode == "replay":
+            entry = self.replay(key, f"a {name} call")
+            if "error" in entry:
+                raise RecordedToolError(entry["error"])
+            return entry["output"]
+
+        start = time.time()
+        entry = {"kind": "tool", "key": key, "tool": name, "args": args}
+        try:
+            output = call()
+        except Exception as e:
+            self.write({**entry, "seconds": time.time() - start, "error": repr(e)})
+            raise
+        # Non-text outputs are stored as they will be shown to the agent
+        recorded = output if isinstance(output, str) else json.loads(json.dumps(output, default=str))
+        self.write({**entry, "seconds": time.time() - start, "output": recorded})
+        return output
+
+
+class CassetteChatModel:
+    """
+    Mixin that sends the calls of a chat model through its class's cassette.
+
+    The provider still formats tools and structured outputs as usual, so a recorded run
+    and its replay send exactly the same requests.
+    """
+
+    cassette: ClassVar[Cassette]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        params = {name: value for name, value in kwargs.items() if not name.startswith("ls_")}
+        key = request_key(
+            "llm", self._llm_type, self._identifying_params, stop, params,
+            [message_fingerprint(message) for message in messages],
+        )
+        request = {"messages": [message_to_dict(message) for message in messages], "stop": stop, "params": params}
+        model = str(self._identifying_params.get("model_name") or self._identifying_params.get("model") or self._llm_type)
+        return self.cassette.model_call(
+            model, key, request, lambda: super(CassetteChatModel, self)._generate(messages, stop, run_manager, **kwargs)
+        )
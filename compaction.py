@@ -0,0 +1,210 @@
+import json
+
+from langchain_core.messages import ToolMessage
+
+from models import config
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in a text, at about four characters per token.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return len(text) // 4
+
+
+def truncate_text(text, max_chars):
+    """
+    Shortens a text to about `max_chars` characters, keeping its beginning and its end.
+
+    Args:
+        text (str): The text.
+        max_chars (int): The longest text to keep.
+
+    Returns:
+        str: The text, with its middle elided if it was too long.
+    """
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return f"{text[:head]}\n... [{len(text) - head - tail} characters elided] ...\n{text[len(text) - tail:]}"
+
+
+def collapse_repeats(text):
+    """
+    Collapses runs of identical lines, as printed by loops in the Python REPL.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        str: The text with every run of identical lines written once.
+    """
+    lines = []
+    for line in text.split("\n"):
+        if lines and lines[-1][0] == line:
+            lines[-1][1] += 1
+        else:
+            lines.append([line, 1])
+    return "\n".join(line if count == 1 else f"{line} (repeated {count} times)" for line, count in lines)
+
+
+def search_results(content):
+    """
+    Reads the results of a search tool from the content of a tool message.
+
+    Args:
+        content (str): The content of the tool message.
+
+    Returns:
+        list | None: The results, each a dict, or None if the content is not a list of results.
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(data, list) and data and all(isinstance(result, dict) for result in data):
+        return data
+    return None
+
+
+def compact_output(content, seen_urls, settings):
+    """
+    Compacts the output of a tool call to its token budget.
+
+    Search results keep only the configured fields and lose the results already shown
+    earlier in the thread (by URL) or in the same output (by content), and the budget is
+    shared between the remaining ones. Other outputs have repeated lines collapsed and
+    their middle elided once over budget.
+
+    Args:
+        content (str): The output of the tool call.
+        seen_urls (set): The URLs of the search results the agent can still see, updated in place.
+        settings (dict): The tool_compaction section of the config.
+
+    Returns:
+        str: The compacted output.
+    """
+    max_chars = settings['max_output_tokens'] * 4
+    results = search_results(content)
+    if results is None:
+        return truncate_text(collapse_repeats(content), max_chars)
+
+    kept = []
+    seen_contents = set()
+    for result in results:
+        text = " ".join(str(result.get("content", "")).split())
+        if result.get("url") in seen_urls or text in seen_contents:
+            continue
+        seen_contents.add(text)
+        kept.append({field: result[field] for field in settings['keep_fields'] if field in result})
+
+    share = max_chars // max(len(kept), 1)
+    for result in kept:
+        if "content" in result:
+            result["content"] = truncate_text(str(result["content"]), share)
+        if result.get("url"):
+            seen_urls.add(result["url"])
+
+    compacted = json.dumps(kept, ensure_ascii=False)
+    if len(kept) < len(results):
+        compacted += f"\n({len(results) - len(kept)} results already shown were left out)"
+    return compacted
+
+
+def elide_output(message, settings):
+    """
+    Replaces a stale tool output with its first few tokens.
+
+    Args:
+        message (ToolMessage): The tool message.
+        settings (dict): The tool_compaction section of the config.
+
+    Returns:
+        str: The elided output.
+    """
+    preview = message.content[:settings['elided_preview_tokens'] * 4]
+    return f"{preview}... [the rest of this {message.name} output was elided to save context]"
+
+
+def tool_rounds(messages):
+    """
+    Groups the tool messages of an agent's conversation by the round trip they answered.
+
+    Args:
+        messages (list): The messages of the conversation.
+
+    Returns:
+        list: The tool messages of every round trip, oldest first.
+    """
+    rounds = []
+    previous = None
+    for message in messages:
+        if isinstance(message, ToolMessage):
+            if not isinstance(previous, ToolMessage):
+                rounds.append([])
+            rounds[-1].append(message)
+        previous = message
+    return rounds
+
+
+def compaction_node(state):
+    """
+    Compacts the tool outputs of the agent's last round trip and elides the stale ones before they go back to the agent.
+
+    The compacted messages keep their ids, so they replace the raw ones in the agent state.
+    The tokens taken out of the thread's context, which every later call of the thread
+    no longer sends, are reported in the stats.
+
+    Args:
+        state (dict): The current state of the agent.
+
+    Returns:
+        dict: The compacted tool messages and the tokens they saved.
+    """
+    settings = config['tool_compaction']
+    rounds = tool_rounds(state["messages"])
+    if not settings['enabled'] or not rounds:
+        return {}
+
+    keep_rounds = settings['keep_rounds']
+    stale = rounds[:-keep_rounds] if keep_rounds else []
+    kept = rounds[-keep_rounds:] if keep_rounds else rounds
+    updates = []
+    stats = {}
+
+    # Outputs of older round trips only keep a preview
+    for message in (message for round_messages in stale for message in round_messages):
+        if not message.additional_kwargs.get("elided"):
+            content = elide_output(message, settings)
+            stats["tool_tokens_elided"] = stats.get("tool_tokens_elided", 0) + estimate_tokens(message.content) - estimate_tokens(content)
+            updates.append(message.model_copy(update={
+                "content": content, "additional_kwargs": {**message.additional_kwargs, "elided": True}
+            }))
+
+    seen_urls = set()
+    for message in (message for round_messages in kept[:-1] for message in round_messages):
+        seen_urls.update(result.get("url") for result in search_results(message.content) or [])
+
+    # Outputs of the last round trip are compacted to the token budget
+    for message in rounds[-1]:
+        if message.additional_kwargs.get("compacted") or message.additional_kwargs.get("elided"):
+            continue
+        content = compact_output(message.content, seen_urls, settings)
+        if content == message.content:
+            continue
+        stats["tool_tokens_compacted"] = stats.get("tool_tokens_compacted", 0) + estimate_tokens(message.content) - estimate_tokens(content)
+        updates.append(message.model_copy(update={
+            "content": content, "additional_kwargs": {**message.additional_kwargs, "compacted": True}
+        }))
+
+    if not updates:
+        return {}
+    stats["tool_tokens_saved"] = stats.get("tool_tokens_elided", 0) + stats.get("tool_tokens_compacted", 0)
+    return {"messages": updates, "stats": stats}
@@ -0,0 +1,119 @@
+import contextvars
+import threading
+import time
+
+from models import config
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a model or tool call does not finish before the deadline of its run."""
+
+
+def seconds_left(deadline):
+    """
+    Computes the time left before a deadline.
+
+    Args:
+        deadline (float | None): The deadline as a Unix timestamp, or None for no deadline.
+
+    Returns:
+        float | None: The seconds left (negative once passed), or None if there is no deadline.
+    """
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def work_deadline(state):
+    """
+    Computes the deadline for the work before the final summary, keeping back the time reserved for it.
+
+    Args:
+        state (dict): The current state.
+
+    Returns:
+        float | None: The deadline for responses, revisions and judging calls, or None if there is no deadline.
+    """
+    deadline = state.get("deadline")
+    if deadline is None:
+        return None
+    return deadline - config['deadline']['final_summary_reserve']
+
+
+def out_of_time(state):
+    """
+    Determines whether a run has too little time left to start another step before its final summary.
+
+    Args:
+        state (dict): The current state.
+
+    Returns:
+        bool: True if a call already hit the deadline, or if less than `min_step_seconds` are left.
+    """
+    if state.get("timed_out"):
+        return True
+    left = seconds_left(work_deadline(state))
+    return left is not None and left < config['deadline']['min_step_seconds']
+
+
+def call_before_deadline(fn, deadline):
+    """
+    Runs a call, giving up on it when the deadline passes.
+
+    The call runs in a daemon thread so the run can move on at the deadline. Python
+    threads cannot be interrupted, so an abandoned call finishes in the background
+    and its result is discarded.
+
+    Args:
+        fn (callable): The call to run, without arguments.
+        deadline (float | None): The deadline as a Unix timestamp, or None for no deadline.
+
+    Returns:
+        The result of the call.
+
+    Raises:
+        DeadlineExceeded: If the deadline passes before the call returns.
+    """
+    left = seconds_left(deadline)
+    if left is None:
+        return fn()
+    if left <= 0:
+        raise DeadlineExceeded("The deadline passed before the call started")
+
+    outcome = {}
+    finished = threading.Event()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            outcome["result"] = context.run(fn)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            finished.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    if not finished.wait(left):
+        raise DeadlineExceeded(f"The call did not finish within {left:.1f} seconds")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def stop_at_deadline(node):
+    """
+    Wraps a graph node so that hitting the deadline marks the run as timed out instead of failing it.
+
+    Args:
+        node (callable): The graph node.
+
+    Returns:
+        callable: The wrapped node.
+    """
+    def wrapped(state):
+        try:
+            return node(state)
+        except DeadlineExceeded:
+            return {"timed_out": True, "stats": {"deadline_timeouts": 1}}
+
+    return wrapped
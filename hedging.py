@@ -0,0 +1,268 @@
+import contextvars
+import math
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+
+from models import config, llm_mapping, provider_mapping
+from scheduler import speculative
+from stats import merge_stats, usage_stats
+
+
+class LatencyTracker:
+    """Keeps the latest latencies of every model, to tell when a call is slower than usual."""
+
+    def __init__(self, window):
+        """
+        Args:
+            window (int): How many of the latest latencies are kept per model.
+        """
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, label, seconds):
+        """
+        Records the latency of a call.
+
+        Args:
+            label (str): The role and model that made the call.
+            seconds (float): How long the call took.
+        """
+        with self.lock:
+            self.samples[label].append(seconds)
+
+    def percentile(self, label, percentile, min_samples):
+        """
+        Computes a percentile of the recorded latencies.
+
+        Args:
+            label (str): The role and model.
+            percentile (float): The percentile, from 0 to 100.
+            min_samples (int): The fewest latencies the percentile is computed from.
+
+        Returns:
+            float | None: The latency, or None if fewer than `min_samples` calls were recorded.
+        """
+        with self.lock:
+            samples = sorted(self.samples[label])
+        if len(samples) < min_samples:
+            return None
+        return samples[max(math.ceil(percentile / 100 * len(samples)) - 1, 0)]
+
+
+settings = config['hedging']
+latencies = LatencyTracker(settings['window'])
+
+
+def llm_label(role, llm):
+    """
+    Names the latencies of a role's calls to a model.
+
+    Args:
+        role (str): The role making the call.
+        llm: The language model.
+
+    Returns:
+        str: The label.
+    """
+    return f"{role}:{getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or type(llm).__name__}"
+
+
+def backup_name(key):
+    """
+    Looks up the backup of an entry of llm_mapping.
+
+    Args:
+        key (str): The name of a response agent, or a role of the llms section (e.g. "scorer_agent").
+
+    Returns:
+        str | None: The name of the backup, or None if hedging is off or the entry has no backup.
+    """
+    return settings['backups'].get(key) if settings['enabled'] else None
+
+
+def backup_request(key, build_prompt):
+    """
+    Prepares the request a judging role sends to its backup model when a call is hedged.
+
+    Args:
+        key (str): The role of the llms section (e.g. "scorer_agent").
+        build_prompt (callable): Builds the messages of the request for a provider.
+
+    Returns:
+        Tuple[Any, list] | None: The backup language model and the messages to send it, or None if the
+            role has no backup.
+    """
+    backup = backup_name(key)
+    if backup is None:
+        return None
+    if backup in llm_mapping['response_agents']:
+        llm, provider = llm_mapping['response_agents'][backup], provider_mapping['response_agents'][backup]
+    else:
+        llm, provider = llm_mapping[backup], provider_mapping[backup]
+    return llm, build_prompt(provider)
+
+
+def reply_message(result):
+    """
+    Finds the message of a reply, structured or not.
+
+    Args:
+        result: The message, or the dict returned by a structured model with include_raw.
+
+    Returns:
+        The message returned by the model.
+    """
+    return result["raw"] if isinstance(result, dict) else result
+
+
+class AbandonedUsage:
+    """Collects the usage of the abandoned calls of a run, which only finish after the call that won."""
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def add(self, stats):
+        """
+        Adds the stats of an abandoned call once it finishes.
+
+        Args:
+            stats (dict): The stats of the call.
+        """
+        with self.lock:
+            self.stats = merge_stats(self.stats, stats)
+
+    def drain(self):
+        """
+        Takes the stats collected so far, to report them with the run's stats.
+
+        Returns:
+            dict: The stats of the abandoned calls that finished since the last drain.
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+
+# The abandoned calls of the current run, set by run_question; runs without one share the default
+abandoned_usage = contextvars.ContextVar("abandoned_usage", default=None)
+default_abandoned_usage = AbandonedUsage()
+
+
+def run_abandoned_usage():
+    """
+    Finds where the abandoned calls of the current run are collected.
+
+    Returns:
+        AbandonedUsage: The collector of the run.
+    """
+    return abandoned_usage.get() or default_abandoned_usage
+
+
+def hedged_call(role, llm, call, backup_call=None):
+    """
+    Makes a call, sending the same request to a backup model if it is slower than usual.
+
+    Once the call has taken longer than the configured percentile of the model's latencies, the
+    backup call starts and the first reply wins. Python threads cannot be interrupted, so the
+    losing call is abandoned: it finishes in the background and its reply is discarded, but its
+    actual usage and cost are collected for the run and reported by the next call (or at the end
+    of the run), as hedge_wasted_tokens and hedge_wasted_cost on top of the usual usage stats.
+
+    Args:
+        role (str): The role making the call, used for the latencies and stats.
+        llm: The language model of the call.
+        call (callable): Makes the call, without arguments.
+        backup_call (callable | None): Makes the same request to the backup model, None for no backup.
+
+    Returns:
+        Tuple[Any, dict]: The winning reply and the hedging stats of the call, including the usage of
+            earlier abandoned calls of the run that finished since.
+
+    Raises:
+        Exception: The error of the call, or of both calls if the first one to finish failed.
+    """
+    label = llm_label(role, llm)
+    usage = run_abandoned_usage()
+    delay = latencies.percentile(label, settings['percentile'], settings['min_samples'])
+    if backup_call is None or delay is None:
+        start = time.time()
+        result = call()
+        latencies.record(label, time.time() - start)
+        return result, usage.drain()
+
+    outcomes = queue.Queue()
+    won = []
+    lock = threading.Lock()
+
+    def start(which, fn):
+        context = contextvars.copy_context()
+
+        def run():
+            began = time.time()
+            try:
+                result, error = context.run(fn), None
+            except Exception as e:
+                result, error = None, e
+            finally:
+                # Slow calls that lost are recorded too, so the percentile sees the tail
+                if which == "primary":
+                    latencies.record(label, time.time() - began)
+
+            with lock:
+                wins = error is None and not won
+                if wins:
+                    won.append(which)
+            if error is None and not wins:
+                # The other call already won, so this reply is only counted
+                message = reply_message(result)
+                call_usage = usage_stats(message, role)
+                call_usage["hedge_wasted_tokens"] = call_usage.get("input_tokens", 0) + call_usage.get("output_tokens", 0)
+                call_usage["hedge_wasted_cost"] = call_usage.get("cost", 0.0)
+                usage.add(call_usage)
+            else:
+                outcomes.put((which, result, error))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    start("primary", call)
+    stats = {"hedgeable_calls": 1}
+    try:
+        which, result, error = outcomes.get(timeout=max(delay, settings['min_delay']))
+    except queue.Empty:
+        # The backup only speeds up a call already under way, so it waits behind all other work
+        start("backup", speculative(backup_call))
+        stats.update({"hedged_calls": 1, f"{role}_hedges": 1})
+        which, result, error = outcomes.get()
+        if error is not None:
+            # The other call may still succeed
+            which, result, error = outcomes.get()
+        if error is None and which == "backup":
+            stats["hedge_wins"] = 1
+
+    if error is not None:
+        raise error
+    return result, merge_stats(stats, usage.drain())
+
+
+def hedging_report(stats):
+    """
+    Describes how often calls were hedged and what it wasted.
+
+    Args:
+        stats (dict): The stats of the run.
+
+    Returns:
+        str | None: The report, or None if no call could be hedged.
+    """
+    calls = stats.get("hedgeable_calls", 0)
+    if not calls:
+        return None
+    hedged = stats.get("hedged_calls", 0)
+    return (
+        f"Hedging: {hedged} of {calls} calls hedged ({hedged / calls:.0%}), "
+        f"the backup won {stats.get('hedge_wins', 0)}, "
+        f"{stats.get('hedge_wasted_tokens', 0)} tokens (${stats.get('hedge_wasted_cost', 0):.4f}) spent on abandoned calls"
+    )
@@ -0,0 +1,215 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    question TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    log_path TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, submitted);
+"""
+STATUSES = ("queued", "running", "done", "failed")
+
+
+class JobQueue:
+    """
+    A durable queue of questions in a local SQLite file, shared by every worker process.
+
+    Workers claim a question with a lease and keep it alive with heartbeats. A question whose
+    lease expires, because its worker crashed or hung, goes back to the queue, until it has
+    been tried `max_attempts` times. Results are stored with the question.
+    """
+
+    def __init__(self, path, lease_seconds, max_attempts):
+        """
+        Args:
+            path (str): The SQLite file, created if needed.
+            lease_seconds (float): How long a claimed question stays with its worker without a heartbeat.
+            max_attempts (int): How many times a question is tried before it fails.
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-ahead logging lets workers read while another one writes
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextmanager
+    def connect(self):
+        """
+        Opens a connection for one transaction, so processes and threads never share one.
+
+        Yields:
+            sqlite3.Connection: The connection, committed on success and rolled back on error.
+        """
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def submit(self, question, options=None):
+        """
+        Adds a question to the queue.
+
+        Args:
+            question (str): The question to answer.
+            options (dict | None): The token_budget, cost_budget and/or deadline_seconds of the run.
+
+        Returns:
+            str: The id of the job.
+        """
+        job_id = uuid.uuid4().hex
+        with self.connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, question, options, status, submitted) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, question, json.dumps(options or {}), time.time()),
+            )
+        return job_id
+
+    def claim(self, worker):
+        """
+        Leases the oldest queued question to a worker, first putting back the questions whose lease expired.
+
+        Args:
+            worker (str): The id of the worker.
+
+        Returns:
+            dict | None: The claimed job, or None if the queue is empty.
+        """
+        now = time.time()
+        with self.connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, worker = NULL, "
+                "error = 'The worker stopped responding on every attempt' "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND lease_expires < ?",
+                (now,),
+            )
+            row = db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY submitted LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?, "
+                "started = ? WHERE id = ?",
+                (worker, now + self.lease_seconds, now, row["id"]),
+            )
+        return {**dict(row), "attempts": row["attempts"] + 1, "options": json.loads(row["options"])}
+
+    def heartbeat(self, job_id, worker):
+        """
+        Extends the lease of a running question.
+
+        Args:
+            job_id (str): The id of the job.
+            worker (str): The id of the worker running it.
+
+        Returns:
+            bool: False if the worker no longer holds the lease.
+        """
+        with self.connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result, log_path):
+        """
+        Stores the result of a question.
+
+        Args:
+            job_id (str): The id of the job.
+            worker (str): The id of the worker that ran it.
+            result (dict): The result of the run.
+            log_path (str): The reasoning log of the run.
+
+        Returns:
+            bool: False if the worker no longer held the lease, in which case the result is dropped.
+        """
+        with self.connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = 'done', finished = ?, result = ?, log_path = ?, error = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), json.dumps(result, default=str), log_path, job_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        """
+        Reports a question whose run raised an error, putting it back in the queue if it has attempts left.
+
+        Args:
+            job_id (str): The id of the job.
+            worker (str): The id of the worker that ran it.
+            error (str): The error.
+        """
+        with self.connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "finished = CASE WHEN attempts >= ? THEN ? END, worker = NULL, error = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (self.max_attempts, self.max_attempts, time.time(), error, job_id, worker),
+            )
+
+    def get(self, job_id):
+        """
+        Looks up a job.
+
+        Args:
+            job_id (str): The id of the job.
+
+        Returns:
+            dict | None: The job, with its result once done, or None if there is no such job.
+        """
+        with self.connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def counts(self):
+        """
+        Counts the jobs by status.
+
+        Returns:
+            dict: The number of queued, running, done and failed jobs.
+        """
+        with self.connect() as db:
+            rows = db.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in STATUSES}
+        counts.update({row["status"]: row["count"] for row in rows})
+        return counts
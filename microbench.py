@@ -0,0 +1,380 @@
+import argparse
+import copy
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from benchmark import apply_overrides, check_overrides, load_dataset, restore_config
+
+FILLER = "Let me check this step by step, carrying every intermediate result over to the next line. "
+
+
+def synthetic_state(threads, revisions, text_chars):
+    """
+    Builds a graph state as it looks deep into a large run.
+
+    Args:
+        threads (int): The number of responses.
+        revisions (int): The number of revisions of every response.
+        text_chars (int): The length of every response text.
+
+    Returns:
+        dict: The state, with every response scored and commented on.
+    """
+    text = (FILLER * (text_chars // len(FILLER) + 1))[:text_chars]
+    comments = text[:text_chars // 4]
+    responses = [
+        {
+            "agent_name": f"Stub{'ABC'[thread % 3]}",
+            "content": [
+                {"text": f"{thread}.{revision} {text}", "comments": comments, "score": (thread * 7 + revision) % 10}
+                for revision in range(revisions + 1)
+            ],
+        }
+        for thread in range(threads)
+    ]
+    return {
+        "question": "What is the sum of the first hundred primes?",
+        "responses": responses,
+        "discarded_responses": [],
+        "threads": threads,
+        "beams": max(threads // 10, 1),
+        "revisions": revisions + 1,
+        "index": threads // 2,
+        "start": False,
+        "done": False,
+        "timed_out": False,
+        "initial_response_agent": "StubA",
+        "agent_response": {"text": text, "comments": comments, "score": 7},
+        "sample_pool": {},
+        "stats": {"llm_calls": threads * revisions * 3, "input_tokens": threads * revisions * 1000},
+    }
+
+
+def measure(setup, fn, repeats, number=1):
+    """
+    Times a function, then measures the memory it allocates.
+
+    Every repeat calls `setup` outside the timing, so functions that change their input get a fresh one.
+
+    Args:
+        setup (callable): Builds the arguments of the function, without arguments.
+        fn (callable): The function to measure, called with the arguments.
+        repeats (int): How often the timing is repeated.
+        number (int): How often the function is called per repeat, for functions too fast to time once.
+
+    Returns:
+        dict: The fastest and median seconds per call, and the peak memory of one call in MB.
+    """
+    timings = []
+    for _ in range(repeats):
+        args = setup()
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        timings.append((time.perf_counter() - started) / number)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "peak_mb": peak / 1e6,
+    }
+
+
+def micro_benchmarks(settings):
+    """
+    Times the nodes, routers, event logging and graph compilation on a large synthetic state.
+
+    Args:
+        settings (dict): The microbench section of the config.
+
+    Returns:
+        dict: The measurements of every benchmark, by name.
+    """
+    import test_time_compute as ttc
+    from stats import collect_stats
+    from upper_agents import beam_search_agent, initial_response_handler, revised_response_handler
+
+    size = (settings['threads'], settings['revisions'], settings['text_chars'])
+    repeats = settings['repeats']
+
+    def state():
+        return (synthetic_state(*size),)
+
+    def routers(state):
+        for router in (ttc.initial_response_router, ttc.difficulty_router, ttc.revision_router,
+                       ttc.deadline_router, ttc.judging_router, ttc.scorer_router, ttc.done_router):
+            router(state)
+
+    def events(state):
+        # The updates streamed by the nodes that write the most to the log
+        return ([
+            {"initial_response_handler": {"responses": state["responses"], "stats": state["stats"]}},
+            {"revised_response_handler": {"responses": state["responses"], "index": state["index"]}},
+            {"beam_search_agent": {"discarded_responses": state["responses"], "index": 0}},
+        ],)
+
+    def log_events(event_dicts):
+        log_file = io.StringIO()
+        run_stats = {}
+        for event_dict in event_dicts:
+            ttc.handle_event_logging(event_dict, log_file)
+            ttc.describe_event(event_dict)
+            run_stats = collect_stats(event_dict, run_stats)
+
+    benchmarks = {
+        "beam_search_agent": (state, beam_search_agent, 1),
+        "initial_response_handler": (state, initial_response_handler, 1),
+        "revised_response_handler": (state, revised_response_handler, 1),
+        "routers": (state, routers, settings['router_calls']),
+        "event_logging": (lambda: events(synthetic_state(*size)), log_events, 1),
+        "compile_graph": (tuple, ttc.graph.compile, 1),
+        "compile_subgraphs": (tuple, lambda: (ttc.initial_response_workflow.compile(), ttc.revision_workflow.compile()), 1),
+    }
+
+    results = {}
+    for name, (setup, fn, number) in benchmarks.items():
+        results[name] = measure(setup, fn, repeats, number)
+        print(f"{name}: {results[name]['seconds'] * 1000:.3f} ms, peak {results[name]['peak_mb']:.1f} MB")
+    return results
+
+
+def stream_question(app, question, recursion_limit):
+    """
+    Streams a question through the graph, timing every node.
+
+    Every node is charged the time between the previous streamed event and its own, which
+    includes the subgraphs and stand-in model calls it ran and the graph's own bookkeeping.
+
+    Args:
+        app: The compiled graph.
+        question (str): The question.
+        recursion_limit (int): The most graph steps allowed.
+
+    Returns:
+        Tuple[int, dict]: The number of graph steps, and the seconds and steps of every node.
+    """
+    nodes = {}
+    steps = 0
+    last = time.perf_counter()
+    for event in app.stream({"question": question}, {"recursion_limit": recursion_limit}):
+        now = time.perf_counter()
+        for node in event:
+            entry = nodes.setdefault(node, {"seconds": 0.0, "steps": 0})
+            entry["seconds"] += (now - last) / len(event)
+            entry["steps"] += 1
+        steps += 1
+        last = now
+    return steps, nodes
+
+
+def run_scenario(app, config, scenario, dataset, recursion_limit):
+    """
+    Runs questions through the graph with a scenario's overrides, measuring its overhead.
+
+    The peak memory is measured on a second run of the first question, since tracing slows the run down.
+
+    Args:
+        app: The compiled graph.
+        config (dict): The shared config.
+        scenario (dict): The name of the scenario, its number of questions and its config overrides.
+        dataset (list[dict]): The questions.
+        recursion_limit (int): The most graph steps allowed per question.
+
+    Returns:
+        dict: The seconds, steps and peak memory per question, and the overhead of every node.
+    """
+    from models import llm_mapping
+    from stub_models import configure_stub_models
+
+    questions = [item["question"] for item in dataset[:scenario.get('questions', 1)]]
+    snapshot = copy.deepcopy(config)
+    apply_overrides(config, scenario.get('overrides') or {})
+    configure_stub_models(llm_mapping, config.get('stub', {}))
+    try:
+        started = time.perf_counter()
+        steps, nodes = 0, {}
+        for question in questions:
+            question_steps, question_nodes = stream_question(app, question, recursion_limit)
+            steps += question_steps
+            for node, entry in question_nodes.items():
+                total = nodes.setdefault(node, {"seconds": 0.0, "steps": 0})
+                total["seconds"] += entry["seconds"]
+                total["steps"] += entry["steps"]
+        seconds = time.perf_counter() - started
+
+        tracemalloc.start()
+        try:
+            stream_question(app, questions[0], recursion_limit)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        restore_config(config, snapshot)
+        configure_stub_models(llm_mapping, config.get('stub', {}))
+
+    return {
+        "questions": len(questions),
+        "seconds_per_question": seconds / len(questions),
+        "steps_per_question": steps / len(questions),
+        "seconds_per_step": seconds / steps,
+        "peak_mb": peak / 1e6,
+        "nodes": {
+            node: {**entry, "ms_per_step": entry["seconds"] / entry["steps"] * 1000}
+            for node, entry in sorted(nodes.items(), key=lambda item: -item[1]["seconds"])
+        },
+    }
+
+
+def markdown_report(report):
+    """
+    Formats the measurements as markdown tables.
+
+    Args:
+        report (dict): The micro-benchmarks and full runs.
+
+    Returns:
+        str: The report.
+    """
+    size = report["size"]
+    lines = [
+        "# Micro-benchmark report",
+        "",
+        f"Config: `{report['config']}`, synthetic state: {size['threads']} threads, "
+        f"{size['revisions']} revisions, {size['text_chars']} characters per text",
+        "",
+        "| Benchmark | Fastest (ms) | Median (ms) | Peak memory (MB) |",
+        "|---|---|---|---|",
+    ]
+    for name, m in report["micro"].items():
+        lines.append(f"| {name} | {m['seconds'] * 1000:.3f} | {m['median_seconds'] * 1000:.3f} | {m['peak_mb']:.1f} |")
+
+    for name, run in report["runs"].items():
+        lines += [
+            "",
+            f"## Run: {name}",
+            "",
+            f"{run['questions']} question(s), {run['steps_per_question']:.0f} graph steps and "
+            f"{run['seconds_per_question']:.2f} s per question, {run['seconds_per_step'] * 1000:.2f} ms per step, "
+            f"peak memory {run['peak_mb']:.1f} MB",
+            "",
+            "| Node | Steps | Total (s) | Per step (ms) |",
+            "|---|---|---|---|",
+        ]
+        for node, entry in run["nodes"].items():
+            lines.append(f"| {node} | {entry['steps']} | {entry['seconds']:.3f} | {entry['ms_per_step']:.3f} |")
+    return "\n".join(lines) + "\n"
+
+
+def find_regressions(report, baseline, threshold, min_seconds):
+    """
+    Compares the measurements against a previous report.
+
+    Args:
+        report (dict): The micro-benchmarks and full runs.
+        baseline (dict): A previous JSON report.
+        threshold (float): The largest relative increase allowed in time, memory and graph steps.
+        min_seconds (float): Timings below this are too noisy to compare.
+
+    Returns:
+        list[str]: A description of every regression.
+    """
+    regressions = []
+
+    def compare(name, metric, before, after):
+        if before and after > before * (1 + threshold):
+            regressions.append(f"{name}: {metric} rose from {before:.4g} to {after:.4g} (+{after / before - 1:.0%})")
+
+    for name, m in report["micro"].items():
+        before = baseline.get("micro", {}).get(name)
+        if not before:
+            continue
+        if max(m["seconds"], before["seconds"]) >= min_seconds:
+            compare(name, "seconds", before["seconds"], m["seconds"])
+        compare(name, "peak_mb", before["peak_mb"], m["peak_mb"])
+
+    for name, run in report["runs"].items():
+        before = baseline.get("runs", {}).get(name)
+        if not before:
+            continue
+        for metric in ("seconds_per_question", "steps_per_question", "peak_mb"):
+            compare(f"run {name}", metric, before[metric], run[metric])
+    return regressions
+
+
+def main():
+    """
+    Command-line entry point: measures the orchestration hot paths and writes the report.
+    """
+    parser = argparse.ArgumentParser(description="Measure the overhead of the orchestration with zero-latency stand-in models.")
+    parser.add_argument("--config", default=os.getenv("TTC_CONFIG", "config.stub.yaml"),
+                        help="The config to run with; the default stub config runs offline.")
+    parser.add_argument("--runs", nargs="*", help="Only run these full-run scenarios (none to skip them).")
+    parser.add_argument("--report", help="The report path, without extension; .md and .json are written.")
+    parser.add_argument("--baseline", help="A previous JSON report; exit with an error on regressions against it.")
+    args = parser.parse_args()
+
+    # The config is loaded when the models are imported, so it has to be chosen first
+    os.environ["TTC_CONFIG"] = args.config
+    from models import config, provider_mapping
+    from stub_models import register_reference_answers
+    from test_time_compute import app
+
+    settings = config['microbench']
+    report = {
+        "config": args.config,
+        "size": {key: settings[key] for key in ("threads", "revisions", "text_chars")},
+        "micro": micro_benchmarks(settings),
+        "runs": {},
+    }
+
+    scenarios = [scenario for scenario in settings['runs'] if args.runs is None or scenario['name'] in args.runs]
+    for scenario in scenarios:
+        check_overrides(f"Scenario {scenario['name']}", scenario.get('overrides') or {})
+    if scenarios and 'stub' not in provider_mapping['response_agents'].values():
+        print("Skipping the full runs, which need the stub models of config.stub.yaml")
+        scenarios = []
+    if scenarios:
+        dataset = load_dataset(config['benchmark']['dataset'])
+        register_reference_answers({item["question"]: item["answer"] for item in dataset})
+    for scenario in scenarios:
+        print(f"Running {scenario['name']}...")
+        report["runs"][scenario['name']] = run_scenario(app, config, scenario, dataset, settings['recursion_limit'])
+
+    markdown = markdown_report(report)
+    print("\n" + markdown)
+
+    report_path = args.report or settings['report']
+    folder = os.path.dirname(report_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(f"{report_path}.md", 'w', encoding='utf-8') as f:
+        f.write(markdown)
+    with open(f"{report_path}.json", 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline, settings['regression_threshold'], settings['min_seconds'])
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
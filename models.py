@@ -1,6 +1,9 @@
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_mistralai import ChatMistralAI
+from stub_models import StubChatModel
+from cassette import Cassette
+from scheduler import Scheduler
 import os
 import yaml
 from dotenv import load_dotenv
@@ -13,19 +16,47 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
 mistral_api_key = os.getenv("MISTRAL_API_KEY")
 
-# Load configuration from config.yaml
-with open('config.yaml', 'r') as f:
+# Load configuration from config.yaml, or from the file set in TTC_CONFIG
+config_path = os.getenv("TTC_CONFIG", "config.yaml")
+with open(config_path, 'r') as f:
     config = yaml.safe_load(f)
 
+# Record or replay every model and tool call, as set in the cassette section of the config
+cassette = Cassette(config['cassette'])
+if cassette.mode == "replay":
+    # Replayed calls never reach the providers, so their clients only need a placeholder key
+    openai_api_key = openai_api_key or "replay"
+    anthropic_api_key = anthropic_api_key or "replay"
+    mistral_api_key = mistral_api_key or "replay"
+
+# Queue the model calls of concurrent runs per provider, as set in the scheduling section of the config
+scheduler = Scheduler(config['scheduling'])
+
 llm_mapping = {"response_agents": {}}
+provider_mapping = {"response_agents": {}}
 
-def determine_llm(name, model_name):
+def determine_provider(name):
     if name.lower().startswith('gpt'):
-        return ChatOpenAI(api_key=openai_api_key, model=model_name)
+        return 'openai'
     elif name.lower().startswith('claude'):
-        return ChatAnthropic(api_key=anthropic_api_key, model=model_name)
+        return 'anthropic'
     elif name.lower().startswith('mistral'):
-        return ChatMistralAI(api_key=mistral_api_key, model=model_name)
+        return 'mistral'
+    elif name.lower().startswith('stub'):
+        return 'stub'
+    else:
+        return None
+
+def determine_llm(name, model_name):
+    provider = determine_provider(name)
+    if provider == 'openai':
+        return scheduler.model_class(cassette.model_class(ChatOpenAI))(api_key=openai_api_key, model=model_name)
+    elif provider == 'anthropic':
+        return scheduler.model_class(cassette.model_class(ChatAnthropic))(api_key=anthropic_api_key, model=model_name)
+    elif provider == 'mistral':
+        return scheduler.model_class(cassette.model_class(ChatMistralAI))(api_key=mistral_api_key, model=model_name)
+    elif provider == 'stub':
+        return scheduler.model_class(cassette.model_class(StubChatModel))(model=model_name, **config.get('stub', {}))
     else:
         raise ValueError(f"Unknown model {model_name} for agent {name}")
 
@@ -35,6 +66,7 @@ for agent in config['llms']['response_agents']:
     model_name = agent['model']
     llm = determine_llm(name, model_name)
     llm_mapping["response_agents"][f'{name}'] = llm
+    provider_mapping["response_agents"][f'{name}'] = determine_provider(name)
 
 
 # Initialize LLM for difficulty agent
@@ -42,33 +74,53 @@ difficulty_agent = config['llms']['difficulty_agent']
 name = difficulty_agent['name']
 model_name = difficulty_agent['model']
 llm_mapping['difficulty_agent'] = determine_llm(name, model_name)
+provider_mapping['difficulty_agent'] = determine_provider(name)
 
 # Initialize LLM for commenter agent
 commenter_agent = config['llms']['commenter_agent']
 name = commenter_agent['name']
 model_name = commenter_agent['model']
 llm_mapping['commenter_agent'] = determine_llm(name, model_name)
+provider_mapping['commenter_agent'] = determine_provider(name)
 
 # Initialize LLM for scorer agent
 scorer_agent = config['llms']['scorer_agent']
 name = scorer_agent['name']
 model_name = scorer_agent['model']
 llm_mapping['scorer_agent'] = determine_llm(name, model_name)
+provider_mapping['scorer_agent'] = determine_provider(name)
+
+# Initialize LLM for judge agent
+judge_agent = config['llms']['judge_agent']
+name = judge_agent['name']
+model_name = judge_agent['model']
+llm_mapping['judge_agent'] = determine_llm(name, model_name)
+provider_mapping['judge_agent'] = determine_provider(name)
 
 # Initialize LLM for check done agent
 check_done_agent = config['llms']['check_done_agent']
 name = check_done_agent['name']
 model_name = check_done_agent['model']
 llm_mapping['check_done_agent'] = determine_llm(name, model_name)
+provider_mapping['check_done_agent'] = determine_provider(name)
 
 # Initialize LLM for answer summary agent
 answer_summary_agent = config['llms']['answer_summary_agent']
 name = answer_summary_agent['name']
 model_name = answer_summary_agent['model']
 llm_mapping['answer_summary_agent'] = determine_llm(name, model_name)
+provider_mapping['answer_summary_agent'] = determine_provider(name)
 
 # Initialize LLM for final summary agent
 final_summary_agent = config['llms']['final_summary_agent']
 name = final_summary_agent['name']
 model_name = final_summary_agent['model']
-llm_mapping['final_summary_agent'] = determine_llm(name, model_name)
\ No newline at end of file
+llm_mapping['final_summary_agent'] = determine_llm(name, model_name)
+provider_mapping['final_summary_agent'] = determine_provider(name)
+
+# Initialize the cheap LLMs that judge first in cascade mode
+llm_mapping['cascade'] = {}
+provider_mapping['cascade'] = {}
+for role, cascade_agent in config['cascade'].items():
+    llm_mapping['cascade'][role] = determine_llm(cascade_agent['name'], cascade_agent['model'])
+    provider_mapping['cascade'][role] = determine_provider(cascade_agent['name'])
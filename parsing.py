@@ -0,0 +1,305 @@
+from typing import Literal, Optional
+import re
+
+from pydantic import BaseModel, Field
+
+from models import config
+from stats import increment, merge_stats, usage_stats
+from deadline import call_before_deadline
+from hedging import hedged_call
+
+
+# SCHEMAS
+
+class ScoreOutput(BaseModel):
+    """The score assigned to a reasoning chain."""
+    score: float = Field(description="Decimal score from 1 to 10 reflecting the quality of the answer")
+    confidence: Optional[float] = Field(
+        default=None, description="How confident you are in the score, from 0 (guessing) to 1 (certain)"
+    )
+
+
+class JudgeOutput(BaseModel):
+    """The comments on a reasoning chain and the score assigned to it."""
+    comments: str = Field(description="Two to three sentences on the accuracy and logical structure of the answer")
+    score: float = Field(description="Decimal score from 1 to 10 reflecting the quality of the answer")
+
+
+class DifficultyOutput(BaseModel):
+    """The difficulty level assigned to a question."""
+    difficulty: int = Field(description="Difficulty level of the question")
+
+
+class DoneOutput(BaseModel):
+    """Whether the reasoning process has converged on a correct answer."""
+    decision: Literal["PROCESS DONE", "CONTINUE"] = Field(
+        description="PROCESS DONE if an answer has been converged on, CONTINUE otherwise"
+    )
+
+
+# TOLERANT PARSERS
+
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+OUT_OF_TEN_PATTERN = re.compile(r"(?:/|out of)\s*10(?:\.0+)?", re.IGNORECASE)
+SCORE_LINE_PATTERN = re.compile(r"^\W*score\b.*$", re.IGNORECASE | re.MULTILINE)
+CONFIDENCE_PATTERN = re.compile(r"confidence\W{0,5}(\d+(?:\.\d+)?)\s*(%?)", re.IGNORECASE)
+SHORT_REPLY_WORDS = 5
+
+
+def message_text(message) -> str:
+    """
+    Extracts the plain text from a model message.
+
+    Args:
+        message: A message (or raw content) whose content is a string or a list of content blocks.
+
+    Returns:
+        str: The concatenated text of the message.
+    """
+    content = getattr(message, "content", message)
+    if isinstance(content, list):
+        return "".join(
+            block if isinstance(block, str) else block.get("text", "")
+            for block in content
+            if isinstance(block, str) or block.get("type") == "text"
+        )
+    return str(content)
+
+
+def find_number(text, label, valid):
+    """
+    Finds the number a reply gives for a label, ignoring unrelated numbers in long replies.
+
+    A number following the label (e.g. "Score: 7") is accepted anywhere, while other
+    numbers are only taken from short replies, so numbers like "Step 1" in a chatty
+    reply are not mistaken for the answer.
+
+    Args:
+        text (str): The raw reply.
+        label (str): The word that introduces the number, e.g. "score".
+        valid (callable): Returns whether a candidate number is acceptable.
+
+    Returns:
+        float | None: The first acceptable number, or None if there is none.
+    """
+    text = OUT_OF_TEN_PATTERN.sub("", text).strip().strip("*").strip()
+    labelled = re.search(label + r"\W{0,5}(-?\d+(?:\.\d+)?)", text, re.IGNORECASE)
+    if labelled and valid(float(labelled.group(1))):
+        return float(labelled.group(1))
+    if len(text.split()) > SHORT_REPLY_WORDS:
+        return None
+    for match in NUMBER_PATTERN.finditer(text):
+        if valid(float(match.group())):
+            return float(match.group())
+    return None
+
+
+def parse_score(text):
+    """
+    Extracts a score from 1 to 10 from a possibly chatty reply.
+
+    Args:
+        text (str): The raw reply, e.g. "8.5", "Score: 7/10" or "**6**".
+
+    Returns:
+        float | None: The score, or None if no valid score was found.
+    """
+    return find_number(text, "score", lambda value: 1 <= value <= 10)
+
+
+def parse_difficulty(text):
+    """
+    Extracts a difficulty level known to `difficulty_settings` from a possibly chatty reply.
+
+    Args:
+        text (str): The raw reply, e.g. "2" or "Difficulty: 3".
+
+    Returns:
+        int | None: The difficulty level, or None if no known level was found.
+    """
+    levels = config['difficulty_settings'].keys()
+    difficulty = find_number(text, "difficulty", lambda value: value.is_integer() and int(value) in levels)
+    return None if difficulty is None else int(difficulty)
+
+
+def parse_comments(text):
+    """
+    Extracts the comments from a judge reply written as text, dropping its score line.
+
+    Args:
+        text (str): The raw reply, e.g. "The steps are correct. \nScore: 8".
+
+    Returns:
+        str: The comments.
+    """
+    return SCORE_LINE_PATTERN.sub("", text).strip()
+
+
+def parse_confidence(text):
+    """
+    Extracts a labelled confidence from a possibly chatty reply.
+
+    Args:
+        text (str): The raw reply, e.g. "Score: 7, confidence: 0.8" or "Confidence: 80%".
+
+    Returns:
+        float | None: The confidence from 0 to 1, or None if the reply states none.
+    """
+    match = CONFIDENCE_PATTERN.search(text)
+    if not match:
+        return None
+    return normalize_confidence(float(match.group(1)), percent=bool(match.group(2)))
+
+
+def normalize_confidence(value, percent=False):
+    """
+    Converts a confidence to a fraction from 0 to 1, accepting percentages.
+
+    Args:
+        value (float): The confidence as given by the model.
+        percent (bool): Whether the value was written with a percent sign.
+
+    Returns:
+        float | None: The confidence from 0 to 1, or None if it is out of range.
+    """
+    if percent or 1 < value <= 100:
+        value /= 100
+    return value if 0 <= value <= 1 else None
+
+
+def parse_done(text):
+    """
+    Extracts the check_done decision from a possibly chatty reply.
+
+    Args:
+        text (str): The raw reply, which should mention exactly one of "PROCESS DONE" or "CONTINUE".
+
+    Returns:
+        bool | None: True if the process is done, False to continue, None if the reply is ambiguous.
+    """
+    text = text.upper()
+    done = "PROCESS DONE" in text
+    cont = "CONTINUE" in text
+    if done == cont:
+        return None
+    return done
+
+
+# STRUCTURED INVOCATION
+
+def structured_model(llm, schema):
+    """
+    Binds a schema to a model through the provider's structured-output support.
+
+    Args:
+        llm: The language model.
+        schema: The pydantic model describing the expected output.
+
+    Returns:
+        The structured runnable, or None if the provider does not support it.
+    """
+    if not config['structured_outputs']['use_schema']:
+        return None
+    try:
+        return llm.with_structured_output(schema, include_raw=True)
+    except NotImplementedError:
+        return None
+
+
+def structured_reply(llm, prompt, schema, field, parse, role, instruction, deadline=None, backup=None):
+    """
+    Invokes a model and returns a validated value from its reply, along with the reply itself.
+
+    The schema is requested through the provider's structured output when available,
+    and the raw text is run through the tolerant parser otherwise. A malformed reply
+    is re-asked up to `max_retries` times, after which the configured fallback is used,
+    so a bad reply never crashes the run.
+
+    Args:
+        llm: The language model to invoke.
+        prompt (list): The messages to send to the model.
+        schema: The pydantic model describing the expected output.
+        field (str): The schema field holding the value.
+        parse (callable): Tolerant parser returning the value from text, or None if it is invalid.
+        role (str): The agent role, used for fallbacks and stats keys.
+        instruction (str): Reminder of the expected format sent when re-asking.
+        deadline (float | None): The deadline every attempt must finish by.
+        backup (Tuple[Any, list] | None): A backup model and the messages to send it, which gets the
+            same request when the model is slower than usual, see `hedged_call`.
+
+    Returns:
+        Tuple[Any, Any, dict]: The parsed value, the reply it came from (the schema object, or the raw
+            message when the reply was parsed from text, None when the fallback was used), and the run
+            stats of the call.
+    """
+    settings = config['structured_outputs']
+    structured_llm = structured_model(llm, schema)
+    stats = {}
+    messages = list(prompt)
+
+    # The backup is only used when it replies in the same form as the model
+    backup_llm, backup_messages = backup if backup else (None, [])
+    backup_structured = structured_model(backup_llm, schema) if backup_llm is not None else None
+    if structured_llm is not None and backup_structured is None:
+        backup_llm = None
+
+    for attempt in range(settings['max_retries'] + 1):
+        if attempt > 0:
+            increment(stats, f"{role}_parse_retries")
+
+        if structured_llm is not None:
+            result, hedge_stats = call_before_deadline(
+                lambda: hedged_call(
+                    role, llm, lambda: structured_llm.invoke(messages),
+                    (lambda: backup_structured.invoke(backup_messages)) if backup_llm is not None else None
+                ),
+                deadline
+            )
+            raw = result["raw"]
+            if result["parsed"] is not None:
+                reply = result["parsed"]
+                value = parse(str(getattr(reply, field)))
+            else:
+                reply = raw
+                value = parse(message_text(raw))
+        else:
+            raw, hedge_stats = call_before_deadline(
+                lambda: hedged_call(
+                    role, llm, lambda: llm.invoke(messages), (lambda: backup_llm.invoke(backup_messages)) if backup_llm is not None else None
+                ),
+                deadline
+            )
+            reply = raw
+            value = parse(message_text(raw))
+        stats = merge_stats(stats, merge_stats(usage_stats(raw, role), hedge_stats))
+
+        if value is not None:
+            return value, reply, stats
+
+        increment(stats, f"{role}_parse_failures")
+        messages = messages + [("human", f"Your reply could not be understood. {instruction}")]
+        backup_messages = backup_messages + [("human", f"Your reply could not be understood. {instruction}")]
+
+    increment(stats, f"{role}_parse_fallbacks")
+    return settings['fallbacks'][role], None, stats
+
+
+def invoke_structured(llm, prompt, schema, field, parse, role, instruction, deadline=None):
+    """
+    Invokes a model and returns a validated value from its reply, see `structured_reply`.
+
+    Args:
+        llm: The language model to invoke.
+        prompt (list): The messages to send to the model.
+        schema: The pydantic model describing the expected output.
+        field (str): The schema field holding the value.
+        parse (callable): Tolerant parser returning the value from text, or None if it is invalid.
+        role (str): The agent role, used for fallbacks and stats keys.
+        instruction (str): Reminder of the expected format sent when re-asking.
+        deadline (float | None): The deadline every attempt must finish by.
+
+    Returns:
+        Tuple[Any, dict]: The parsed value and the run stats of the call.
+    """
+    value, _, stats = structured_reply(llm, prompt, schema, field, parse, role, instruction, deadline)
+    return value, stats
@@ -0,0 +1,120 @@
+import re
+
+PATCH_INSTRUCTION = (
+    "\n The previous response is split into numbered steps. Instead of writing the whole answer again, only write "
+    "the edits it needs, using these tags:\n"
+    "<replace step=\"k\">new text of step k</replace>\n"
+    "<insert after=\"k\">a new step after step k (0 for the beginning)</insert>\n"
+    "<delete step=\"k\"/>\n"
+    "<append>a correction or new step at the end</append>\n"
+    "Steps you do not edit are kept exactly as they are, so make sure the edited answer still reads as one "
+    "complete answer, including its final answer. If the answer has to be rewritten entirely, write the "
+    "complete revised answer without any tags. \n"
+)
+FULL_REWRITE_REQUEST = "Your edits could not be applied: {error}. Write the complete revised answer instead, without any tags."
+
+REPLACE_PATTERN = re.compile(r"<replace\s+step=\"?(\d+)\"?\s*>(.*?)</replace>", re.DOTALL)
+INSERT_PATTERN = re.compile(r"<insert\s+after=\"?(\d+)\"?\s*>(.*?)</insert>", re.DOTALL)
+DELETE_PATTERN = re.compile(r"<delete\s+step=\"?(\d+)\"?\s*/?>(?:\s*</delete>)?")
+APPEND_PATTERN = re.compile(r"<append>(.*?)</append>", re.DOTALL)
+STEP_BREAK_PATTERN = re.compile(r"\n\s*\n")
+
+
+class PatchError(ValueError):
+    """Raised when a revision's edits do not fit the previous response."""
+
+
+def split_steps(text):
+    """
+    Splits a response into steps: its paragraphs, or its lines if it is a single paragraph.
+
+    Args:
+        text (str): The response.
+
+    Returns:
+        list: The steps, without surrounding whitespace.
+    """
+    steps = [step.strip() for step in STEP_BREAK_PATTERN.split(text.strip()) if step.strip()]
+    if len(steps) == 1:
+        steps = [line.strip() for line in steps[0].split("\n") if line.strip()]
+    return steps
+
+
+def numbered_steps(text):
+    """
+    Shows a response as numbered steps, for the reviser to edit.
+
+    Args:
+        text (str): The response.
+
+    Returns:
+        str: Every step preceded by its number.
+    """
+    return "\n\n".join(f"[Step {number}]\n{step}" for number, step in enumerate(split_steps(text), start=1))
+
+
+def parse_edits(text):
+    """
+    Reads the edits a reviser wrote.
+
+    Args:
+        text (str): The reviser's reply.
+
+    Returns:
+        dict | None: The replaced, inserted, deleted and appended steps, or None if the reply has no
+            edit tags (i.e. it is a full rewrite).
+    """
+    edits = {
+        "replace": [(int(step), content.strip()) for step, content in REPLACE_PATTERN.findall(text)],
+        "insert": [(int(step), content.strip()) for step, content in INSERT_PATTERN.findall(text)],
+        "delete": [int(step) for step in DELETE_PATTERN.findall(text)],
+        "append": [content.strip() for content in APPEND_PATTERN.findall(text)],
+    }
+    if not any(edits.values()):
+        return None
+    return edits
+
+
+def apply_edits(previous, edits):
+    """
+    Rebuilds the full revised response from the previous one and the reviser's edits.
+
+    Args:
+        previous (str): The previous response.
+        edits (dict): The edits, see `parse_edits`.
+
+    Returns:
+        str: The revised response.
+
+    Raises:
+        PatchError: If an edit refers to a step that does not exist, or a step is edited twice.
+    """
+    steps = split_steps(previous)
+    changed = {}
+    for step, content in edits["replace"]:
+        changed.setdefault(step, []).append(content)
+    for step in edits["delete"]:
+        changed.setdefault(step, []).append(None)
+
+    for step, contents in changed.items():
+        if not 1 <= step <= len(steps):
+            raise PatchError(f"there is no step {step}, the previous response has {len(steps)} steps")
+        if len(contents) > 1:
+            raise PatchError(f"step {step} was edited more than once")
+    inserted = {}
+    for step, content in edits["insert"]:
+        if not 0 <= step <= len(steps):
+            raise PatchError(f"cannot insert after step {step}, the previous response has {len(steps)} steps")
+        inserted.setdefault(step, []).append(content)
+
+    revised = list(inserted.get(0, []))
+    for number, step in enumerate(steps, start=1):
+        content = changed.get(number, [step])[0]
+        if content:
+            revised.append(content)
+        revised.extend(inserted.get(number, []))
+    revised.extend(edits["append"])
+
+    if not revised:
+        raise PatchError("the edits deleted every step")
+    return "\n\n".join(revised)
@@ -0,0 +1,97 @@
+from langchain_core.messages import HumanMessage, SystemMessage
+
+# Marks the end of a prefix Anthropic should cache
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# System prompts by name, shared by every run in the process
+prompt_registry = {}
+
+
+def load_prompt(name):
+    """
+    Loads the system prompt of an agent, reading it from the prompts directory the first time only.
+
+    The prompts are kept in a registry shared by every run in the process, so concurrent
+    runs do not re-read the files for every call.
+
+    Args:
+        name (str): The name of the prompt file, without extension.
+
+    Returns:
+        str: The system prompt.
+    """
+    if name not in prompt_registry:
+        with open(f'prompts/{name}.txt', 'r') as file:
+            prompt_registry[name] = file.read()
+    return prompt_registry[name]
+
+
+def reload_prompt(name):
+    """
+    Drops a prompt from the registry, so the next call reads the edited file.
+
+    Args:
+        name (str): The name of the prompt file, without extension.
+    """
+    prompt_registry.pop(name, None)
+
+
+def system_message(system_prompt, provider):
+    """
+    Builds the system message, marked as a cacheable prefix for Anthropic models.
+
+    Args:
+        system_prompt (str): The system prompt.
+        provider (str): The provider of the model the message is sent to.
+
+    Returns:
+        SystemMessage: The system message.
+    """
+    if provider == 'anthropic':
+        return SystemMessage(content=[{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}])
+    return SystemMessage(content=system_prompt)
+
+
+def question_message(question, details, provider):
+    """
+    Builds the human message, with the question first so every call about it shares the same prefix.
+
+    OpenAI caches the longest repeated prefix automatically, so the question always
+    opens the message, byte for byte identical. For Anthropic models the question is
+    a separate block carrying a cache breakpoint, which caches the system prompt and
+    the question together.
+
+    Args:
+        question (str): The question being answered.
+        details (str): The part of the message that changes between calls.
+        provider (str): The provider of the model the message is sent to.
+
+    Returns:
+        HumanMessage: The human message.
+    """
+    prefix = f"Here is the question: {question} \n"
+    if provider == 'anthropic':
+        content = [{"type": "text", "text": prefix, "cache_control": CACHE_CONTROL}]
+        if details:
+            content.append({"type": "text", "text": details})
+        return HumanMessage(content=content)
+    return HumanMessage(content=prefix + details)
+
+
+def build_prompt(name, question, details, provider):
+    """
+    Builds the messages for an agent, with the stable prefix (system prompt, then question) first.
+
+    Args:
+        name (str): The name of the agent's prompt file.
+        question (str): The question being answered.
+        details (str): The part of the message that changes between calls.
+        provider (str): The provider of the model the messages are sent to.
+
+    Returns:
+        list: The messages to send to the model.
+    """
+    return [
+        system_message(load_prompt(name), provider),
+        question_message(question, details, provider),
+    ]
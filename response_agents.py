@@ -2,28 +2,46 @@ from langchain_core.messages import (
     ToolMessage,
 )
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessage, HumanMessage
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import functools
-from models import llm_mapping, config 
+import re
+from models import llm_mapping, provider_mapping, config 
+from parsing import message_text
+from prompting import load_prompt
+from stats import merge_stats, usage_stats
+from deadline import call_before_deadline
+from hedging import backup_name, hedged_call
+from compaction import estimate_tokens
+from patching import FULL_REWRITE_REQUEST, PATCH_INSTRUCTION, PatchError, apply_edits, parse_edits
 from tools import tools
 
-def create_response_agent(llm, tools):
+STRUCTURED_ANSWER_INSTRUCTION = (
+    "\n When you have finished, write your complete final answer, including its step-by-step reasoning, "
+    "between <final_answer> and </final_answer> tags. It will be shown to the reader exactly as written. \n"
+)
+FINAL_ANSWER_PATTERN = re.compile(r"<final_answer>(.*?)</final_answer>", re.DOTALL)
+
+def create_response_agent(llm, tools, summary_mode="always"):
     """
     Create an agent for generating initial responses to complex questions.
 
     Args:
         llm: The language model to use for generating responses.
         tools: A list of tools that the agent can use to help answer questions.
+        summary_mode (str): The agent's summary mode; "structured" asks for a tagged final answer.
 
     Returns:
         A prompt template bound to the language model and tools.
     """
 
-    # load and read the text from file at prompt/initial_response.txt
-    with open('prompts/response.txt', 'r') as file:
-        data = file.read()
+    # load the prompt from the registry
+    data = load_prompt('response')
 
     system_prompt = data + "\n To help answer your question, you have access to the following tools: {tool_names} \n"
+    if summary_mode == "structured":
+        system_prompt += STRUCTURED_ANSWER_INSTRUCTION
 
     prompt = ChatPromptTemplate.from_messages(
         [
@@ -48,8 +66,7 @@ def create_summary_agent(llm):
         A prompt template bound to the language model.
     """
 
-    with open('prompts/summary.txt', 'r') as file:
-        system_prompt = file.read()
+    system_prompt = load_prompt('summary')
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -61,22 +78,26 @@ def create_summary_agent(llm):
     )
     return prompt | llm
 
-def create_revision_agent(llm, tools):
+def create_revision_agent(llm, tools, summary_mode="always"):
     """
     Create an agent for revising pre-generated answers to questions.
 
     Args:
         llm: The language model to use for generating revised responses.
         tools: A list of tools that the agent can use to help revise answers.
+        summary_mode (str): The agent's summary mode; "structured" asks for a tagged final answer.
 
     Returns:
         A prompt template bound to the language model and tools.
     """
 
-    with open('prompts/reviser.txt', 'r') as file:
-        data = file.read()
+    data = load_prompt('reviser')
 
-    system_prompt = data + "\n To help, you have access to the following tools: {tool_names} \n"
+    # The patch instructions follow the revising mode of each call, which benchmark variants change at runtime
+    system_prompt = data + "\n To help, you have access to the following tools: {tool_names} \n{patch_instruction}"
+    # A full rewrite still needs its tagged final answer to skip the Summary node
+    if summary_mode == "structured":
+        system_prompt += STRUCTURED_ANSWER_INSTRUCTION
 
     prompt = ChatPromptTemplate.from_messages(
         [
@@ -88,54 +109,273 @@ def create_revision_agent(llm, tools):
             MessagesPlaceholder(variable_name="messages"),
         ]
     )
-    prompt = prompt.partial(tool_names=", ".join([tool.name for tool in tools]))
+    prompt = prompt.partial(
+        tool_names=", ".join([tool.name for tool in tools]),
+        patch_instruction=lambda: PATCH_INSTRUCTION if config['revising']['mode'] == "patch" else "",
+    )
     return prompt | llm.bind_tools(tools)
 
-def agent_node(state, agent, name):
+def direct_answer(state, result, summary_mode, summary_max_chars):
     """
-    Helper function to create a node for a given agent.
+    Determines whether an agent's final message can be used as the answer without the Summary node.
 
     Args:
         state: The current state of the conversation.
-        agent: The agent to invoke.
+        result: The message the agent just produced.
+        summary_mode (str): "always" to always summarize, "auto" to skip the summary for short or
+            tool-free answers, or "structured" to use the answer the agent wrote between tags.
+        summary_max_chars (int): The longest answer "auto" mode uses directly.
+
+    Returns:
+        str | None: The answer to use directly, or None if the Summary node should run.
+    """
+    if result.tool_calls or summary_mode == "always":
+        return None
+
+    text = message_text(result)
+    if summary_mode == "structured":
+        match = FINAL_ANSWER_PATTERN.search(text)
+        return match.group(1).strip() if match else None
+
+    used_tools = any(isinstance(message, ToolMessage) for message in state["messages"])
+    if not used_tools or len(text) <= summary_max_chars:
+        return text
+
+    return None
+
+
+def revision_patch(state, result):
+    """
+    Applies the edits of a revision to the previous response.
+
+    Args:
+        state: The current state of the conversation.
+        result: The final message of the revision agent.
+
+    Returns:
+        dict | None: The revised response as the final answer, or, if the edits do not apply, a request
+            for a full rewrite sent back to the agent; with the stats of the patch. None if the message
+            is a full rewrite, or the agent was already asked for one.
+    """
+    rewrite_requested = any(message.additional_kwargs.get("full_rewrite") for message in state["messages"])
+    edits = parse_edits(message_text(result))
+    if edits is None or rewrite_requested or state.get("previous_response") is None:
+        return None
+
+    try:
+        revised = apply_edits(state["previous_response"], edits)
+    except PatchError as e:
+        request = HumanMessage(content=FULL_REWRITE_REQUEST.format(error=e), additional_kwargs={"full_rewrite": True})
+        return {"messages": [request], "stats": {"revision_patch_failures": 1}}
+
+    # Every step kept as it was is output the agent did not have to write
+    output_tokens = (result.usage_metadata or {}).get("output_tokens") or estimate_tokens(message_text(result))
+    return {
+        "final_answer": revised,
+        "stats": {"revision_patches": 1, "revision_output_tokens_saved": max(estimate_tokens(revised) - output_tokens, 0)},
+    }
+
+
+def agent_update(state, result, name, role, summary_mode="always", summary_max_chars=0):
+    """
+    Converts a message produced by an agent into an update of the agent state.
+
+    Args:
+        state: The current state of the conversation.
+        result: The message the agent produced.
         name: The name of the agent.
+        role: The role the agent plays ("response", "revision" or "summary"), used for stats.
+        summary_mode (str): How the agent's final message is turned into the answer, see `direct_answer`.
+        summary_max_chars (int): The longest answer used directly in "auto" summary mode.
 
     Returns:
-        A dictionary representing the updated state after invoking the agent.
+        A dictionary representing the updated state.
     """
-    result = agent.invoke(state)
     # Convert the agent output into a format that is suitable to append to the global state
+    stats = usage_stats(result, role)
     if name == "Summary":
         return {
             "final_answer": result.content,
+            "stats": stats,
         }
       
     if isinstance(result, ToolMessage):
         pass
     else:
         result = AIMessage(**result.dict(exclude={"type", "name"}), name=name)
-    return {
+    update = {
         "messages": [result],
         # Track the sender to know who to pass to next in the workflow.
         "sender": name,
+        "stats": stats,
     }
 
+    # In patch mode a revision's edits are applied to the previous response
+    if role == "revision" and config['revising']['mode'] == "patch" and not result.tool_calls:
+        patch_update = revision_patch(state, result)
+        if patch_update is not None:
+            return {
+                **update,
+                **patch_update,
+                "messages": update["messages"] + patch_update.get("messages", []),
+                "stats": merge_stats(stats, patch_update["stats"]),
+            }
+
+    # Use the final message directly when the summary would not change anything
+    final_answer = direct_answer(state, result, summary_mode, summary_max_chars)
+    if final_answer is not None:
+        update["final_answer"] = final_answer
+        update["stats"] = merge_stats(stats, {"summary_skipped": 1})
+
+    return update
+
+
+def agent_node(state, agent, name, role, summary_mode="always", summary_max_chars=0):
+    """
+    Helper function to create a node for a given agent.
+
+    Args:
+        state: The current state of the conversation.
+        agent: The agent to invoke.
+        name: The name of the agent.
+        role: The role the agent plays ("response", "revision" or "summary"), used for stats.
+        summary_mode (str): How the agent's final message is turned into the answer, see `direct_answer`.
+        summary_max_chars (int): The longest answer used directly in "auto" summary mode.
+
+    Returns:
+        A dictionary representing the updated state after invoking the agent.
+    """
+    backup = backup_name(name) if role != "summary" else None
+    if backup is None:
+        result = call_before_deadline(lambda: agent.invoke(state), state.get("deadline"))
+        return agent_update(state, result, name, role, summary_mode, summary_max_chars)
+
+    # Send the same turn to the backup agent if this one is slower than usual
+    backup_agent = response_chains["initial" if role == "response" else "revision"][backup]
+    result, hedge_stats = call_before_deadline(
+        lambda: hedged_call(
+            role, llm_mapping["response_agents"][name], lambda: agent.invoke(state), lambda: backup_agent.invoke(state)
+        ),
+        state.get("deadline")
+    )
+    update = agent_update(state, result, name, role, summary_mode, summary_max_chars)
+    update["stats"] = merge_stats(update["stats"], hedge_stats)
+    return update
+
+
+def sample_agent_turns(agent, state, count, provider):
+    """
+    Samples several independent turns of an agent for the same input.
+
+    OpenAI models return all of them from one request with `n`, so the shared input is
+    sent and billed once. Other providers get one request per turn, sent concurrently.
+
+    Args:
+        agent: The agent to sample, a prompt template bound to a language model and tools.
+        state: The state of the conversation the turns respond to.
+        count (int): The number of turns to sample.
+        provider (str): The provider of the agent's language model.
+
+    Returns:
+        Tuple[list, dict]: The sampled messages and the stats of the requests.
+    """
+    if provider == 'openai' and config['batched_sampling']['native_n']:
+        messages = agent.first.invoke(state).to_messages()
+        model = agent.last
+        result = model.bound.generate([messages], n=count, **model.kwargs)
+        turns = [generation.message for generation in result.generations[0]]
+
+        # Every candidate carries the usage of the whole request, so only the first one keeps it
+        for turn in turns[1:]:
+            turn.usage_metadata = None
+            turn.response_metadata["shared_request"] = True
+
+        return turns, {"sampling_requests": 1, "sampled_turns": len(turns), "sampling_requests_saved": len(turns) - 1}
+
+    # Every request keeps the context of the run, e.g. the tenant and priority its calls are scheduled with
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, agent.invoke, state) for _ in range(count)]
+        turns = [future.result() for future in futures]
+
+    return turns, {"sampling_requests": count, "sampled_turns": count}
+
+
 # Create initial response agents and nodes
 initial_response_agents = {}
 revision_agents = {}
+response_chains = {"initial": {}, "revision": {}}
+agent_settings = {}
 for agent_cfg in config['llms']['response_agents']:
     name = agent_cfg['name']
     llm = llm_mapping["response_agents"][f'{name}']
+    summary_mode = agent_cfg.get('summary_mode', 'always')
+    summary_max_chars = agent_cfg.get('summary_max_chars', 0)
+    agent_settings[name] = {"summary_mode": summary_mode, "summary_max_chars": summary_max_chars}
 
-    response_agent = create_response_agent(llm, tools)
-    agent_node_fn = functools.partial(agent_node, agent=response_agent, name=name)
+    response_agent = create_response_agent(llm, tools, summary_mode)
+    response_chains["initial"][name] = response_agent
+    agent_node_fn = functools.partial(
+        agent_node, agent=response_agent, name=name, role="response",
+        summary_mode=summary_mode, summary_max_chars=summary_max_chars
+    )
     initial_response_agents[name] = agent_node_fn
 
-    revision_agent = create_revision_agent(llm, tools)
-    agent_node_fn_rev = functools.partial(agent_node, agent=revision_agent, name=name)
+    revision_agent = create_revision_agent(llm, tools, summary_mode)
+    response_chains["revision"][name] = revision_agent
+    agent_node_fn_rev = functools.partial(
+        agent_node, agent=revision_agent, name=name, role="revision",
+        summary_mode=summary_mode, summary_max_chars=summary_max_chars
+    )
     revision_agents[name] = agent_node_fn_rev
 
 # Do the same for answer_summary agent
 answer_summary_llm = llm_mapping['answer_summary_agent']
 answer_summary_agent = create_summary_agent(answer_summary_llm)
-answer_summary_node = functools.partial(agent_node, agent=answer_summary_agent, name='Summary')
+answer_summary_node = functools.partial(agent_node, agent=answer_summary_agent, name='Summary', role='summary')
+
+
+
+def draw_agent_turn(kind, agent, start_state, key, count, pool):
+    """
+    Draws the first agent turn of a thread, sampling it together with every other thread that shares the same input.
+
+    Args:
+        kind (str): "initial" or "revision".
+        agent (str): The name of the response agent.
+        start_state (dict): The starting state of the response or revision subgraph.
+        key (str): Identifies the shared input, so later threads can find their pre-sampled turn.
+        count (int): The number of threads, starting with this one, that share the input.
+        pool (dict): Turns already sampled for later threads, by key.
+
+    Returns:
+        Tuple[dict | None, dict]: The subgraph state seeded with the agent's first turn (None if the
+            agent should simply be invoked), and the updated pool.
+    """
+    pool = dict(pool or {})
+    stats = {}
+    if pool.get(key):
+        turn, *rest = pool.pop(key)
+        if rest:
+            pool[key] = rest
+    elif count > 1:
+        turns, stats = call_before_deadline(
+            lambda: sample_agent_turns(
+                response_chains[kind][agent], start_state, count, provider_mapping["response_agents"][agent]
+            ),
+            start_state.get("deadline")
+        )
+        turn, *rest = turns
+        if rest:
+            pool[key] = rest
+    else:
+        return None, pool
+
+    role = "response" if kind == "initial" else "revision"
+    update = agent_update(start_state, turn, agent, role, **agent_settings[agent])
+    seeded = {
+        **start_state,
+        **update,
+        "messages": list(start_state["messages"]) + update["messages"],
+        "stats": merge_stats(stats, update["stats"]),
+    }
+    return seeded, pool
@@ -0,0 +1,298 @@
+import contextvars
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from typing import ClassVar
+
+# Priorities of model calls, the most urgent first
+CRITICAL = 0
+FIRST_THREAD = 1
+EXTRA_THREAD = 2
+SPECULATIVE = 3
+
+# The tenant of the run and the priority of the node making a call, seen by the calls they make
+current_tenant = contextvars.ContextVar("current_tenant", default=None)
+current_priority = contextvars.ContextVar("current_priority", default=FIRST_THREAD)
+
+
+class Overloaded(Exception):
+    """Raised when a run or a model call is rejected because the deployment is at capacity."""
+
+
+class Ticket:
+    """A model call waiting for a provider slot."""
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.granted = threading.Event()
+        self.cancelled = False
+
+
+class Scheduler:
+    """
+    Shares the providers between the model calls of concurrent runs.
+
+    Every provider runs at most `max_concurrent_calls` calls at a time; the others wait in its
+    queue. Waiting calls go out by priority (critical path first, speculative work last), and
+    within a priority by weighted fair queuing across tenants: every call of a tenant advances
+    the tenant's virtual finish time by 1 / weight, and the call with the earliest finish goes
+    first, so a tenant with many calls queued cannot starve the others. Queues are bounded,
+    so an overloaded deployment rejects new runs at once instead of letting them wait without
+    end, and runs whose calls are rejected finish early with what they have.
+    """
+
+    def __init__(self, settings):
+        """
+        Args:
+            settings (dict): The scheduling section of the config.
+        """
+        self.settings = settings
+        self.enabled = settings['enabled']
+        self.lock = threading.Lock()
+        self.queues = defaultdict(list)
+        self.running = defaultdict(int)
+        self.virtual_time = defaultdict(float)
+        self.finish_times = defaultdict(float)
+        self.queued = defaultdict(int)
+        self.runs = defaultdict(int)
+        self.sequence = itertools.count()
+        self.classes = {}
+
+    def tenant(self, tenant=None):
+        """
+        Names the tenant of a call.
+
+        Args:
+            tenant (str | None): The tenant, or None for the tenant of the current run.
+
+        Returns:
+            str: The tenant, the default tenant if none was set.
+        """
+        return tenant or current_tenant.get() or self.settings['default_tenant']
+
+    def weight(self, tenant):
+        """
+        Looks up a tenant's share of the providers.
+
+        Args:
+            tenant (str): The tenant.
+
+        Returns:
+            float: The weight of the tenant, 1 unless set in tenant_weights.
+        """
+        return float(self.settings['tenant_weights'].get(tenant, 1))
+
+    def admit(self, tenant=None):
+        """
+        Takes one of a tenant's run slots for a question that is about to be queued.
+
+        Args:
+            tenant (str | None): The tenant submitting the question.
+
+        Returns:
+            str: The tenant, to give back to `finish` once the run is over.
+
+        Raises:
+            Overloaded: If the tenant, or the deployment, already has the most runs allowed.
+        """
+        tenant = self.tenant(tenant)
+        if not self.enabled:
+            return tenant
+        with self.lock:
+            if sum(self.runs.values()) >= self.settings['max_runs']:
+                raise Overloaded(f"{self.settings['max_runs']} questions are already queued or running")
+            if self.runs[tenant] >= self.settings['max_runs_per_tenant']:
+                raise Overloaded(f"Tenant {tenant} already has {self.settings['max_runs_per_tenant']} questions queued or running")
+            self.runs[tenant] += 1
+        return tenant
+
+    def finish(self, tenant):
+        """
+        Gives back the run slot of a finished question.
+
+        Args:
+            tenant (str): The tenant returned by `admit`.
+        """
+        if self.enabled:
+            with self.lock:
+                self.runs[tenant] -= 1
+
+    def call(self, provider, fn):
+        """
+        Makes a model call once the provider has a free slot.
+
+        Args:
+            provider (str): The provider the call goes to.
+            fn (callable): Makes the call, without arguments.
+
+        Returns:
+            The result of the call.
+
+        Raises:
+            Overloaded: If the queue is full, or the call waited longer than `queue_timeout`.
+        """
+        tenant = self.tenant()
+        priority = current_priority.get()
+        ticket = None
+        with self.lock:
+            if self.running[provider] < self.settings['max_concurrent_calls'] and not self.queues[provider]:
+                self.running[provider] += 1
+            else:
+                if sum(self.queued.values()) >= self.settings['max_queued_calls']:
+                    raise Overloaded(f"{self.settings['max_queued_calls']} model calls are already waiting")
+                if self.queued[tenant] >= self.settings['max_queued_calls_per_tenant']:
+                    raise Overloaded(f"Tenant {tenant} already has {self.settings['max_queued_calls_per_tenant']} model calls waiting")
+                # The tenant's calls are spaced by 1 / weight in virtual time
+                start = max(self.virtual_time[provider], self.finish_times[provider, tenant])
+                finish = start + 1 / self.weight(tenant)
+                self.finish_times[provider, tenant] = finish
+                ticket = Ticket(tenant)
+                heapq.heappush(self.queues[provider], (priority, finish, next(self.sequence), ticket))
+                self.queued[tenant] += 1
+
+        if ticket is not None and not ticket.granted.wait(self.settings['queue_timeout']):
+            with self.lock:
+                # The slot may have been granted just after the timeout
+                if not ticket.granted.is_set():
+                    ticket.cancelled = True
+                    self.queued[tenant] -= 1
+                    raise Overloaded(f"The call waited more than {self.settings['queue_timeout']} seconds for {provider}")
+
+        try:
+            return fn()
+        finally:
+            self.release(provider)
+
+    def release(self, provider):
+        """
+        Hands a finished call's slot to the next waiting call of the provider.
+
+        Args:
+            provider (str): The provider of the finished call.
+        """
+        with self.lock:
+            queue = self.queues[provider]
+            while queue:
+                _, finish, _, ticket = heapq.heappop(queue)
+                if ticket.cancelled:
+                    continue
+                self.virtual_time[provider] = finish
+                self.queued[ticket.tenant] -= 1
+                ticket.granted.set()
+                return
+            self.running[provider] -= 1
+
+    def snapshot(self):
+        """
+        Describes the current load.
+
+        Returns:
+            dict: The calls running and waiting per provider, and the runs and waiting calls per tenant.
+        """
+        with self.lock:
+            return {
+                "running_calls": {provider: count for provider, count in self.running.items() if count},
+                "queued_calls": {provider: sum(not ticket.cancelled for *_, ticket in queue) for provider, queue in self.queues.items() if queue},
+                "runs": {tenant: count for tenant, count in self.runs.items() if count},
+                "queued_calls_per_tenant": {tenant: count for tenant, count in self.queued.items() if count},
+            }
+
+    def node_priority(self, name, state):
+        """
+        Decides the priority of the model calls a graph node makes.
+
+        Args:
+            name (str): The name of the node.
+            state (GraphState): The state the node runs on.
+
+        Returns:
+            int: CRITICAL for the nodes of the critical_nodes setting, FIRST_THREAD for the work on
+                a run's first thread, and EXTRA_THREAD for the work on its other threads.
+        """
+        if name in self.settings['critical_nodes']:
+            return CRITICAL
+        responses = state.get("responses") or []
+        if state.get("start") or len(responses) < state.get("threads", 0):
+            # An initial response, not yet in the list of responses
+            thread = len(responses)
+        else:
+            thread = state.get("index", 0)
+        return FIRST_THREAD if thread == 0 else EXTRA_THREAD
+
+    def prioritized(self, name, node):
+        """
+        Wraps a graph node so that its model calls are queued with the node's priority.
+
+        A call rejected as overloaded marks the run as timed out, so it goes on to its final
+        summary with the responses it already has, like a run that hit its deadline.
+
+        Args:
+            name (str): The name of the node.
+            node (callable): The graph node.
+
+        Returns:
+            callable: The wrapped node.
+        """
+        def wrapped(state):
+            token = current_priority.set(self.node_priority(name, state))
+            try:
+                return node(state)
+            except Overloaded:
+                # Like a deadline, overload cuts the run short instead of discarding what it already spent
+                return {"timed_out": True, "stats": {"overload_rejections": 1}}
+            finally:
+                current_priority.reset(token)
+
+        return wrapped
+
+    def model_class(self, chat_model_class):
+        """
+        Makes a chat model class whose calls go through the scheduler.
+
+        Args:
+            chat_model_class: The chat model class of a provider.
+
+        Returns:
+            The class itself when scheduling is off, a subclass that queues its calls otherwise.
+        """
+        if not self.enabled:
+            return chat_model_class
+        if chat_model_class not in self.classes:
+            self.classes[chat_model_class] = type(
+                f"Scheduled{chat_model_class.__name__}",
+                (ScheduledChatModel, chat_model_class),
+                {"__annotations__": {"scheduler": ClassVar[Scheduler]}, "scheduler": self},
+            )
+        return self.classes[chat_model_class]
+
+
+class ScheduledChatModel:
+    """Mixin that queues the calls of a chat model in its class's scheduler, per provider."""
+
+    scheduler: ClassVar[Scheduler]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self.scheduler.call(
+            self._llm_type, lambda: super(ScheduledChatModel, self)._generate(messages, stop, run_manager, **kwargs)
+        )
+
+
+def speculative(fn):
+    """
+    Marks a call as speculative work (e.g. a hedged backup request), queued after all other calls.
+
+    Args:
+        fn (callable): Makes the call, without arguments.
+
+    Returns:
+        callable: The call, made with the speculative priority.
+    """
+    def wrapped():
+        token = current_priority.set(SPECULATIVE)
+        try:
+            return fn()
+        finally:
+            current_priority.reset(token)
+
+    return wrapped
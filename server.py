@@ -0,0 +1,298 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from models import config, scheduler
+from scheduler import Overloaded
+from test_time_compute import run_question
+
+settings = config['server']
+
+
+class Job:
+    """A question submitted to the server, with the progress updates of its run."""
+
+    def __init__(self, question, initial_state, tenant):
+        self.id = uuid.uuid4().hex
+        self.question = question
+        self.initial_state = initial_state
+        self.tenant = tenant
+        self.status = "queued"
+        self.submitted = time.time()
+        self.finished = None
+        self.updates = []
+        self.result = None
+        self.error = None
+        self.changed = threading.Condition()
+
+    def publish(self, update):
+        """
+        Adds a progress update and wakes up the streams following the job.
+
+        Args:
+            update (dict): The progress update.
+        """
+        with self.changed:
+            self.updates.append(update)
+            self.changed.notify_all()
+
+    def finish(self, status, result=None, error=None):
+        """
+        Marks the job as finished.
+
+        Args:
+            status (str): "done" or "failed".
+            result (dict | None): The result of the run.
+            error (str | None): The error that failed the run.
+        """
+        with self.changed:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            self.changed.notify_all()
+
+    def follow(self, keepalive):
+        """
+        Yields every progress update of the job, waiting for new ones until it finishes.
+
+        Args:
+            keepalive (float): The longest time to wait before yielding None, so the stream can be kept alive.
+
+        Yields:
+            dict | None: The next progress update, or None after `keepalive` seconds without one.
+        """
+        sent = 0
+        while True:
+            with self.changed:
+                if sent == len(self.updates) and self.finished is None:
+                    self.changed.wait(keepalive)
+                pending = self.updates[sent:]
+                done = self.finished is not None
+            for update in pending:
+                yield update
+            sent += len(pending)
+            if done and sent == len(self.updates):
+                return
+            if not pending:
+                yield None
+
+    def summary(self):
+        """
+        Describes the job and, once finished, its result.
+
+        Returns:
+            dict: The id, question, tenant, status, timings and result of the job.
+        """
+        return {
+            "id": self.id,
+            "question": self.question,
+            "tenant": self.tenant,
+            "status": self.status,
+            "submitted": self.submitted,
+            "finished": self.finished,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+jobs = {}
+jobs_lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=settings['max_concurrent_runs'])
+
+
+def run_job(job):
+    """
+    Runs a job's question through the shared graph.
+
+    Args:
+        job (Job): The job to run.
+    """
+    job.status = "running"
+    try:
+        result = run_question(job.question, job.publish, job.initial_state, log_name=f"reasoning_log_{job.id}.txt", tenant=job.tenant)
+        job.finish("done", result=result)
+    except Exception as e:
+        job.publish({"event": "error", "message": f"{type(e).__name__}: {e}"})
+        job.finish("failed", error=f"{type(e).__name__}: {e}")
+    finally:
+        scheduler.finish(job.tenant)
+
+
+def submit(question, initial_state, tenant=None):
+    """
+    Queues a question, forgetting the oldest finished jobs beyond `max_jobs_kept`.
+
+    Args:
+        question (str): The question to answer.
+        initial_state (dict): Extra initial state, e.g. a token_budget, cost_budget or deadline.
+        tenant (str | None): The tenant submitting the question, None for the default tenant.
+
+    Returns:
+        Job: The queued job.
+
+    Raises:
+        Overloaded: If the tenant, or the server, already has the most questions queued or running.
+    """
+    job = Job(question, initial_state, scheduler.admit(tenant))
+    with jobs_lock:
+        finished = sorted((j for j in jobs.values() if j.finished is not None), key=lambda j: j.finished)
+        for old in finished[:max(len(jobs) + 1 - settings['max_jobs_kept'], 0)]:
+            del jobs[old.id]
+        jobs[job.id] = job
+    executor.submit(run_job, job)
+    return job
+
+
+def parse_submission(body):
+    """
+    Validates the body of a question submission.
+
+    Args:
+        body (dict): The JSON body, with a "question" and optionally a "token_budget",
+            "cost_budget", "deadline_seconds" and "tenant".
+
+    Returns:
+        Tuple[str, dict, str | None]: The question, the extra initial state of its run, and its tenant.
+
+    Raises:
+        ValueError: If the body is not a valid submission.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("question"), str) or not body["question"].strip():
+        raise ValueError("The body must be a JSON object with a non-empty 'question'")
+
+    initial_state = {}
+    for key in ("token_budget", "cost_budget", "deadline_seconds"):
+        value = body.get(key)
+        if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError(f"'{key}' must be a positive number")
+    if body.get("token_budget"):
+        initial_state["token_budget"] = int(body["token_budget"])
+    if body.get("cost_budget"):
+        initial_state["cost_budget"] = float(body["cost_budget"])
+    if body.get("deadline_seconds"):
+        initial_state["deadline"] = time.time() + body["deadline_seconds"]
+    tenant = body.get("tenant")
+    if tenant is not None and (not isinstance(tenant, str) or not tenant.strip()):
+        raise ValueError("'tenant' must be a non-empty string")
+    return body["question"].strip(), initial_state, tenant and tenant.strip()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the question endpoints:
+
+    - POST /questions submits a question and returns its job id.
+    - GET /questions/{id} returns the status and, once finished, the result of a job.
+    - GET /questions/{id}/events streams the progress of a job as server-sent events.
+    - GET /health reports the number of jobs by status.
+    """
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/questions":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            question, initial_state, tenant = parse_submission(json.loads(self.rfile.read(length) or b"null"))
+        except (ValueError, json.JSONDecodeError) as e:
+            return self.send_json(400, {"error": str(e)})
+
+        try:
+            job = submit(question, initial_state, tenant)
+        except Overloaded as e:
+            # Rejected at once, so the client can retry later or elsewhere
+            return self.send_json(429, {"error": str(e)})
+        self.send_json(202, {"id": job.id, "status": job.status})
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["health"]:
+            with jobs_lock:
+                statuses = [job.status for job in jobs.values()]
+            health = {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+            if scheduler.enabled:
+                health["scheduler"] = scheduler.snapshot()
+            return self.send_json(200, health)
+
+        if len(parts) not in (2, 3) or parts[0] != "questions" or (len(parts) == 3 and parts[2] != "events"):
+            return self.send_json(404, {"error": "Not found"})
+        with jobs_lock:
+            job = jobs.get(parts[1])
+        if job is None:
+            return self.send_json(404, {"error": f"Unknown question id {parts[1]}"})
+
+        if len(parts) == 2:
+            return self.send_json(200, job.summary())
+        self.stream_events(job)
+
+    def stream_events(self, job):
+        """
+        Streams the progress updates of a job as server-sent events, ending with its result.
+
+        Args:
+            job (Job): The job to follow.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for update in job.follow(settings['keepalive_seconds']):
+                if update is None:
+                    self.wfile.write(b": keep-alive\n\n")
+                else:
+                    self.wfile.write(f"event: {update['event']}\ndata: {json.dumps(update)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(f"event: end\ndata: {json.dumps(job.summary())}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_json(self, status, body):
+        """
+        Sends a JSON response.
+
+        Args:
+            status (int): The HTTP status code.
+            body (dict): The response body.
+        """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if settings['access_log']:
+            super().log_message(format, *args)
+
+
+def main():
+    """
+    Command-line entry point: serves questions over HTTP until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Serve the test-time compute pipeline over HTTP.")
+    parser.add_argument("--host", default=settings['host'])
+    parser.add_argument("--port", type=int, default=settings['port'])
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.daemon_threads = True
+    print(f"Serving on http://{args.host}:{args.port} with up to {settings['max_concurrent_runs']} concurrent runs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+import argparse
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+import yaml
+
+
+def load_traces(path):
+    """
+    Loads the traces of past runs from a JSON lines file.
+
+    Args:
+        path (str): The trace file written by the main program.
+
+    Returns:
+        list[dict]: The traces, skipping runs that never scored a response.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        traces = [json.loads(line) for line in f if line.strip()]
+    return [trace for trace in traces if trace["steps"]]
+
+
+def padded(rows, fill=0.0):
+    """
+    Stacks rows of different lengths into one array, padding the short ones.
+
+    Args:
+        rows (list[list[float]]): The rows, none of them empty.
+        fill (float): The padding value.
+
+    Returns:
+        np.ndarray: An array of shape (len(rows), longest row).
+    """
+    array = np.full((len(rows), max(len(row) for row in rows)), fill, dtype=float)
+    for i, row in enumerate(rows):
+        array[i, :len(row)] = row
+    return array
+
+
+def overhead_mean(trace, node, field):
+    """
+    Averages the seconds or tokens a trace spent on one overhead node.
+
+    Args:
+        trace (dict): The trace of a run.
+        node (str): "difficulty_assessment", "check_done" or "final_summary".
+        field (str): "seconds" or "tokens".
+
+    Returns:
+        float: The mean over the node's calls, 0 if it was never called.
+    """
+    values = [entry[field] for entry in trace["overhead"] if entry["node"] == node]
+    return float(np.mean(values)) if values else 0.0
+
+
+def build_arrays(traces):
+    """
+    Converts traces into the arrays the simulator works on, one row per question.
+
+    Initial responses keep their recorded score. Revisions are kept as the change in
+    score they made to the response they revised, so they can be replayed on top of
+    any parent. A question without recorded revisions gets a single revision that
+    changes nothing and costs as much as an average initial response.
+
+    Args:
+        traces (list[dict]): The traces of past runs.
+
+    Returns:
+        dict: The padded arrays and the number of valid entries in each row.
+    """
+    initial = [[step for step in trace["steps"] if step["previous_score"] is None] for trace in traces]
+    revised = [[step for step in trace["steps"] if step["previous_score"] is not None] for trace in traces]
+
+    for i, steps in enumerate(revised):
+        if not steps:
+            revised[i] = [{
+                "score": 0.0,
+                "previous_score": 0.0,
+                "seconds": float(np.mean([step["seconds"] for step in initial[i]])),
+                "tokens": float(np.mean([step["tokens"] for step in initial[i]])),
+            }]
+
+    arrays = {
+        "initial_score": padded([[step["score"] for step in steps] for steps in initial]),
+        "initial_seconds": padded([[step["seconds"] for step in steps] for steps in initial]),
+        "initial_tokens": padded([[step["tokens"] for step in steps] for steps in initial]),
+        "initial_count": np.array([len(steps) for steps in initial]),
+        "revision_delta": padded([[step["score"] - step["previous_score"] for step in steps] for steps in revised]),
+        "revision_seconds": padded([[step["seconds"] for step in steps] for steps in revised]),
+        "revision_tokens": padded([[step["tokens"] for step in steps] for steps in revised]),
+        "revision_count": np.array([len(steps) for steps in revised]),
+    }
+    for node in ("difficulty_assessment", "check_done", "final_summary"):
+        for field in ("seconds", "tokens"):
+            arrays[f"{node}_{field}"] = np.array([overhead_mean(trace, node, field) for trace in traces])
+
+    arrays["recorded_best"] = np.array([max(step["score"] for step in trace["steps"]) for trace in traces])
+    arrays["recorded_tokens"] = np.array(
+        [sum(step["tokens"] for step in trace["steps"]) + sum(entry["tokens"] for entry in trace["overhead"]) for trace in traces],
+        dtype=float
+    )
+    arrays["recorded_seconds"] = np.array([trace["seconds"] for trace in traces], dtype=float)
+    return arrays
+
+
+def cycle(array, count, offset, slots):
+    """
+    Picks `slots` entries from every row, cycling through the valid entries starting at `offset`.
+
+    Args:
+        array (np.ndarray): A padded array of shape (questions, entries).
+        count (np.ndarray): The number of valid entries in each row.
+        offset (int): The position of the first entry to pick.
+        slots (int): The number of entries to pick.
+
+    Returns:
+        np.ndarray: An array of shape (questions, slots).
+    """
+    index = (offset + np.arange(slots))[None, :] % count[:, None]
+    return np.take_along_axis(array, index, axis=1)
+
+
+def select_parents(scores, beams, threads, variant, rng):
+    """
+    Picks the response every thread revises next, like `beam_search_agent`.
+
+    Args:
+        scores (np.ndarray): The current score of every thread, shape (questions, threads).
+        beams (int): The number of responses kept.
+        threads (int): The number of threads of the next round.
+        variant (str): "top_k" keeps the best `beams` responses and replicates them over the threads,
+            as `beam_search_agent` does. "resample" draws every thread's parent with probability
+            proportional to its score.
+        rng (np.random.Generator): The random generator for "resample".
+
+    Returns:
+        np.ndarray: The score of every thread's parent, shape (questions, threads).
+    """
+    if variant == "top_k":
+        best = np.argsort(-scores, axis=1, kind="stable")[:, :beams]
+        parents = np.take_along_axis(scores, best, axis=1)
+        return parents[:, np.arange(threads) % parents.shape[1]]
+
+    if variant == "resample":
+        weights = np.cumsum(scores, axis=1)
+        draws = rng.random((scores.shape[0], threads)) * weights[:, -1:]
+        index = (weights[:, None, :] <= draws[:, :, None]).sum(axis=2)
+        return np.take_along_axis(scores, np.minimum(index, scores.shape[1] - 1), axis=1)
+
+    raise ValueError(f"Unknown beam variant: {variant}")
+
+
+def simulate(arrays, policy, seed=0):
+    """
+    Replays every recorded question through a policy.
+
+    A run generates `threads` initial responses (reusing the recorded ones in turn),
+    then, for up to `revisions` rounds, picks parents like `beam_search_agent` and
+    applies recorded revision score changes to them (clipped to 1-10). Every round but
+    the last is followed by check_done, and the stopping rule decides whether the
+    question goes on. Tokens and seconds add up the recorded cost of every step, since
+    the graph runs its steps one after the other.
+
+    Args:
+        arrays (dict): The arrays built by `build_arrays`.
+        policy (dict): The threads, beams, revisions, beam variant and stopping rule to simulate.
+        seed (int): The seed of the random generator used by the "resample" variant.
+
+    Returns:
+        dict: The final best score, tokens, seconds and rounds of every question.
+    """
+    rng = np.random.default_rng(seed)
+    threads, beams, revisions = policy["threads"], policy["beams"], policy["revisions"]
+    stop = policy["stop"]
+
+    scores = cycle(arrays["initial_score"], arrays["initial_count"], 0, threads)
+    tokens = cycle(arrays["initial_tokens"], arrays["initial_count"], 0, threads).sum(axis=1)
+    seconds = cycle(arrays["initial_seconds"], arrays["initial_count"], 0, threads).sum(axis=1)
+    if revisions > 0:
+        tokens = tokens + arrays["difficulty_assessment_tokens"]
+        seconds = seconds + arrays["difficulty_assessment_seconds"]
+
+    active = np.ones(scores.shape[0], dtype=bool)
+    rounds = np.zeros(scores.shape[0], dtype=int)
+    best = scores.max(axis=1)
+
+    for r in range(revisions):
+        if r > 0:
+            tokens = tokens + active * arrays["check_done_tokens"]
+            seconds = seconds + active * arrays["check_done_seconds"]
+
+        parents = select_parents(scores, beams, threads, policy["beam_variant"], rng)
+        delta = cycle(arrays["revision_delta"], arrays["revision_count"], r * threads, threads)
+        revised = np.clip(parents + delta, 1, 10)
+        scores = np.where(active[:, None], revised, scores)
+
+        tokens = tokens + active * cycle(arrays["revision_tokens"], arrays["revision_count"], r * threads, threads).sum(axis=1)
+        seconds = seconds + active * cycle(arrays["revision_seconds"], arrays["revision_count"], r * threads, threads).sum(axis=1)
+        rounds = rounds + active
+
+        previous_best, best = best, scores.max(axis=1)
+        if stop["rule"] == "threshold":
+            active &= best < stop["score"]
+        elif stop["rule"] == "plateau":
+            active &= best - previous_best >= stop["delta"]
+        elif stop["rule"] == "tokens":
+            active &= tokens < stop["max_tokens"]
+        elif stop["rule"] != "fixed":
+            raise ValueError(f"Unknown stopping rule: {stop['rule']}")
+
+    return {
+        "best_score": best,
+        "tokens": tokens + arrays["final_summary_tokens"],
+        "seconds": seconds + arrays["final_summary_seconds"],
+        "rounds": rounds,
+    }
+
+
+def policy_name(policy):
+    """
+    Describes a policy in one short line.
+
+    Args:
+        policy (dict): The policy.
+
+    Returns:
+        str: The description, e.g. "4t/2b/3r top_k threshold(score=9)".
+    """
+    stop = policy["stop"]
+    params = ",".join(f"{key}={value}" for key, value in stop.items() if key != "rule")
+    rule = f"{stop['rule']}({params})" if params else stop["rule"]
+    return f"{policy['threads']}t/{policy['beams']}b/{policy['revisions']}r {policy['beam_variant']} {rule}"
+
+
+def policy_grid(settings):
+    """
+    Lists every combination of the policy settings to simulate.
+
+    Args:
+        settings (dict): The `simulator` section of the config.
+
+    Returns:
+        list[dict]: The policies, skipping those with more beams than threads and
+            stopping rules or variants that make no difference without revisions.
+    """
+    policies = []
+    for threads, beams, revisions, variant, stop in itertools.product(
+        settings['threads'], settings['beams'], settings['revisions'],
+        settings['beam_variants'], settings['stopping_rules']
+    ):
+        if beams > threads:
+            continue
+        if revisions == 0 and (stop['rule'] != 'fixed' or variant != settings['beam_variants'][0] or beams > 1):
+            continue
+        policies.append({"threads": threads, "beams": beams, "revisions": revisions, "beam_variant": variant, "stop": stop})
+    return policies
+
+
+def summarize(name, result):
+    """
+    Averages the simulated outcome of a policy over the questions.
+
+    Args:
+        name (str): The name of the policy.
+        result (dict): The outcome of every question.
+
+    Returns:
+        dict: The mean best score, tokens, seconds and rounds, and the 95th percentile of seconds.
+    """
+    return {
+        "policy": name,
+        "best_score": float(result["best_score"].mean()),
+        "tokens": float(result["tokens"].mean()),
+        "seconds": float(result["seconds"].mean()),
+        "p95_seconds": float(np.percentile(result["seconds"], 95)),
+        "rounds": float(result["rounds"].mean()),
+    }
+
+
+def pareto_front(rows):
+    """
+    Marks the policies no other policy beats on score without spending more tokens.
+
+    Args:
+        rows (list[dict]): The summaries of the policies.
+
+    Returns:
+        list[dict]: The same summaries, with a "pareto" flag.
+    """
+    for row in rows:
+        row["pareto"] = not any(
+            other["best_score"] >= row["best_score"] and other["tokens"] <= row["tokens"]
+            and (other["best_score"] > row["best_score"] or other["tokens"] < row["tokens"])
+            for other in rows
+        )
+    return rows
+
+
+def main():
+    """
+    Command-line entry point: simulates the policy grid over the recorded traces and prints the best policies.
+    """
+    with open(os.getenv("TTC_CONFIG", "config.yaml"), 'r') as file:
+        settings = yaml.safe_load(file)['simulator']
+
+    parser = argparse.ArgumentParser(description="Replay recorded runs through alternative test-time compute policies.")
+    parser.add_argument("--traces", default=settings['traces'], help="The trace file to replay.")
+    parser.add_argument("--top", type=int, default=settings['top'], help="The number of policies to print.")
+    parser.add_argument("--json", help="Also write every policy's results to this file.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.traces):
+        print(f"No traces in {args.traces}: set enabled to true in the traces section of the config, and ask some questions first.")
+        return
+
+    traces = load_traces(args.traces)
+    if not traces:
+        print(f"No traces with scored responses in {args.traces}.")
+        return
+
+    # Simulate every policy over all questions at once
+    started = time.time()
+    arrays = build_arrays(traces)
+    policies = policy_grid(settings)
+    rows = pareto_front([summarize(policy_name(policy), simulate(arrays, policy, settings['seed'])) for policy in policies])
+    elapsed = time.time() - started
+
+    rows.sort(key=lambda row: (-row["best_score"], row["tokens"]))
+    print(f"Simulated {len(policies)} policies x {len(traces)} questions in {elapsed:.2f} seconds\n")
+    print(f"{'policy':<40} {'score':>6} {'tokens':>9} {'seconds':>8} {'p95 s':>8} {'rounds':>6}")
+    print(f"{'recorded runs':<40} {arrays['recorded_best'].mean():>6.2f} {arrays['recorded_tokens'].mean():>9.0f} "
+          f"{arrays['recorded_seconds'].mean():>8.1f} {np.percentile(arrays['recorded_seconds'], 95):>8.1f}")
+    for row in rows[:args.top]:
+        flag = " *" if row["pareto"] else ""
+        print(f"{row['policy']:<40} {row['best_score']:>6.2f} {row['tokens']:>9.0f} "
+              f"{row['seconds']:>8.1f} {row['p95_seconds']:>8.1f} {row['rounds']:>6.2f}{flag}")
+    print("\n* no other policy scores higher for fewer tokens")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
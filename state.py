@@ -4,6 +4,10 @@ from langchain_core.messages import (
 )
 import operator
 
+from langgraph.graph.message import add_messages
+
+from stats import merge_stats
+
 
 # Define the state with messages
 class GraphState(TypedDict):
@@ -16,12 +20,24 @@ class GraphState(TypedDict):
     start: bool
     done: bool
     final_response: str
+    confidence: float
     agent_response: dict
     index: int
     initial_response_agent: str
     revisions: int
+    sample_pool: dict
+    token_budget: int
+    cost_budget: float
+    deadline: float
+    timed_out: bool
+    compute_decisions: Annotated[list[dict], operator.add]
+    stats: Annotated[dict, merge_stats]
 
 class AgentState(TypedDict):
-  messages: Annotated[Sequence[BaseMessage], operator.add]
+  messages: Annotated[Sequence[BaseMessage], add_messages]
   sender: str
-  final_answer: str
\ No newline at end of file
+  final_answer: str
+  previous_response: str
+  tool_rounds: Annotated[int, operator.add]
+  deadline: float
+  stats: Annotated[dict, merge_stats]
\ No newline at end of file
@@ -0,0 +1,101 @@
+from budget import call_cost
+
+
+def merge_stats(left, right):
+    """
+    Merges two run stats dictionaries by summing their counters.
+
+    Used as the reducer for the `stats` field of the graph state, so every node
+    can return just the counters it changed.
+
+    Args:
+        left (dict): The stats accumulated so far.
+        right (dict): The stats reported by a node.
+
+    Returns:
+        dict: The combined stats.
+    """
+    merged = dict(left or {})
+    for key, value in (right or {}).items():
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def increment(stats, key, amount=1):
+    """
+    Increments a counter in a stats dictionary in place.
+
+    Args:
+        stats (dict): The stats dictionary to update.
+        key (str): The name of the counter.
+        amount (int | float): How much to add to the counter.
+    """
+    stats[key] = stats.get(key, 0) + amount
+
+
+def collect_stats(event_dict, run_stats):
+    """
+    Folds the stats reported in a streamed event into the stats of the run.
+
+    Args:
+        event_dict (dict): The current event data, keyed by node name.
+        run_stats (dict): The stats accumulated so far for the run.
+
+    Returns:
+        dict: The updated stats for the run.
+    """
+    for update in event_dict.values():
+        if isinstance(update, dict) and update.get("stats"):
+            run_stats = merge_stats(run_stats, update["stats"])
+    return run_stats
+
+
+def format_stats(stats):
+    """
+    Formats run stats as one `key: value` line per counter.
+
+    Args:
+        stats (dict): The stats to format.
+
+    Returns:
+        str: The formatted stats.
+    """
+    lines = []
+    for key in sorted(stats):
+        value = stats[key]
+        if isinstance(value, float):
+            value = round(value, 6)
+        lines.append(f"{key}: {value}")
+    return "\n".join(lines)
+
+
+def usage_stats(message, role):
+    """
+    Reports the token usage of a single model call, including input tokens served from the provider's prompt cache.
+
+    Args:
+        message: The message returned by the model.
+        role (str): The agent role that made the call.
+
+    Returns:
+        dict: The stats of the call.
+    """
+    # Extra candidates sampled in the same request were already counted with the first one
+    if getattr(message, "response_metadata", {}).get("shared_request"):
+        return {}
+
+    stats = {"llm_calls": 1, f"{role}_calls": 1}
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return stats
+
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    stats.update({
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "cached_input_tokens": cached,
+        f"{role}_input_tokens": usage.get("input_tokens", 0),
+        f"{role}_cached_input_tokens": cached,
+        "cost": call_cost(message),
+    })
+    return stats
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+# Reference answers by question, registered by the benchmark so stub answers can be right or wrong
+reference_answers = {}
+QUESTION_PATTERN = re.compile(r"Here is the question: (.*?) \n", re.DOTALL)
+STEP_PATTERN = re.compile(r"\[Step (\d+)\]")
+
+
+def register_reference_answers(answers):
+    """
+    Registers the reference answers the stub models answer from.
+
+    Args:
+        answers (dict): The reference answer of every question.
+    """
+    reference_answers.update(answers)
+
+
+def configure_stub_models(llm_mapping, settings):
+    """
+    Applies the stub section of the config to the stub models, which read it only when they are built.
+
+    Args:
+        llm_mapping (dict): The language models of every role.
+        settings (dict): The stub section of the config.
+    """
+    for entry in llm_mapping.values():
+        for llm in entry.values() if isinstance(entry, dict) else [entry]:
+            if isinstance(llm, StubChatModel):
+                for key, value in settings.items():
+                    setattr(llm, key, value)
+
+
+def content_text(message):
+    """
+    Extracts the text of a message whose content is a string or a list of content blocks.
+
+    Args:
+        message: The message.
+
+    Returns:
+        str: The text of the message.
+    """
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(block.get("text", "") if isinstance(block, dict) else str(block) for block in message.content)
+
+
+def draw(*parts):
+    """
+    Draws a number in [0, 1) that is always the same for the same inputs.
+
+    Args:
+        *parts: The inputs the draw depends on.
+
+    Returns:
+        float: The draw.
+    """
+    digest = hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) / 0x100000000
+
+
+def call_id(*parts):
+    """
+    Makes a tool call id that is always the same for the same inputs.
+
+    Args:
+        *parts: The inputs the id depends on.
+
+    Returns:
+        str: The id.
+    """
+    return f"stub_{int(draw('id', *parts) * 10 ** 9)}"
+
+
+def wrong_answer(reference):
+    """
+    Makes up a wrong answer close to the reference.
+
+    Args:
+        reference (str): The reference answer.
+
+    Returns:
+        str: A different answer.
+    """
+    try:
+        return str(float(reference) + 1).removesuffix(".0")
+    except ValueError:
+        return f"not {reference}"
+
+
+class StubChatModel(BaseChatModel):
+    """
+    A chat model that answers offline, for benchmarks and local development.
+
+    Replies are drawn deterministically from the prompt, so the same run always gives
+    the same result. Answers are right with probability `accuracy` when a reference
+    answer was registered for the question, and `carry_over` when the prompt already
+    contains the right answer (e.g. a revision of a right response). Structured outputs
+    are filled in from the bound tool's schema, and usage is estimated at four
+    characters per token. Revisions asked for edits replace the last step of the previous
+    response, pointing at a step that does not exist with probability `patch_error_rate`.
+    Structured done checks decide to stop with probability `done_rate`, or like any other
+    choice when it is not set.
+    """
+
+    model: str = "stub"
+    accuracy: float = 0.5
+    carry_over: float = 0.9
+    tool_rate: float = 0.0
+    patch_error_rate: float = 0.0
+    done_rate: Optional[float] = None
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        bound = {"tools": [convert_to_openai_tool(tool) for tool in tools], **kwargs}
+        if tool_choice:
+            bound["tool_choice"] = tool_choice
+        return self.bind(**bound)
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+
+        prompt = "\n".join(content_text(message) for message in messages)
+        tools = kwargs.get("tools") or []
+        generations = []
+        for candidate in range(kwargs.get("n", 1)):
+            if tools and kwargs.get("tool_choice"):
+                message = self._structured_reply(prompt, tools[0]["function"], candidate)
+            else:
+                message = self._reply(prompt, messages, tools, candidate)
+            message.usage_metadata = {
+                "input_tokens": len(prompt) // 4 if candidate == 0 else 0,
+                "output_tokens": len(content_text(message) + json.dumps(message.tool_calls)) // 4,
+                "total_tokens": 0,
+            }
+            message.usage_metadata["total_tokens"] = message.usage_metadata["input_tokens"] + message.usage_metadata["output_tokens"]
+            message.response_metadata = {"model_name": self.model}
+            generations.append(ChatGeneration(message=message))
+        return ChatResult(generations=generations)
+
+    def _reference(self, prompt):
+        match = QUESTION_PATTERN.search(prompt)
+        question = match.group(1).strip() if match else None
+        return question, reference_answers.get(question)
+
+    def _right(self, prompt, candidate):
+        question, reference = self._reference(prompt)
+        if reference is None:
+            return None
+        rest = prompt.replace(question, "")
+        chance = self.carry_over if re.search(rf"\b{re.escape(str(reference))}\b", rest) else self.accuracy
+        return draw(self.model, prompt, candidate) < chance
+
+    def _reply(self, prompt, messages, tools, candidate):
+        tool_names = [tool["function"]["name"] for tool in tools]
+        used_tools = any(isinstance(message, ToolMessage) for message in messages)
+        if "python_repl" in tool_names and not used_tools and draw("tool", self.model, prompt, candidate) < self.tool_rate:
+            return AIMessage(
+                content="",
+                tool_calls=[{"name": "python_repl", "args": {"__arg1": "print(6 * 7)"}, "id": call_id(prompt, candidate)}]
+            )
+
+        question, reference = self._reference(prompt)
+        right = self._right(prompt, candidate)
+        if right is None:
+            answer = str(int(draw("answer", self.model, prompt, candidate) * 100))
+        else:
+            answer = str(reference) if right else wrong_answer(str(reference))
+
+        steps = [int(step) for step in STEP_PATTERN.findall(prompt)]
+        if steps and "<replace step=" in prompt and "Write the complete revised answer instead" not in prompt:
+            step = max(steps) + 5 if draw("patch", self.model, prompt, candidate) < self.patch_error_rate else max(steps)
+            return AIMessage(content=f"<replace step=\"{step}\">The final answer is {answer}.</replace>")
+        return AIMessage(content=f"I worked through the question step by step.\n\nThe final answer is {answer}.")
+
+    def _structured_reply(self, prompt, function, candidate):
+        right = self._right(prompt, candidate)
+        args = {}
+        for name, field in function["parameters"].get("properties", {}).items():
+            value = draw(name, self.model, prompt, candidate)
+            # Optional fields are described as any of their type and null
+            field = next((option for option in field.get("anyOf", []) if option.get("type") != "null"), field)
+            if name == "confidence":
+                args[name] = round(0.4 + value * 0.6, 2)
+            elif "enum" in field and "PROCESS DONE" in field["enum"] and self.done_rate is not None:
+                args[name] = "PROCESS DONE" if value < self.done_rate else "CONTINUE"
+            elif "enum" in field:
+                args[name] = field["enum"][int(value * len(field["enum"]))]
+            elif field.get("type") == "integer":
+                args[name] = 1 + int(value * 3)
+            elif field.get("type") == "number":
+                low, high = (7, 10) if right else (2, 7)
+                args[name] = round(low + value * (high - low), 1)
+            else:
+                args[name] = "stub"
+        return AIMessage(content="", tool_calls=[{"name": function["name"], "args": args, "id": call_id(prompt, candidate)}])
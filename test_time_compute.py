@@ -1,18 +1,31 @@
 from typing import Literal
-from langchain_core.messages import HumanMessage
 from langgraph.graph import END, StateGraph, START
 import os
 import time
+from langchain_core.messages import HumanMessage
 
 from state import AgentState, GraphState
-from response_agents import answer_summary_node, initial_response_agents, revision_agents
+from response_agents import answer_summary_node, initial_response_agents, revision_agents, draw_agent_turn
 
+from models import config, provider_mapping, scheduler
+from prompting import question_message, reload_prompt
+from scheduler import current_tenant
 from tools import tool_node
+from compaction import compaction_node
+from patching import numbered_steps
+from stats import collect_stats, format_stats, merge_stats
+from budget import budget_exhausted, spend_report
+from deadline import out_of_time, stop_at_deadline, work_deadline
+from adaptive import reallocate_compute
+from cascade import cascade_report
+from hedging import AbandonedUsage, abandoned_usage, hedging_report
+from traces import TraceRecorder, append_trace
 from upper_agents import (
     ask_question, join_graph, get_info_for_initial_response,
     get_info_for_revision_response, difficulty_agent, commenter_agent,
-    scorer_agent, check_done_agent, final_summary_agent, beam_search_agent,
-    initial_response_handler, revised_response_handler
+    scorer_agent, judge_agent, check_done_agent, final_summary_agent, beam_search_agent,
+    initial_response_handler, revised_response_handler, sampling_key,
+    count_initial_responses_for_agent, count_identical_revisions
 )
 
 from prompt_toolkit.shortcuts import prompt
@@ -21,26 +34,67 @@ from prompt_toolkit.key_binding import KeyBindings
 
 # ROUTERS
 
-def router_tools(state) -> Literal["call_tool", "__end__"]:
+def router_tools(state) -> str:
     """
-    Determines whether a tool should be called or if the process should end based on the state.
+    Determines whether a tool should be called, the answer summarized, or if the process should end based on the state.
     
     Args:
         state (dict): The current state of the agent.
         
     Returns:
-        Literal["call_tool", "__end__"]: The next step in the workflow.
+        str: The next step in the workflow: "call_tool", "Summary", "__end__", or the agent itself
+            when it was asked for a full rewrite.
     """
     messages = state["messages"]
     last_message = messages[-1]
+
+    # The agent's edits did not apply, so it writes the whole answer again
+    if isinstance(last_message, HumanMessage):
+        return state["sender"]
     
     if last_message.tool_calls:
         return "call_tool"
+
+    # The agent's final message was already used as the answer
+    if state.get("final_answer") is not None:
+        return "__end__"
     
-    return "__end__"
+    return "Summary"
+
+
+def subgraph_start_router(state) -> str:
+    """
+    Starts a response or revision subgraph at its agent, or, when the agent's first turn was sampled in advance, routes that turn.
+
+    Args:
+        state (dict): The starting state of the agent.
+
+    Returns:
+        str: The name of the agent, or the step after the pre-sampled turn.
+    """
+    if len(state["messages"]) > 1:
+        return router_tools(state)
+
+    return state["sender"]
 
 
-def initial_response_router(state) -> Literal["get_initial_response", "difficulty_assessment", "beam_search_agent"]:
+def tool_return_router(state) -> str:
+    """
+    Determines whether the agent gets the tool outputs back or, once its tool round trips are used up, goes to the summary.
+
+    Args:
+        state (dict): The current state of the agent.
+
+    Returns:
+        str: The name of the agent that called the tools, or "Summary".
+    """
+    if state["tool_rounds"] > config['tool_execution']['max_tool_rounds']:
+        return "Summary"
+
+    return state["sender"]
+
+
+def initial_response_router(state) -> Literal["get_initial_response", "difficulty_assessment", "beam_search_agent", "summary"]:
     """
     Routes the workflow for the initial response generation.
 
@@ -48,21 +102,25 @@ def initial_response_router(state) -> Literal["get_initial_response", "difficult
         state (dict): The current state of the agent.
 
     Returns:
-        Literal["get_initial_response", "difficulty_assessment", "beam_search_agent"]: The next step.
+        Literal["get_initial_response", "difficulty_assessment", "beam_search_agent", "summary"]: The next step.
     """
     start = state["start"]
     responses = state["responses"]
     threads = state["threads"]
 
-    if len(responses) < threads:
+    if budget_exhausted(state) or out_of_time(state):
+        return "summary"
+    elif len(responses) < threads:
         return "get_initial_response"
     elif start:
         return "difficulty_assessment"
+    elif state["revisions"] == 0:
+        return "summary"
 
     return "beam_search_agent"
 
 
-def difficulty_router(state) -> Literal["get_initial_response", "beam_search_agent"]:
+def difficulty_router(state) -> Literal["get_initial_response", "beam_search_agent", "summary"]:
     """
     Routes the workflow for the difficulty assessment process.
 
@@ -70,13 +128,17 @@ def difficulty_router(state) -> Literal["get_initial_response", "beam_search_age
         state (dict): The current state of the agent.
 
     Returns:
-        Literal["get_initial_response", "beam_search_agent"]: The next step.
+        Literal["get_initial_response", "beam_search_agent", "summary"]: The next step.
     """
     responses = state["responses"]
     threads = state["threads"]
 
-    if len(responses) < threads:
+    if budget_exhausted(state) or out_of_time(state):
+        return "summary"
+    elif len(responses) < threads:
         return "get_initial_response"
+    elif state["revisions"] == 0:
+        return "summary"
 
     return "beam_search_agent"
 
@@ -96,15 +158,68 @@ def revision_router(state) -> Literal["check_done", "get_revision_response", "su
     revisions = state["revisions"]
     responses = state["responses"]
     
-    if len(responses[-1]["content"]) == revisions + 1:
+    if budget_exhausted(state) or out_of_time(state):
         return "summary"
     elif index == threads:
+        # After the last planned round, only the compute controller can extend the run
+        if len(responses[-1]["content"]) >= revisions + 1 and not config['adaptive_compute']['enabled']:
+            return "summary"
         return "check_done"
 
     return "get_revision_response"
 
 
-def scorer_router(state) -> Literal["initial_response_handler", "revised_response_handler"]:
+def reallocation_router(state) -> Literal["beam_search_agent", "summary"]:
+    """
+    Routes the workflow after the compute distribution was re-evaluated.
+
+    Args:
+        state (dict): The current state of the agent.
+
+    Returns:
+        Literal["beam_search_agent", "summary"]: The next step, the summary once every planned revision is done.
+    """
+    if len(state["responses"][-1]["content"]) >= state["revisions"] + 1:
+        return "summary"
+
+    return "beam_search_agent"
+
+
+def deadline_router(state) -> Literal["continue", "summary"]:
+    """
+    Routes the workflow to the final summary once a call has hit the deadline.
+
+    Args:
+        state (dict): The current state of the agent.
+
+    Returns:
+        Literal["continue", "summary"]: The next step.
+    """
+    if state.get("timed_out"):
+        return "summary"
+
+    return "continue"
+
+
+def judging_router(state) -> Literal["commenter", "judge", "summary"]:
+    """
+    Routes a new response to its judging, in the configured judging mode.
+
+    Args:
+        state (dict): The current state of the agent.
+
+    Returns:
+        Literal["commenter", "judge", "summary"]: The next step.
+    """
+    if state.get("timed_out"):
+        return "summary"
+    elif config['judging']['mode'] == 'fused':
+        return "judge"
+
+    return "commenter"
+
+
+def scorer_router(state) -> Literal["initial_response_handler", "revised_response_handler", "summary"]:
     """
     Routes the workflow for scoring the responses.
 
@@ -112,13 +227,15 @@ def scorer_router(state) -> Literal["initial_response_handler", "revised_respons
         state (dict): The current state of the agent.
 
     Returns:
-        Literal["initial_response_handler", "revised_response_handler"]: The next step.
+        Literal["initial_response_handler", "revised_response_handler", "summary"]: The next step.
     """
     start = state["start"]
     threads = state["threads"]
     responses = state["responses"]
 
-    if start or len(responses) < threads:
+    if state.get("timed_out"):
+        return "summary"
+    elif start or len(responses) < threads:
         return "initial_response_handler"
     
     return "revised_response_handler"
@@ -134,7 +251,7 @@ def done_router(state) -> Literal["continue", "__end__"]:
     Returns:
         Literal["continue", "__end__"]: The next step.
     """
-    if state["done"]:
+    if state.get("timed_out") or state.get("done"):
         return "__end__"
     
     return "continue"
@@ -147,8 +264,12 @@ initial_response_workflow = StateGraph(AgentState)
 
 # Add nodes to the initial response workflow
 initial_response_workflow.add_node("call_tool", tool_node)
+initial_response_workflow.add_node("compact_tools", compaction_node)
 initial_response_workflow.add_node("Summary", answer_summary_node)
 
+# Compact the tool outputs before they go back to the agent
+initial_response_workflow.add_edge("call_tool", "compact_tools")
+
 # Add all initial response agents to the workflow
 for name, node in initial_response_agents.items():
     initial_response_workflow.add_node(name, node)
@@ -157,24 +278,24 @@ for name, node in initial_response_agents.items():
     initial_response_workflow.add_conditional_edges(
         name,
         router_tools,
-        {"call_tool": "call_tool", "__end__": "Summary"},
+        {name: name, "call_tool": "call_tool", "Summary": "Summary", "__end__": END},
     )
 
 # Store agent names in a dictionary
 name_dict = {name: name for name in initial_response_agents.keys()}
 
-# Add conditional edges for tool invocation
+# Add conditional edges for the compacted tool outputs
 initial_response_workflow.add_conditional_edges(
-    "call_tool",
-    lambda x: x["sender"],
-    name_dict,
+    "compact_tools",
+    tool_return_router,
+    {**name_dict, "Summary": "Summary"},
 )
 
 # Add the starting edge to invoke the appropriate agent based on the sender
 initial_response_workflow.add_conditional_edges(
     START,
-    lambda x: x["sender"],
-    name_dict,
+    subgraph_start_router,
+    {**name_dict, "call_tool": "call_tool", "Summary": "Summary", "__end__": END},
 )
 
 # Add the final summary node and compile the graph
@@ -194,7 +315,7 @@ def enter_chain(message_and_agent):
     """
     message, agent = message_and_agent
     return {
-        "messages": [HumanMessage(content=message)],
+        "messages": [question_message(message, "", provider_mapping["response_agents"][agent])],
         "sender": agent,
     }
 
@@ -209,8 +330,12 @@ revision_workflow = StateGraph(AgentState)
 
 # Add nodes to the revision workflow
 revision_workflow.add_node("call_tool", tool_node)
+revision_workflow.add_node("compact_tools", compaction_node)
 revision_workflow.add_node("Summary", answer_summary_node)
 
+# Compact the tool outputs before they go back to the agent
+revision_workflow.add_edge("call_tool", "compact_tools")
+
 # Add all revision agents to the workflow
 for name, node in revision_agents.items():
     revision_workflow.add_node(name, node)
@@ -219,21 +344,21 @@ for name, node in revision_agents.items():
     revision_workflow.add_conditional_edges(
         name,
         router_tools,
-        {"call_tool": "call_tool", "__end__": "Summary"},
+        {name: name, "call_tool": "call_tool", "Summary": "Summary", "__end__": END},
     )
 
-# Add conditional edges for tool invocation
+# Add conditional edges for the compacted tool outputs
 revision_workflow.add_conditional_edges(
-    "call_tool",
-    lambda x: x["sender"],
-    name_dict,
+    "compact_tools",
+    tool_return_router,
+    {**name_dict, "Summary": "Summary"},
 )
 
 # Add the starting edge to invoke the appropriate agent based on the sender
 revision_workflow.add_conditional_edges(
     START,
-    lambda x: x["sender"],
-    name_dict,
+    subgraph_start_router,
+    {**name_dict, "call_tool": "call_tool", "Summary": "Summary", "__end__": END},
 )
 
 # Add the final summary node and compile the graph
@@ -252,11 +377,15 @@ def enter_chain_revision(question_and_agent_and_previous_response_and_comments):
         dict: The initial state for the workflow.
     """
     question, agent, previous_response, comments = question_and_agent_and_previous_response_and_comments
-    message = f"Here is the question: {question}\nHere is the previous response: {previous_response}\nHere are the comments: {comments}\n"
+    if config['revising']['mode'] == "patch":
+        message = f"Here is the previous response, split into numbered steps:\n{numbered_steps(previous_response)}\nHere are the comments: {comments}\n"
+    else:
+        message = f"Here is the previous response: {previous_response}\nHere are the comments: {comments}\n"
     
     return {
-        "messages": [HumanMessage(content=message)],
+        "messages": [question_message(question, message, provider_mapping["response_agents"][agent])],
         "sender": agent,
+        "previous_response": previous_response,
     }
 
 
@@ -264,49 +393,118 @@ def enter_chain_revision(question_and_agent_and_previous_response_and_comments):
 revision_chain = enter_chain_revision | graph_revision
 
 
+# BATCHED SAMPLING NODES
+
+def get_initial_response(state):
+    """
+    Generates an initial response, sampling the agent's first turn together with the other upcoming threads of the same agent.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        dict: The agent response, its stats and the updated pool of sampled turns.
+    """
+    question, agent = get_info_for_initial_response(state)
+    count = count_initial_responses_for_agent(state) if config['batched_sampling']['enabled'] else 1
+    start_state = {**enter_chain((question, agent)), "deadline": work_deadline(state)}
+
+    seeded, pool = draw_agent_turn(
+        "initial", agent, start_state,
+        sampling_key("initial", agent, question), count, state.get("sample_pool")
+    )
+    response = graph_initial.invoke(seeded or start_state)
+
+    return {**join_graph(response), "sample_pool": pool}
+
+
+def get_revision_response(state):
+    """
+    Generates a revised response, sampling the agent's first turn together with the replicated threads that share its input.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        dict: The agent response, its stats and the updated pool of sampled turns.
+    """
+    info = get_info_for_revision_response(state)
+    question, agent, previous_response, comments = info
+    count = count_identical_revisions(state) if config['batched_sampling']['enabled'] else 1
+    start_state = {**enter_chain_revision(info), "deadline": work_deadline(state)}
+
+    seeded, pool = draw_agent_turn(
+        "revision", agent, start_state,
+        sampling_key("revision", agent, question, previous_response, comments), count, state.get("sample_pool")
+    )
+    response = graph_revision.invoke(seeded or start_state)
+
+    return {**join_graph(response), "sample_pool": pool}
+
+
 # MAIN APPLICATION GRAPH
 
 graph = StateGraph(GraphState)
 
 # Add nodes to the main graph
 graph.add_node("ask_question", ask_question)
-graph.add_node("get_initial_response", get_info_for_initial_response | initial_response_chain | join_graph)
-graph.add_node("get_revision_response", get_info_for_revision_response | revision_chain | join_graph)
-graph.add_node("difficulty_assessment", difficulty_agent)
-graph.add_node("commenter", commenter_agent)
-graph.add_node("scorer", scorer_agent)
-graph.add_node("check_done", check_done_agent)
-graph.add_node("final_summary", final_summary_agent)
+# The model calls of every node are queued with the node's priority when scheduling is on
+graph.add_node("get_initial_response", stop_at_deadline(scheduler.prioritized("get_initial_response", get_initial_response)))
+graph.add_node("get_revision_response", stop_at_deadline(scheduler.prioritized("get_revision_response", get_revision_response)))
+graph.add_node("difficulty_assessment", stop_at_deadline(scheduler.prioritized("difficulty_assessment", difficulty_agent)))
+graph.add_node("commenter", stop_at_deadline(scheduler.prioritized("commenter", commenter_agent)))
+graph.add_node("scorer", stop_at_deadline(scheduler.prioritized("scorer", scorer_agent)))
+graph.add_node("judge", stop_at_deadline(scheduler.prioritized("judge", judge_agent)))
+graph.add_node("check_done", stop_at_deadline(scheduler.prioritized("check_done", check_done_agent)))
+graph.add_node("final_summary", scheduler.prioritized("final_summary", final_summary_agent))
 graph.add_node("beam_search_agent", beam_search_agent)
+graph.add_node("reallocate_compute", reallocate_compute)
 graph.add_node("initial_response_handler", initial_response_handler)
 graph.add_node("revised_response_handler", revised_response_handler)
 
 # Define edges for the main workflow
 graph.set_entry_point("ask_question")
 graph.add_edge("ask_question", "get_initial_response")
-graph.add_edge("get_initial_response", "commenter")
-graph.add_edge("commenter", "scorer")
+graph.add_conditional_edges(
+    "get_initial_response",
+    judging_router,
+    {"commenter": "commenter", "judge": "judge", "summary": "final_summary"},
+)
+graph.add_conditional_edges(
+    "commenter",
+    deadline_router,
+    {"continue": "scorer", "summary": "final_summary"},
+)
 
 # Define conditional edges for scoring and handling responses
 graph.add_conditional_edges(
     "scorer",
     scorer_router,
-    {"initial_response_handler": "initial_response_handler", "revised_response_handler": "revised_response_handler"},
+    {"initial_response_handler": "initial_response_handler", "revised_response_handler": "revised_response_handler", "summary": "final_summary"},
+)
+graph.add_conditional_edges(
+    "judge",
+    scorer_router,
+    {"initial_response_handler": "initial_response_handler", "revised_response_handler": "revised_response_handler", "summary": "final_summary"},
 )
 graph.add_conditional_edges(
     "initial_response_handler",
     initial_response_router,
-    {"get_initial_response": "get_initial_response", "difficulty_assessment": "difficulty_assessment", "beam_search_agent": "beam_search_agent"},
+    {"get_initial_response": "get_initial_response", "difficulty_assessment": "difficulty_assessment", "beam_search_agent": "beam_search_agent", "summary": "final_summary"},
 )
 graph.add_conditional_edges(
     "difficulty_assessment",
     difficulty_router,
-    {"get_initial_response": "get_initial_response", "beam_search_agent": "beam_search_agent"},
+    {"get_initial_response": "get_initial_response", "beam_search_agent": "beam_search_agent", "summary": "final_summary"},
 )
 
 # Handle the beam search and revision edges
 graph.add_edge("beam_search_agent", "get_revision_response")
-graph.add_edge("get_revision_response", "commenter")
+graph.add_conditional_edges(
+    "get_revision_response",
+    judging_router,
+    {"commenter": "commenter", "judge": "judge", "summary": "final_summary"},
+)
 
 # Add conditional edges for revisions and checking completion
 graph.add_conditional_edges(
@@ -317,7 +515,12 @@ graph.add_conditional_edges(
 graph.add_conditional_edges(
     "check_done",
     done_router,
-    {"continue": "beam_search_agent", "__end__": "final_summary"},
+    {"continue": "reallocate_compute", "__end__": "final_summary"},
+)
+graph.add_conditional_edges(
+    "reallocate_compute",
+    reallocation_router,
+    {"beam_search_agent": "beam_search_agent", "summary": "final_summary"},
 )
 
 # Final edge to end the process
@@ -342,6 +545,7 @@ def edit_prompt(agent_name):
         'response': 'Initial Response Agent',
         'reviser': 'Revision Agent',
         'scorer': 'Answer Scorer Agent',
+        'judge': 'Judge Agent',
         'summary': 'Summary Agent',
         'final_summary': 'Final Summary Agent',
         'check_done': 'Check Done Agent',
@@ -380,6 +584,7 @@ def edit_prompt(agent_name):
     with open(filename, 'w', encoding='utf-8') as f:
         f.write(edited_content)
 
+    reload_prompt(key)
     print(f'\nPrompt "{filename}" has been updated.')
 
 
@@ -405,7 +610,10 @@ def handle_event_logging(event_dict, log_file):
             log_file.write("Text:\n------------\n")
             log_file.write(f"{text}\n------------\n")
             log_file.write(f"Comments:\n{comments}\n")
-            log_file.write(f"Score: {score}\n\n")
+            log_file.write(f"Score: {score}\n")
+            if c.get('tool_tokens_saved'):
+                log_file.write(f"Tool output compaction saved about {c['tool_tokens_saved']} tokens of context\n")
+            log_file.write("\n")
     elif 'revised_response_handler' in event_dict:
         index = event_dict['revised_response_handler']['index']
         responses = event_dict['revised_response_handler']['responses']
@@ -421,12 +629,15 @@ def handle_event_logging(event_dict, log_file):
             log_file.write("Text:\n------------\n")
             log_file.write(f"{text}\n------------\n")
             log_file.write(f"Comments:\n{comments}\n")
-            log_file.write(f"Score: {score}\n\n")
+            log_file.write(f"Score: {score}\n")
+            if c.get('tool_tokens_saved'):
+                log_file.write(f"Tool output compaction saved about {c['tool_tokens_saved']} tokens of context\n")
+            log_file.write("\n")
     elif 'difficulty_assessment' in event_dict:
         difficulty = event_dict['difficulty_assessment']
         log_file.write("=== Difficulty Assessment ===\n")
         for key, value in difficulty.items():
-            if key != 'start':
+            if key not in ('start', 'stats'):
                 log_file.write(f"{key.capitalize()}: {value}\n")
         log_file.write("\n")
     elif 'beam_search_agent' in event_dict:
@@ -441,14 +652,183 @@ def handle_event_logging(event_dict, log_file):
         done = event_dict['check_done'].get('done', False)
         log_file.write("=== Check Done Result ===\n")
         log_file.write(f"Done: {done}\n\n")
+    elif event_dict.get('reallocate_compute'):
+        log_file.write("=== Compute Reallocation ===\n")
+        for decision in event_dict['reallocate_compute']['compute_decisions']:
+            log_file.write(f"Round: {decision['round']}\nBest score: {decision['best_score']}\n")
+            for change in decision['changes']:
+                log_file.write(f"- {change}\n")
+            log_file.write(
+                f"Threads: {decision['threads']}, Beams: {decision['beams']}, Revisions: {decision['revisions']}\n\n"
+            )
     elif 'final_summary' in event_dict:
         final_response = event_dict['final_summary']['final_response']
+        confidence = event_dict['final_summary'].get('confidence')
         log_file.write("=== Final Answer ===\n")
         log_file.write(f"{final_response}\n\n")
+        if confidence is not None:
+            log_file.write(f"Confidence: {confidence:.0%}\n\n")
+
+    # Report the token usage of the model calls made by this node
+    for node, update in event_dict.items():
+        stats = update.get("stats", {}) if isinstance(update, dict) else {}
+        if stats.get("llm_calls"):
+            log_file.write(
+                f"[{node}] {stats['llm_calls']} model call(s): {stats.get('input_tokens', 0)} input tokens "
+                f"({stats.get('cached_input_tokens', 0)} cached), {stats.get('output_tokens', 0)} output tokens\n\n"
+            )
+
+    log_file.flush()
+
 
+def log_run_stats(run_stats, run_budget, log_file):
+    """
+    Logs the stats accumulated over a run, and its spend against its budget, to a log file.
+
+    Args:
+        run_stats (dict): The stats accumulated over the run.
+        run_budget (dict): The token and cost budget of the run.
+        log_file (file object): The open log file to write to.
+    """
+    log_file.write("=== Run Stats ===\n")
+    log_file.write(f"{spend_report(run_stats, **run_budget)}\n")
+    if cascade_report(run_stats):
+        log_file.write(f"{cascade_report(run_stats)}\n")
+    if hedging_report(run_stats):
+        log_file.write(f"{hedging_report(run_stats)}\n")
+    log_file.write(f"{format_stats(run_stats)}\n\n")
     log_file.flush()
 
 
+def describe_event(event_dict):
+    """
+    Describes the progress a streamed event represents, as shown to the user.
+
+    Args:
+        event_dict (dict): The current event data.
+
+    Returns:
+        list[dict]: The progress updates, each with its kind ("event"), a "message" for the user,
+            and the data it is about.
+    """
+    updates = []
+    if 'ask_question' in event_dict:
+        updates.append({"event": "started", "message": "Generating initial responses..."})
+    elif 'initial_response_handler' in event_dict:
+        agent_name = event_dict['initial_response_handler']['responses'][-1]['agent_name']
+        updates.append({"event": "initial_response", "message": f"Created initial {agent_name} response", "agent": agent_name})
+    elif 'difficulty_assessment' in event_dict:
+        difficulty = event_dict['difficulty_assessment'].get('difficulty')
+        if difficulty is not None:
+            updates.append({"event": "difficulty", "message": f"Assessed difficulty: {difficulty}", "difficulty": difficulty})
+    elif 'revised_response_handler' in event_dict:
+        index = event_dict['revised_response_handler']['index']
+        agent_name = event_dict['revised_response_handler']['responses'][index - 1]['agent_name']
+        updates.append({"event": "revision", "message": f"Revised {agent_name} response", "agent": agent_name})
+    elif 'beam_search_agent' in event_dict:
+        updates.append({"event": "pruning", "message": "Pruning responses"})
+    elif 'check_done' in event_dict:
+        done = event_dict['check_done'].get('done')
+        if done is not None:
+            updates.append({"event": "done_decision", "message": "Decided to be done" if done else "Decided to continue", "done": done})
+    elif event_dict.get('reallocate_compute'):
+        for decision in event_dict['reallocate_compute']['compute_decisions']:
+            updates.append({"event": "reallocation", "message": "Reallocated compute: " + "; ".join(decision['changes']), **decision})
+    elif 'final_summary' in event_dict:
+        final_response = event_dict['final_summary']['final_response']
+        confidence = event_dict['final_summary'].get('confidence')
+        message = f"\nFinal Answer:\n {final_response}"
+        if confidence is not None:
+            message += f"\nConfidence: {confidence:.0%}"
+        updates.append({"event": "final_answer", "message": message, "final_response": final_response, "confidence": confidence})
+
+    for update in event_dict.values():
+        if isinstance(update, dict) and update.get('timed_out'):
+            if update.get('stats', {}).get('overload_rejections'):
+                updates.append({"event": "overloaded", "message": "The providers are overloaded, finishing with the best responses so far"})
+            else:
+                updates.append({"event": "deadline", "message": "Reached the deadline, finishing with the best responses so far"})
+
+    return updates
+
+
+def run_question(question, on_update=None, initial_state=None, log_name=None, tenant=None):
+    """
+    Runs a question through the shared compiled graph, logging it and reporting its progress.
+
+    Args:
+        question (str): The question to answer.
+        on_update (callable | None): Called with every progress update, see `describe_event`.
+        initial_state (dict | None): Extra initial state, e.g. a token_budget, cost_budget or deadline.
+        log_name (str | None): The name of the log file in the logs directory.
+        tenant (str | None): The tenant the question is answered for, whose share of the providers
+            its model calls are queued in when scheduling is on.
+
+    Returns:
+        dict: The final response, its confidence, and the stats and spend of the run.
+    """
+    on_update = on_update or (lambda update: None)
+    log_file_folder = 'logs'
+    log_file_path = log_name or f'reasoning_log_{int(time.time())}.txt'
+
+    if not os.path.exists(log_file_folder):
+        os.makedirs(log_file_folder, exist_ok=True)
+
+    final = {}
+    # Every model call of the run is made for its tenant, and its abandoned hedged calls are counted for it
+    tenant_token = current_tenant.set(tenant)
+    run_abandoned_usage = AbandonedUsage()
+    usage_token = abandoned_usage.set(run_abandoned_usage)
+    try:
+        with open(os.path.join(log_file_folder, log_file_path), 'w', encoding='utf-8') as log_file:
+            events = app.stream({**(initial_state or {}), "question": question}, {"recursion_limit": 1000})
+            run_stats = {}
+            run_budget = {}
+            trace = TraceRecorder(question)
+
+            for event in events:
+                event_dict = dict(event)
+                trace.record(event_dict)
+                if 'ask_question' in event_dict:
+                    run_budget = {
+                        "token_budget": event_dict['ask_question'].get('token_budget'),
+                        "cost_budget": event_dict['ask_question'].get('cost_budget'),
+                    }
+                elif 'final_summary' in event_dict:
+                    final = event_dict['final_summary']
+
+                for update in describe_event(event_dict):
+                    on_update(update)
+
+                handle_event_logging(event_dict, log_file)
+                run_stats = collect_stats(event_dict, run_stats)
+
+            # Abandoned calls that finished after the last call of the run
+            run_stats = merge_stats(run_stats, run_abandoned_usage.drain())
+            log_run_stats(run_stats, run_budget, log_file)
+    finally:
+        current_tenant.reset(tenant_token)
+        abandoned_usage.reset(usage_token)
+
+    spend = spend_report(run_stats, **run_budget)
+    on_update({"event": "spend", "message": spend})
+    if cascade_report(run_stats):
+        on_update({"event": "cascade", "message": cascade_report(run_stats)})
+    if hedging_report(run_stats):
+        on_update({"event": "hedging", "message": hedging_report(run_stats)})
+
+    # Record the run's trajectory so policies can be compared offline with simulator.py
+    if config['traces']['enabled']:
+        append_trace(trace.to_dict(), config['traces']['path'])
+
+    return {
+        "final_response": final.get('final_response'),
+        "confidence": final.get('confidence'),
+        "stats": run_stats,
+        "spend": spend,
+    }
+
+
 def main():
     """
     Main function that handles the command-line interface and runs the agents' workflows.
@@ -473,43 +853,7 @@ def main():
                 continue
             question = parts[1].strip()
 
-            app = graph.compile()
-
-            initial_state = {"question": question}
-
-            log_file_folder = 'logs'
-            log_file_path = f'reasoning_log_{int(time.time())}.txt'
-
-            if not os.path.exists(log_file_folder):
-                os.makedirs(log_file_folder)
-                
-            with open(os.path.join(log_file_folder, log_file_path), 'w', encoding='utf-8') as log_file:
-                events = app.stream(initial_state, {"recursion_limit": 1000})
-
-                for event in events:
-                    event_dict = dict(event)
-                    if 'ask_question' in event_dict:
-                        print("Generating initial responses...")
-                    elif 'initial_response_handler' in event_dict:
-                        agent_name = event_dict['initial_response_handler']['responses'][-1]['agent_name']
-                        print(f"Created initial {agent_name} response")
-                    elif 'difficulty_assessment' in event_dict:
-                        difficulty = event_dict['difficulty_assessment']['difficulty']
-                        print("Assessed difficulty:", difficulty)
-                    elif 'revised_response_handler' in event_dict:
-                        index = event_dict['revised_response_handler']['index']
-                        agent_name = event_dict['revised_response_handler']['responses'][index - 1]['agent_name']
-                        print(f"Revised {agent_name} response")
-                    elif 'beam_search_agent' in event_dict:
-                        print("Pruning responses")
-                    elif 'check_done' in event_dict:
-                        done = event_dict['check_done']['done']
-                        print("Decided to be done" if done else "Decided to continue")
-                    elif 'final_summary' in event_dict:
-                        final_response = event_dict['final_summary']['final_response']
-                        print("\nFinal Answer:\n", final_response)
-
-                    handle_event_logging(event_dict, log_file)
+            run_question(question, lambda update: print(update["message"]))
 
         elif user_input.lower().startswith('/edit'):
             parts = user_input.split(' ', 1)
@@ -524,4 +868,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules load their config and prompts relative to the repository root, and the tests run offline on the stub models
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("TTC_CONFIG", "config.stub.yaml")
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
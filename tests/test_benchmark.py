@@ -0,0 +1,22 @@
+import pytest
+
+from benchmark import check_overrides, import_time_overrides
+
+
+def test_import_time_overrides_are_found():
+    overrides = {
+        "llms": {"response_agents": []},
+        "scheduling": {"enabled": True, "max_runs": 3},
+        "cascade": {"scorer": {"enabled": True, "model": "stub-small"}},
+        "revising": {"mode": "patch"},
+    }
+    assert import_time_overrides(overrides) == ["llms", "scheduling.enabled", "cascade.scorer.model"]
+
+
+def test_runtime_overrides_are_accepted():
+    check_overrides("Variant patch", {"revising": {"mode": "patch"}, "cascade": {"scorer": {"enabled": True}}})
+
+
+def test_import_time_overrides_are_rejected():
+    with pytest.raises(ValueError, match="scheduling.enabled"):
+        check_overrides("Variant scheduled", {"scheduling": {"enabled": True}})
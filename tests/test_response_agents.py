@@ -0,0 +1,16 @@
+import copy
+
+from benchmark import apply_overrides, restore_config
+from models import config
+from test_time_compute import app
+
+
+def test_patch_mode_switched_at_runtime_produces_patches():
+    snapshot = copy.deepcopy(config)
+    apply_overrides(config, {"revising": {"mode": "patch"}})
+    try:
+        state = app.invoke({"question": "What is 17 * 23?"}, {"recursion_limit": 1000})
+    finally:
+        restore_config(config, snapshot)
+
+    assert state["stats"].get("revision_patches", 0) > 0
@@ -0,0 +1,19 @@
+import sys
+
+from langchain_core.messages import AIMessage
+
+from tools import tool_node
+
+
+def test_concurrent_repl_calls_keep_their_own_output():
+    stdout = sys.stdout
+    # Each command prints in two parts around a pause, so unserialized calls would capture each other's output
+    calls = [
+        {"name": "python_repl", "args": {"__arg1": f"import time\nprint({i}, end='')\ntime.sleep(0.02)\nprint()"}, "id": f"call_{i}", "type": "tool_call"}
+        for i in range(4)
+    ]
+
+    for _ in range(5):
+        update = tool_node({"messages": [AIMessage(content="", tool_calls=calls)], "tool_rounds": 0})
+        assert [message.content for message in update["messages"]] == [f"{i}\n" for i in range(4)]
+        assert sys.stdout is stdout
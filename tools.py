@@ -1,25 +1,33 @@
 from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
 from langchain.agents import Tool
 from langchain_experimental.utilities import PythonREPL
-from langgraph.prebuilt import ToolNode
+from langchain_core.messages import ToolMessage
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import threading
+import json
 import os
 from dotenv import load_dotenv
-import yaml
 
-# Load configuration from config.yaml
-with open('config.yaml', 'r') as f:
-    config = yaml.safe_load(f)
+from models import cassette, config
+from deadline import DeadlineExceeded, call_before_deadline
 
 load_dotenv()
 
 # Retrieve the TAVILY_API_KEY from the environment variables
 tavily_api_key = os.getenv("TAVILY_API_KEY")
+if cassette.mode == "replay":
+    # Replayed searches never reach Tavily, so its client only needs a placeholder key
+    tavily_api_key = tavily_api_key or "replay"
 
 # Initialize tools based on configuration
 tools = []
 for tool_cfg in config['tools']:
     if tool_cfg['name'] == 'TavilySearchResults':
-        tavily_tool = TavilySearchResults(max_results=tool_cfg.get('max_results', 5))
+        tavily_tool = TavilySearchResults(
+            max_results=tool_cfg.get('max_results', 5), api_wrapper=TavilySearchAPIWrapper(tavily_api_key=tavily_api_key)
+        )
         tools.append(tavily_tool)
     elif tool_cfg['name'] == 'PythonREPL':
         python_repl = PythonREPL()
@@ -38,5 +46,105 @@ for tool_cfg in config['tools']:
     else:
         raise ValueError(f"Unknown tool {tool_cfg['name']}")
 
-# Initialize a ToolNode with the list of tools
-tool_node = ToolNode(tools)
\ No newline at end of file
+tools_by_name = {tool.name: tool for tool in tools}
+
+# Limits how many tool calls run at once across every thread of every run in this process
+tool_settings = config['tool_execution']
+tool_semaphore = threading.BoundedSemaphore(tool_settings['max_concurrent_calls'])
+
+# Tools that are not safe to run concurrently make their calls one at a time. The Python REPL swaps the
+# process-wide sys.stdout to capture what a command prints, and all its commands share one globals dict.
+tool_locks = {"python_repl": threading.Lock()}
+
+
+def run_tool_call(call, deadline=None):
+    """
+    Runs a single tool call, turning any error into a message the agent can react to.
+
+    Args:
+        call (dict): The tool call issued by the agent.
+        deadline (float | None): The deadline the call must finish by.
+
+    Returns:
+        ToolMessage: The output of the tool.
+    """
+    tool = tools_by_name.get(call["name"])
+    if tool is None:
+        return ToolMessage(
+            content=f"Error: {call['name']} is not a valid tool, try one of [{', '.join(tools_by_name)}].",
+            name=call["name"],
+            tool_call_id=call["id"],
+            status="error",
+        )
+
+    def invoke():
+        # The tool's own lock is taken first, so calls waiting for it do not hold a slot of the semaphore
+        with tool_locks.get(call["name"], nullcontext()), tool_semaphore:
+            return cassette.tool_call(call["name"], call["args"], lambda: tool.invoke(call["args"]))
+
+    try:
+        output = call_before_deadline(invoke, deadline)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error: {repr(e)}\n Please fix your mistakes.",
+            name=call["name"],
+            tool_call_id=call["id"],
+            status="error",
+        )
+
+    content = output if isinstance(output, str) else json.dumps(output, default=str)
+    return ToolMessage(content=content, name=call["name"], tool_call_id=call["id"])
+
+
+def skipped_tool_call(call):
+    """
+    Answers a tool call that was not run because the round trip limit was reached.
+
+    Args:
+        call (dict): The tool call issued by the agent.
+
+    Returns:
+        ToolMessage: A message telling the agent the tool was not run.
+    """
+    return ToolMessage(
+        content="Tool call limit reached for this response, the tool was not run.",
+        name=call["name"],
+        tool_call_id=call["id"],
+        status="error",
+    )
+
+
+def tool_node(state):
+    """
+    Runs every tool call of the agent's last turn concurrently.
+
+    At most `parallelism` calls of a turn run at once, calls of the tools in `tool_locks` run
+    one at a time across every thread of the process, and once a thread has used
+    `max_tool_rounds` round trips its remaining calls are answered without running them.
+
+    Args:
+        state (dict): The current state of the agent.
+
+    Returns:
+        dict: The tool messages, in the order of the calls, and the updated round count.
+    """
+    tool_calls = state["messages"][-1].tool_calls
+    tool_rounds = state.get("tool_rounds", 0) + 1
+
+    if tool_rounds > tool_settings['max_tool_rounds']:
+        return {
+            "messages": [skipped_tool_call(call) for call in tool_calls],
+            "tool_rounds": 1,
+            "stats": {"tool_calls_skipped": len(tool_calls)},
+        }
+
+    with ThreadPoolExecutor(max_workers=min(tool_settings['parallelism'], len(tool_calls))) as executor:
+        tool_messages = list(executor.map(lambda call: run_tool_call(call, state.get("deadline")), tool_calls))
+
+    return {
+        "messages": tool_messages,
+        "tool_rounds": 1,
+        "stats": {"tool_calls": len(tool_calls), "tool_rounds": 1},
+    }
\ No newline at end of file
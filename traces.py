@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+from budget import spent_tokens
+from stats import collect_stats
+
+# Serializes appends from runs finishing at the same time
+trace_file_lock = threading.Lock()
+
+
+class TraceRecorder:
+    """
+    Records the score, latency and token trajectory of every thread of a run from its streamed events.
+
+    Each scored response becomes a step with its round, thread, score, the score of
+    the response it revised, and the seconds and tokens spent on it (response,
+    comments and score). Check_done, difficulty and final summary calls are recorded
+    as overhead.
+    """
+
+    def __init__(self, question):
+        self.question = question
+        self.started = time.time()
+        self.last_event = self.started
+        self.pending_stats = {}
+        self.pending_seconds = 0.0
+        self.difficulty = None
+        self.steps = []
+        self.overhead = []
+
+    def record(self, event_dict):
+        """
+        Records a streamed event.
+
+        Args:
+            event_dict (dict): The current event data.
+        """
+        now = time.time()
+        self.pending_seconds += now - self.last_event
+        self.last_event = now
+        self.pending_stats = collect_stats(event_dict, self.pending_stats)
+
+        if 'initial_response_handler' in event_dict:
+            responses = event_dict['initial_response_handler']['responses']
+            self._step(0, len(responses) - 1, responses[-1], None)
+        elif 'revised_response_handler' in event_dict:
+            update = event_dict['revised_response_handler']
+            index = update['index'] - 1
+            content = update['responses'][index]['content']
+            self._step(len(content) - 1, index, update['responses'][index], content[-2]['score'])
+        elif 'difficulty_assessment' in event_dict:
+            self.difficulty = event_dict['difficulty_assessment'].get('difficulty')
+            self._overhead('difficulty_assessment')
+        elif 'check_done' in event_dict:
+            self._overhead('check_done')
+        elif 'final_summary' in event_dict:
+            self._overhead('final_summary')
+
+    def _step(self, round_number, thread, response, previous_score):
+        self.steps.append({
+            "round": round_number,
+            "thread": thread,
+            "agent": response['agent_name'],
+            "score": response['content'][-1]['score'],
+            "previous_score": previous_score,
+            "seconds": round(self.pending_seconds, 3),
+            "tokens": spent_tokens(self.pending_stats),
+        })
+        self._reset()
+
+    def _overhead(self, node):
+        self.overhead.append({
+            "node": node,
+            "seconds": round(self.pending_seconds, 3),
+            "tokens": spent_tokens(self.pending_stats),
+        })
+        self._reset()
+
+    def _reset(self):
+        self.pending_stats = {}
+        self.pending_seconds = 0.0
+
+    def to_dict(self):
+        """
+        Returns the trace as a JSON-serializable dictionary.
+
+        Returns:
+            dict: The trace of the run.
+        """
+        return {
+            "question": self.question,
+            "started": self.started,
+            "seconds": round(self.last_event - self.started, 3),
+            "difficulty": self.difficulty,
+            "steps": self.steps,
+            "overhead": self.overhead,
+        }
+
+
+def append_trace(trace, path):
+    """
+    Appends the trace of a run to a JSON lines file.
+
+    Args:
+        trace (dict): The trace of the run.
+        path (str): The trace file.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    with trace_file_lock, open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(trace) + "\n")
+
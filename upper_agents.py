@@ -1,90 +1,210 @@
 from typing import Tuple
 import functools
+import hashlib
 import copy
+import time
 
 from state import GraphState
-from models import config, llm_mapping
+from models import config, llm_mapping, provider_mapping
+from prompting import build_prompt
+from budget import plan_compute
+from aggregation import weighted_vote
+from deadline import DeadlineExceeded, call_before_deadline, work_deadline, out_of_time
+from scheduler import Overloaded
+from stats import merge_stats, usage_stats
+from hedging import backup_request, hedged_call
+from cascade import (
+    beam_cutoff, cascade_settings, cheap_call_stats, escalation_stats, first_judge,
+    reply_confidence, should_escalate
+)
+from parsing import (
+    ScoreOutput, JudgeOutput, DifficultyOutput, DoneOutput,
+    message_text, parse_score, parse_comments, parse_difficulty, parse_done, invoke_structured, structured_reply
+)
 
 # AGENTS
 
-def create_commenter_agent(state, llm):
+def comment_on(state, llm, provider, role="commenter"):
     """
-    Creates an agent that comments on the quality of a reasoning chain.
+    Asks a model to comment on the reasoning chain of the response being judged.
 
     Args:
         state (dict): The current state containing the question and agent response.
         llm: The language model used for generating comments.
+        provider (str): The provider of the language model.
+        role (str): The role the call is counted under in the stats.
 
     Returns:
-        dict: Updated state with comments added to the agent response.
+        Tuple[str, dict]: The comments and the stats of the call.
     """
     question = state["question"]
-    agent_response = state["agent_response"]
-    reasoning_chain = agent_response["text"]
+    reasoning_chain = state["agent_response"]["text"]
+
+    # Create the prompt for the language model
+    details = f"Here is the reasoning chain: {reasoning_chain} \n"
+    prompt = build_prompt("commenter", question, details, provider)
+    backup = backup_request("commenter_agent", lambda backup_provider: build_prompt("commenter", question, details, backup_provider))
+
+    # Generate comments using the language model, hedged with the backup model if it is slow
+    result, hedge_stats = call_before_deadline(
+        lambda: hedged_call(role, llm, lambda: llm.invoke(prompt), backup and (lambda: backup[0].invoke(backup[1]))),
+        work_deadline(state)
+    )
+    return result.content, merge_stats(usage_stats(result, role), hedge_stats)
 
-    # Load the system prompt for the commenter agent
-    with open('prompts/commenter.txt', 'r') as file:
-        system_prompt = file.read()
+
+def score_response(state, comments, llm, provider):
+    """
+    Asks a model to score the reasoning chain of the response being judged.
+
+    Args:
+        state (dict): The current state containing the question and agent response.
+        comments (str): The comments on the reasoning chain.
+        llm: The language model used for generating the score.
+        provider (str): The provider of the language model.
+
+    Returns:
+        Tuple[float, float | None, dict]: The score, the confidence the model gave with it, and the stats of the call.
+    """
+    question = state["question"]
+    reasoning_chain = state["agent_response"]["text"]
 
     # Create the prompt for the language model
-    prompt = [
-        ("system", system_prompt),
-        ("human", f"Here is the question: {question} \nHere is the reasoning chain: {reasoning_chain} \n")
-    ]
+    details = f"Here is the reasoning chain: {reasoning_chain} \nHere are the comments: {comments} \n"
+    prompt = build_prompt("scorer", question, details, provider)
+    backup = backup_request("scorer_agent", lambda backup_provider: build_prompt("scorer", question, details, backup_provider))
+
+    # Generate the score using the language model
+    score, reply, stats = structured_reply(
+        llm, prompt, ScoreOutput, "score", parse_score, "scorer",
+        "Only provide the numeric score, a decimal from 1 to 10.", work_deadline(state), backup
+    )
+    return score, reply_confidence(reply), stats
 
-    # Generate comments using the language model
-    result = llm.invoke(prompt)
-    comments = result.content
+
+def create_commenter_agent(state, llm, provider):
+    """
+    Creates an agent that comments on the quality of a reasoning chain.
+
+    In cascade mode the comments come from the cheap model, and the scorer decides
+    whether they have to be redone by `llm`.
+
+    Args:
+        state (dict): The current state containing the question and agent response.
+        llm: The language model used for generating comments.
+        provider (str): The provider of the language model.
+
+    Returns:
+        dict: Updated state with comments added to the agent response.
+    """
+    agent_response = state["agent_response"]
+
+    judge_llm, judge_provider = first_judge("commenter", llm, provider)
+    comments, stats = comment_on(state, judge_llm, judge_provider)
+    if cascade_settings("commenter"):
+        stats = merge_stats(stats, cheap_call_stats("commenter", stats))
 
     # Add comments to the agent response
     agent_response["comments"] = comments
 
-    return {"agent_response": agent_response}
+    return {"agent_response": agent_response, "stats": stats}
 
 
-def create_scorer_agent(state, llm):
+def create_scorer_agent(state, llm, provider, commenter_llm, commenter_provider):
     """
     Creates an agent that scores the quality of a reasoning chain.
 
+    In cascade mode the cheap judges go first. When their score is close to the beam
+    cut-off, or their confidence is low, the comments and/or score are redone by the
+    stronger models, as configured per role.
+
     Args:
         state (dict): The current state containing the question, agent response, and comments.
         llm: The language model used for generating the score.
+        provider (str): The provider of the language model.
+        commenter_llm: The language model used for comments that are escalated.
+        commenter_provider (str): The provider of the commenter language model.
 
     Returns:
         dict: Updated state with the score added to the agent response.
     """
-    question = state["question"]
     agent_response = state["agent_response"]
-    reasoning_chain = agent_response["text"]
     comments = agent_response["comments"]
 
-    # Load the system prompt for the scorer agent
-    with open('prompts/scorer.txt', 'r') as file:
-        system_prompt = file.read()
+    judge_llm, judge_provider = first_judge("scorer", llm, provider)
+    score, confidence, stats = score_response(state, comments, judge_llm, judge_provider)
+    if cascade_settings("scorer"):
+        stats = merge_stats(stats, cheap_call_stats("scorer", stats))
+
+    # Escalate to the stronger models when the cheap judgement is too uncertain
+    cutoff = beam_cutoff(state)
+    redo_comments = should_escalate("commenter", score, confidence, cutoff)
+    if redo_comments:
+        comments, comment_stats = comment_on(state, commenter_llm, commenter_provider)
+        stats = merge_stats(stats, merge_stats(comment_stats, escalation_stats("commenter", comment_stats)))
+        agent_response["comments"] = comments
+
+    if redo_comments or should_escalate("scorer", score, confidence, cutoff):
+        score, _, score_stats = score_response(state, comments, llm, provider)
+        if cascade_settings("scorer"):
+            stats = merge_stats(stats, merge_stats(score_stats, escalation_stats("scorer", score_stats)))
+        else:
+            # Rescoring the new comments counts against what the commenter cascade saved
+            stats = merge_stats(stats, merge_stats(score_stats, {"cascade_cost_saved": -score_stats.get("cost", 0)}))
 
-    # Create the prompt for the language model
-    prompt = [
-        ("system", system_prompt),
-        ("human", f"Here is the question: {question} \nHere is the reasoning chain: {reasoning_chain} \nHere are the comments: {comments} \n")
-    ]
+    # Add the score to the agent response
+    agent_response["score"] = score
 
-    # Generate the score using the language model
-    result = llm.invoke(prompt)
-    score = result.content
+    return {"agent_response": agent_response, "stats": stats}
 
-    # Add the score to the agent response
-    agent_response["score"] = float(score)
 
-    return {"agent_response": agent_response}
+def create_judge_agent(state, llm, provider):
+    """
+    Creates an agent that comments on and scores a reasoning chain in a single call.
+
+    Args:
+        state (dict): The current state containing the question and agent response.
+        llm: The language model used for judging.
+        provider (str): The provider of the language model.
+
+    Returns:
+        dict: Updated state with the comments and score added to the agent response.
+    """
+    question = state["question"]
+    agent_response = state["agent_response"]
+    reasoning_chain = agent_response["text"]
+
+    # Create the prompt for the language model
+    details = f"Here is the reasoning chain: {reasoning_chain} \n"
+    prompt = build_prompt("judge", question, details, provider)
+    backup = backup_request("judge_agent", lambda backup_provider: build_prompt("judge", question, details, backup_provider))
+
+    # Generate the comments and score using the language model
+    score, reply, stats = structured_reply(
+        llm, prompt, JudgeOutput, "score", parse_score, "judge",
+        "Write your comments, then the score on its own line as \"Score: <decimal from 1 to 10>\".",
+        work_deadline(state), backup
+    )
+    if isinstance(reply, JudgeOutput):
+        comments = reply.comments
+    else:
+        comments = parse_comments(message_text(reply)) if reply is not None else ""
+
+    # Add the comments and score to the agent response
+    agent_response["comments"] = comments
+    agent_response["score"] = score
+
+    return {"agent_response": agent_response, "stats": stats}
 
 
-def create_difficulty_agent(state, llm):
+def create_difficulty_agent(state, llm, provider):
     """
     Creates an agent that assesses the difficulty of a question.
 
     Args:
         state (dict): The current state containing the question, responses, comments, and grades.
         llm: The language model used for assessing difficulty.
+        provider (str): The provider of the language model.
 
     Returns:
         dict: A dictionary containing the difficulty level and associated parameters.
@@ -97,22 +217,20 @@ def create_difficulty_agent(state, llm):
     comments = [response["content"][0]["comments"] for response in responses_full]
     grades = [response["content"][0]["score"] for response in responses_full]
 
-    # Load the system prompt for the difficulty agent
-    with open('prompts/difficulty.txt', 'r') as file:
-        system_prompt = file.read()
-
     # Create the prompt for the language model
-    prompt = [
-        ("system", system_prompt),
-        ("human", f"Here is the question: {question} \n"
-                 f"Here is the first response, comments on the response, and its grade: {responses[0]}, {comments[0]}, {grades[0]} \n"
-                 f"Here is the second response, comments on the response, and its grade: {responses[1]}, {comments[1]}, {grades[1]} \n"
-                 f"Here is the third response, comments on the response, and its grade: {responses[2]}, {comments[2]}, {grades[2]} \n")
-    ]
+    prompt = build_prompt(
+        "difficulty", question,
+        f"Here is the first response, comments on the response, and its grade: {responses[0]}, {comments[0]}, {grades[0]} \n"
+        f"Here is the second response, comments on the response, and its grade: {responses[1]}, {comments[1]}, {grades[1]} \n"
+        f"Here is the third response, comments on the response, and its grade: {responses[2]}, {comments[2]}, {grades[2]} \n",
+        provider
+    )
 
     # Get the difficulty level using the language model
-    result = llm.invoke(prompt)
-    difficulty = int(result.content)
+    difficulty, stats = invoke_structured(
+        llm, prompt, DifficultyOutput, "difficulty", parse_difficulty, "difficulty",
+        "Provide only the difficulty level number.", work_deadline(state)
+    )
 
     # Load difficulty settings from configuration
     difficulty_settings = config['difficulty_settings']
@@ -122,23 +240,29 @@ def create_difficulty_agent(state, llm):
     if not settings:
         raise ValueError(f"Unknown difficulty level: {difficulty}")
 
+    # Fit the settings to what is left of the budget
+    if config['budget']['enabled']:
+        settings = plan_compute(state, settings)
+
     # Return the difficulty level and associated parameters
     return {
         "difficulty": difficulty,
         "threads": settings['threads'],
         "beams": settings['beams'],
         "start": False,
-        "revisions": settings['revisions']
+        "revisions": settings['revisions'],
+        "stats": stats
     }
 
 
-def create_check_done_agent(state, llm):
+def create_check_done_agent(state, llm, provider):
     """
     Creates an agent that checks if the reasoning process has converged on a correct answer.
 
     Args:
         state (dict): The current state containing the question and responses.
         llm: The language model used for checking if the process is done.
+        provider (str): The provider of the language model.
 
     Returns:
         dict: A dictionary indicating whether the process is done.
@@ -146,69 +270,120 @@ def create_check_done_agent(state, llm):
     question = state["question"]
     responses = [response["content"] for response in state["responses"]]
 
-    # Load the system prompt for the check_done agent
-    with open('prompts/check_done.txt', 'r') as file:
-        system_prompt = file.read()
-
     # Create the prompt for the language model
-    prompt = [
-        ("system", system_prompt),
-        ("human", f"Here is the question: {question} \nHere are the reasoning chains: {str(responses)} \n")
-    ]
+    prompt = build_prompt("check_done", question, f"Here are the reasoning chains: {str(responses)} \n", provider)
 
     # Invoke the model to check if the process is done
-    result = llm.invoke(prompt)
+    done, stats = invoke_structured(
+        llm, prompt, DoneOutput, "decision", parse_done, "check_done",
+        'Return only "PROCESS DONE" or "CONTINUE".', work_deadline(state)
+    )
 
-    return {"done": result.content == "PROCESS DONE"}
+    return {"done": done, "stats": stats}
 
 
-def create_final_summary_agent(state, llm):
+def best_responses(responses, count):
+    """
+    Picks the threads whose latest response scored best.
+
+    Args:
+        responses (list): The threads of the run.
+        count (int): How many threads to keep.
+
+    Returns:
+        list: The best threads, best first.
+    """
+    return sorted(responses, key=lambda x: x["content"][-1]["score"], reverse=True)[:count]
+
+
+def create_final_summary_agent(state, llm, provider):
     """
     Creates an agent that generates a final summary of reasoning chains.
 
+    The final answers of the threads are first put to a score-weighted vote. When
+    aggregation is enabled and enough of the threads agree, the best agreeing
+    response is returned as is, without calling the model. The share of the vote
+    won is returned as the confidence of the final response either way.
+
+    When the run was cut short by its deadline, only the best responses so far are
+    summarized, and if the summary itself cannot finish in time, or is rejected because
+    the providers are overloaded, the best response is returned as is.
+
     Args:
         state (dict): The current state containing the question and responses.
         llm: The language model used for generating the final summary.
+        provider (str): The provider of the language model.
 
     Returns:
-        dict: A dictionary containing the final combined response.
+        dict: A dictionary containing the final combined response and its confidence.
     """
     question = state["question"]
-    responses = [response["content"] for response in state["responses"]]
-
-    # Load the system prompt for the final_summary agent
-    with open('prompts/final_summary.txt', 'r') as file:
-        system_prompt = file.read()
+    threads = state["responses"]
+    deadline = state.get("deadline")
+
+    if deadline is not None and out_of_time(state):
+        threads = best_responses(threads, state.get("beams") or len(threads))
+    if not threads:
+        if (state.get("stats") or {}).get("overload_rejections"):
+            return {"final_response": "No response could be generated: the providers are overloaded.", "confidence": 0.0}
+        return {"final_response": "No response could be generated before the deadline.", "confidence": 0.0}
+
+    # Skip the summary when the threads already agree on the answer
+    settings = config['aggregation']
+    vote = weighted_vote(threads, settings['max_answer_words'])
+    confidence = vote["agreement"] if vote else None
+    if (
+        settings['enabled'] and vote and vote["votes"] >= settings['min_threads']
+        and vote["agreement"] >= settings['agreement_threshold']
+    ):
+        return {
+            "final_response": vote["thread"]["content"][-1]["text"],
+            "confidence": confidence,
+            "stats": {"final_summary_skipped": 1},
+        }
+
+    responses = [response["content"] for response in threads]
 
     # Create the prompt for the language model
-    prompt = [
-        ("system", system_prompt),
-        ("human", f"Here is the question: {question} \nHere are the reasoning chains: {str(responses)} \n")
-    ]
+    prompt = build_prompt("final_summary", question, f"Here are the reasoning chains: {str(responses)} \n", provider)
 
     # Generate the final summary using the language model
-    result = llm.invoke(prompt)
+    try:
+        result = call_before_deadline(lambda: llm.invoke(prompt), deadline)
+    except (DeadlineExceeded, Overloaded) as e:
+        best = best_responses(threads, 1)[0]
+        return {
+            "final_response": best["content"][-1]["text"],
+            "confidence": confidence,
+            "stats": {"deadline_fallbacks" if isinstance(e, DeadlineExceeded) else "overload_fallbacks": 1},
+        }
 
-    return {"final_response": result.content}
+    return {"final_response": result.content, "confidence": confidence, "stats": usage_stats(result, "final_summary")}
 
 
 # PARTIAL AGENT CREATION
 
 # Create partials for each agent by binding them to their respective language model
 commenter_llm = llm_mapping['commenter_agent']
-commenter_agent = functools.partial(create_commenter_agent, llm=commenter_llm)
+commenter_agent = functools.partial(create_commenter_agent, llm=commenter_llm, provider=provider_mapping['commenter_agent'])
 
 scorer_llm = llm_mapping['scorer_agent']
-scorer_agent = functools.partial(create_scorer_agent, llm=scorer_llm)
+scorer_agent = functools.partial(
+    create_scorer_agent, llm=scorer_llm, provider=provider_mapping['scorer_agent'],
+    commenter_llm=commenter_llm, commenter_provider=provider_mapping['commenter_agent']
+)
+
+judge_llm = llm_mapping['judge_agent']
+judge_agent = functools.partial(create_judge_agent, llm=judge_llm, provider=provider_mapping['judge_agent'])
 
 difficulty_llm = llm_mapping['difficulty_agent']
-difficulty_agent = functools.partial(create_difficulty_agent, llm=difficulty_llm)
+difficulty_agent = functools.partial(create_difficulty_agent, llm=difficulty_llm, provider=provider_mapping['difficulty_agent'])
 
 check_done_llm = llm_mapping['check_done_agent']
-check_done_agent = functools.partial(create_check_done_agent, llm=check_done_llm)
+check_done_agent = functools.partial(create_check_done_agent, llm=check_done_llm, provider=provider_mapping['check_done_agent'])
 
 final_summary_llm = llm_mapping['final_summary_agent']
-final_summary_agent = functools.partial(create_final_summary_agent, llm=final_summary_llm)
+final_summary_agent = functools.partial(create_final_summary_agent, llm=final_summary_llm, provider=provider_mapping['final_summary_agent'])
 
 
 # STATE AND RESPONSE HANDLING FUNCTIONS
@@ -223,11 +398,18 @@ def ask_question(state: GraphState) -> GraphState:
     Returns:
         GraphState: The initial state with default values.
     """
+    budget = config['budget']
+    deadline_seconds = config['deadline']['seconds']
     return {
         "initial_response_agent": config['start_settings']['starting_agent'],
         "responses": [],
         "threads": config['start_settings']['threads'],
-        "start": True
+        "start": True,
+        "sample_pool": {},
+        "token_budget": state.get("token_budget") or (budget['max_tokens'] if budget['enabled'] else None),
+        "cost_budget": state.get("cost_budget") or (budget['max_cost'] if budget['enabled'] else None),
+        "deadline": state.get("deadline") or (time.time() + deadline_seconds if deadline_seconds else None),
+        "timed_out": False
     }
 
 
@@ -266,6 +448,54 @@ def get_info_for_revision_response(state: GraphState) -> Tuple[str, str, str, st
     )
 
 
+def sampling_key(*parts) -> str:
+    """
+    Builds the key under which turns sampled for identical inputs are pooled.
+
+    Args:
+        *parts (str): Everything that makes up the input of the agent.
+
+    Returns:
+        str: The key.
+    """
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def count_initial_responses_for_agent(state: GraphState) -> int:
+    """
+    Counts the initial responses still to be generated, including this one, that go to the current initial response agent.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        int: The number of initial responses sharing the current agent and question.
+    """
+    remaining = state["threads"] - len(state["responses"])
+    agents = len(llm_mapping["response_agents"])
+    return max(1, -(-remaining // agents))
+
+
+def count_identical_revisions(state: GraphState) -> int:
+    """
+    Counts the threads, starting with the current one, whose next revision has exactly the same input.
+
+    Args:
+        state (GraphState): The current state.
+
+    Returns:
+        int: The number of threads sharing the agent, previous response and comments of the current thread.
+    """
+    responses = state["responses"]
+    index = state["index"]
+
+    def revision_input(response):
+        return response["agent_name"], response["content"][-1]["text"], response["content"][-1]["comments"]
+
+    current = revision_input(responses[index])
+    return sum(1 for response in responses[index:] if revision_input(response) == current)
+
+
 def join_graph(response: dict):
     """
     Add the original response to the upper-level graph.
@@ -274,9 +504,14 @@ def join_graph(response: dict):
         response (dict): The response to add.
 
     Returns:
-        dict: The agent response containing the final answer.
+        dict: The agent response containing the final answer, and the stats of the subgraph.
     """
-    return {"agent_response": {"text": response["final_answer"]}}
+    stats = response.get("stats", {})
+    agent_response = {"text": response["final_answer"]}
+    # Report the context the thread's tool outputs no longer take up
+    if stats.get("tool_tokens_saved"):
+        agent_response["tool_tokens_saved"] = stats["tool_tokens_saved"]
+    return {"agent_response": agent_response, "stats": stats}
 
 
 def beam_search_agent(state: GraphState) -> GraphState:
@@ -300,7 +535,7 @@ def beam_search_agent(state: GraphState) -> GraphState:
     # Replicate best responses to fill threads
     final_responses = []
     for response in best_responses:
-        final_responses.extend([copy.deepcopy(response)] * (threads // beams))
+        final_responses.extend(copy.deepcopy(response) for _ in range(threads // beams))
 
     # Add remaining responses to balance
     for i in range(threads % beams):
@@ -0,0 +1,188 @@
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jobqueue import JobQueue
+from models import config
+
+settings = config['workers']
+
+
+def open_queue():
+    """
+    Opens the job queue set in the workers section of the config.
+
+    Returns:
+        JobQueue: The queue.
+    """
+    return JobQueue(settings['queue_path'], settings['lease_seconds'], settings['max_attempts'])
+
+
+def initial_state(options):
+    """
+    Turns the options of a job into the extra initial state of its run.
+
+    Args:
+        options (dict): The token_budget, cost_budget and/or deadline_seconds of the job.
+
+    Returns:
+        dict: The initial state, with the deadline counted from the start of this attempt.
+    """
+    state = {}
+    if options.get("token_budget"):
+        state["token_budget"] = int(options["token_budget"])
+    if options.get("cost_budget"):
+        state["cost_budget"] = float(options["cost_budget"])
+    if options.get("deadline_seconds"):
+        state["deadline"] = time.time() + options["deadline_seconds"]
+    return state
+
+
+def run_job(queue, job, worker, run_question):
+    """
+    Runs a claimed question, keeping its lease alive until the result is stored.
+
+    Args:
+        queue (JobQueue): The job queue.
+        job (dict): The claimed job.
+        worker (str): The id of this worker.
+        run_question (callable): Runs a question through this worker's graph.
+    """
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(settings['heartbeat_seconds']):
+            if not queue.heartbeat(job["id"], worker):
+                return
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    log_name = f"reasoning_log_{job['id']}.txt"
+    try:
+        result = run_question(
+            job["question"], initial_state=initial_state(job["options"]), log_name=log_name, tenant=job["options"].get("tenant")
+        )
+        queue.complete(job["id"], worker, result, os.path.join("logs", log_name))
+    except Exception as e:
+        queue.fail(job["id"], worker, f"{type(e).__name__}: {e}")
+    finally:
+        stop.set()
+
+
+def worker_process(index):
+    """
+    Runs questions from the queue until the process is stopped.
+
+    Every worker process compiles its own graph and provider clients, and runs up to
+    `runs_per_worker` questions at a time on threads, since runs mostly wait on the providers.
+
+    Args:
+        index (int): The number of the worker, used in its id.
+    """
+    # Imported here so that every process builds its own graph and clients
+    from test_time_compute import run_question
+
+    worker = f"{socket.gethostname()}-{os.getpid()}-{index}"
+    queue = open_queue()
+    slots = threading.BoundedSemaphore(settings['runs_per_worker'])
+    with ThreadPoolExecutor(max_workers=settings['runs_per_worker']) as executor:
+        while True:
+            slots.acquire()
+            job = queue.claim(worker)
+            if job is None:
+                slots.release()
+                time.sleep(settings['poll_seconds'])
+                continue
+
+            future = executor.submit(run_job, queue, job, worker, run_question)
+            future.add_done_callback(lambda _: slots.release())
+
+
+def supervise(processes):
+    """
+    Starts the worker processes and restarts any that dies, until interrupted.
+
+    The questions a dead worker held go back to the queue once their lease expires.
+
+    Args:
+        processes (int): The number of worker processes.
+    """
+    # Spawned processes start clean instead of sharing the parent's connections
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    # Stop the workers too when the pool is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            for index in range(processes):
+                if index not in workers or not workers[index].is_alive():
+                    if index in workers:
+                        print(f"Worker {index} exited with code {workers[index].exitcode}, restarting it")
+                    workers[index] = context.Process(target=worker_process, args=(index,), daemon=True)
+                    workers[index].start()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+
+
+def submit_file(queue, path):
+    """
+    Adds every question of a JSON lines file to the queue.
+
+    Args:
+        queue (JobQueue): The job queue.
+        path (str): The file, with a "question" and optionally a "token_budget", "cost_budget",
+            "deadline_seconds" and "tenant" on every line.
+
+    Returns:
+        list: The ids of the submitted jobs.
+    """
+    ids = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                options = {key: entry[key] for key in ("token_budget", "cost_budget", "deadline_seconds", "tenant") if entry.get(key)}
+                ids.append(queue.submit(entry["question"], options))
+    return ids
+
+
+def main():
+    """
+    Command-line entry point: submits questions to the queue, reports its status, or runs the worker pool.
+    """
+    parser = argparse.ArgumentParser(description="Answer queued questions with a pool of worker processes.")
+    parser.add_argument("--processes", type=int, default=settings['processes'],
+                        help="Number of worker processes (0 for one per CPU core).")
+    parser.add_argument("--submit", help="Queue the questions of a JSON lines file and exit.")
+    parser.add_argument("--status", action="store_true", help="Print the number of jobs by status and exit.")
+    parser.add_argument("--result", help="Print the job with this id and exit.")
+    args = parser.parse_args()
+
+    queue = open_queue()
+    if args.submit:
+        for job_id in submit_file(queue, args.submit):
+            print(job_id)
+    elif args.status:
+        print(json.dumps(queue.counts()))
+    elif args.result:
+        print(json.dumps(queue.get(args.result), indent=2))
+    else:
+        processes = args.processes or os.cpu_count()
+        print(f"Starting {processes} worker processes on {settings['queue_path']}")
+        supervise(processes)
+
+
+if __name__ == "__main__":
+    main()